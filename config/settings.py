@@ -64,14 +64,32 @@ ASGI_APPLICATION = 'config.asgi.application'
 WSGI_APPLICATION = 'config.wsgi.application'
 
 # Настройки для Channels и Redis (наше "почтовое отделение")
-#CHANNEL_LAYERS = {
-#   "default": {
-#       "BACKEND": "channels_redis.core.RedisChannelLayer",
-#       "CONFIG": {
-#           "hosts": [("127.0.0.1", 6379)],
-#       },
-#   },
-#}
+# Группы chat_<id> общие для daphne и runbot, поэтому в работе нужен Redis.
+# Без CHANNEL_REDIS_URL - слой в памяти процесса: для разработки и проверок, между процессами он не работает
+CHANNEL_REDIS_URL = config('CHANNEL_REDIS_URL', default='')
+# Сколько сообщений может ждать в одном канале и сколько секунд хранится непрочитанное
+CHANNEL_LAYER_CAPACITY = config('CHANNEL_LAYER_CAPACITY', default=100, cast=int)
+CHANNEL_LAYER_EXPIRY = config('CHANNEL_LAYER_EXPIRY', default=60, cast=int)
+if CHANNEL_REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [CHANNEL_REDIS_URL],
+                "prefix": "myroute",
+                "capacity": CHANNEL_LAYER_CAPACITY,
+                "expiry": CHANNEL_LAYER_EXPIRY,
+                "serializer_format": "msgpack",
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {"capacity": CHANNEL_LAYER_CAPACITY, "expiry": CHANNEL_LAYER_EXPIRY},
+        },
+    }
 
 DATABASES = {
     'default': {
@@ -81,6 +99,9 @@ DATABASES = {
         'PASSWORD': config('POSTGRES_PASSWORD'),
         'HOST': config('POSTGRES_HOST'),
         'PORT': config('POSTGRES_PORT'),
+        # Постоянные соединения: пул потоков бота не переподключается на каждый запрос
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -101,6 +122,56 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Кэш пользователей в процессе бота (telegram_id -> User)
+BOT_USER_CACHE_MAXSIZE = config('BOT_USER_CACHE_MAXSIZE', default=2048, cast=int)
+BOT_USER_CACHE_TTL = config('BOT_USER_CACHE_TTL', default=60, cast=int)
+
+# Сколько апдейтов бот обрабатывает одновременно (порядок внутри чата сохраняется)
+BOT_CONCURRENT_UPDATES = config('BOT_CONCURRENT_UPDATES', default=32, cast=int)
+
+# Записей на одной странице списков бота ("Мои поездки", "История" и т.д.)
+BOT_LIST_PAGE_SIZE = config('BOT_LIST_PAGE_SIZE', default=5, cast=int)
+
+# Потоки для запросов бота к БД (у каждого свое соединение)
+BOT_DB_THREADS = config('BOT_DB_THREADS', default=8, cast=int)
+
+# Режим вебхука (manage.py runbot --webhook)
+BOT_WEBHOOK_URL = config('BOT_WEBHOOK_URL', default='')
+BOT_WEBHOOK_SECRET = config('BOT_WEBHOOK_SECRET', default='')
+
+# Очередь исходящих сообщений Telegram (users/outbox.py): лимиты Bot API
+TELEGRAM_API_URL = config('TELEGRAM_API_URL', default='https://api.telegram.org/bot')
+OUTBOX_GLOBAL_RATE = config('OUTBOX_GLOBAL_RATE', default=30, cast=int)
+OUTBOX_CHAT_INTERVAL = config('OUTBOX_CHAT_INTERVAL', default=1.0, cast=float)
+# Где считать лимиты (users/rate_limit.py). С Redis лимит общий для runbot, Daphne и админки,
+# в него входят и ответы бота. Без Redis у каждого процесса свой лимит, и вместе они могут его превысить
+TELEGRAM_RATE_LIMIT_REDIS_URL = config('TELEGRAM_RATE_LIMIT_REDIS_URL', default=CHANNEL_REDIS_URL)
+
+# Удержание мест, пока пассажир вводит количество мест (секунды), и период очистки просроченных
+SEAT_HOLD_TTL = config('SEAT_HOLD_TTL', default=300, cast=int)
+SEAT_HOLD_SWEEP_SECONDS = config('SEAT_HOLD_SWEEP_SECONDS', default=30, cast=int)
+
+# Чат поддержки: сколько сообщений писать в БД одним bulk_create (support/writer.py)
+SUPPORT_CHAT_BATCH_SIZE = config('SUPPORT_CHAT_BATCH_SIZE', default=100, cast=int)
+# Сообщения администраторов с сайта копятся до записи не дольше стольких миллисекунд
+SUPPORT_CHAT_FLUSH_MS = config('SUPPORT_CHAT_FLUSH_MS', default=50, cast=int)
+# Сколько раз повторять запись сообщений чата при временной ошибке БД
+SUPPORT_CHAT_WRITE_RETRIES = config('SUPPORT_CHAT_WRITE_RETRIES', default=3, cast=int)
+# Сколько последних сообщений обращения администратор получает при открытии чата (и за один запрос load_older)
+SUPPORT_CHAT_HISTORY_SIZE = config('SUPPORT_CHAT_HISTORY_SIZE', default=50, cast=int)
+
+# Как часто процесс перечитывает справочник городов из БД (секунды)
+GAZETTEER_RELOAD_SECONDS = config('GAZETTEER_RELOAD_SECONDS', default=600, cast=int)
+
+# Метрики обработчиков бота (users/metrics.py). Отдаются в формате Prometheus
+# по HTTP (BOT_METRICS_PORT, 0 - не поднимать) и/или пишутся в файл раз в BOT_METRICS_DUMP_SECONDS
+BOT_METRICS_ENABLED = config('BOT_METRICS_ENABLED', default=False, cast=bool)
+BOT_METRICS_HOST = config('BOT_METRICS_HOST', default='127.0.0.1')
+BOT_METRICS_PORT = config('BOT_METRICS_PORT', default=0, cast=int)
+BOT_METRICS_FILE = config('BOT_METRICS_FILE', default='')
+BOT_METRICS_DUMP_SECONDS = config('BOT_METRICS_DUMP_SECONDS', default=15, cast=int)
+BOT_METRICS_SLOW_HANDLER_SECONDS = config('BOT_METRICS_SLOW_HANDLER_SECONDS', default=1.0, cast=float)
+
 AUTH_USER_MODEL = 'users.User'
 
 # config/settings.py
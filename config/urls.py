@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from users.views import telegram_webhook
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('support/', include('support.urls')),
+    path('telegram/webhook/', telegram_webhook, name='telegram_webhook'),
 ]
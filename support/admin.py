@@ -1,13 +1,16 @@
 # support/admin.py
 
 from django.contrib import admin
+from django.db import transaction
 from django.urls import reverse
 from django.utils.html import format_html
 from .models import SupportTicket, ChatMessage
+from .writer import notify_ticket_updated
 
 @admin.register(SupportTicket)
 class SupportTicketAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'status', 'created_at', 'open_chat_link')
+    list_select_related = ('user',)
     list_filter = ('status', 'created_at')
     search_fields = ('user__name', 'user__telegram_id', 'message')
     ordering = ('-created_at',)
@@ -23,9 +26,23 @@ class SupportTicketAdmin(admin.ModelAdmin):
 
     open_chat_link.short_description = 'Чат с пользователем'
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Открытые вкладки чата держат обращение в памяти - обновляем их после коммита
+        if change and form.changed_data:
+            transaction.on_commit(lambda: notify_ticket_updated(obj.id))
+
 # Регистрируем модель сообщений, чтобы видеть ее в админке (для отладки)
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ('ticket', 'author', 'timestamp')
+    # __str__ тикета читает его пользователя
+    list_select_related = ('ticket__user', 'author')
     list_filter = ('timestamp', 'author')
     search_fields = ('message', 'author__name')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # Выпадающий список тикетов в карточке: __str__ каждого тикета читает пользователя
+        if db_field.name == 'ticket':
+            kwargs['queryset'] = SupportTicket.objects.select_related('user')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
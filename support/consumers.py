@@ -1,12 +1,19 @@
+import asyncio
 import json
-import os
+import logging
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+
 from django.conf import settings
-import httpx
+from django.core.exceptions import ValidationError
+
+from trips.pagination import decode_cursor, keyset_page
+from users.outbox import get_outbox, TelegramSendError
+from .models import SupportTicket, ChatMessage
+from .writer import chat_group_name, get_admin_chat_writer
 
-from users.models import User
-from .models import SupportTicket, TicketMessage
+logger = logging.getLogger(__name__)
 
 # --- Вспомогательные функции для работы с БД ---
 @database_sync_to_async
@@ -23,56 +30,39 @@ def get_ticket_and_user(ticket_id, admin_user):
         return None, None
 
 @database_sync_to_async
-def save_message(ticket, sender, message_text):
+def get_ticket_history(ticket_id, cursor=None, limit=None):
     """
-    Сохраняет новое сообщение в базу данных.
+    Страница истории обращения: последние limit сообщений, а с cursor - сообщения
+    старше него. Keyset по (timestamp, id) из trips.pagination, без OFFSET.
+    Возвращает (сообщения от старых к новым, есть_еще_старше, курсор_самого_старого).
     """
-    return TicketMessage.objects.create(
-        ticket=ticket,
-        sender=sender,
-        text=message_text
+    messages = ChatMessage.objects.filter(ticket_id=ticket_id).select_related('author')
+    rows, _, has_older, _, oldest_cursor = keyset_page(
+        messages, 'timestamp', limit or settings.SUPPORT_CHAT_HISTORY_SIZE, cursor
     )
-
-@database_sync_to_async
-def get_ticket_history(ticket):
-    """
-    Загружает историю сообщений для данного обращения.
-    """
-    return list(ticket.messages.select_related('sender').order_by('timestamp'))
-
-# --- Функция для отправки сообщения пользователю в Telegram ---
-def send_telegram_message(chat_id, text):
-    """
-    Отправляет сообщение пользователю в Telegram.
-    (Эта функция дублируется из admin.py для использования здесь)
-    """
-    bot_token = settings.BOT_TOKEN
-    if not bot_token:
-        print("Ошибка: Токен бота не найден в настройках Django.")
-        return
-    
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {'chat_id': chat_id, 'text': text}
-    try:
-        # Используем синхронный запрос, так как consumer работает в асинхронном потоке
-        with httpx.Client() as client:
-            response = client.post(url, json=payload)
-            response.raise_for_status()
-    except Exception as e:
-        print(f"Ошибка отправки сообщения в Telegram: {e}")
+    return rows[::-1], has_older, oldest_cursor
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Получаем ID обращения из URL
         self.ticket_id = self.scope['url_route']['kwargs']['ticket_id']
-        self.room_group_name = f'chat_{self.ticket_id}'
+        self.room_group_name = chat_group_name(self.ticket_id)
         self.user = self.scope['user']
+        # Фоновые задачи, ожидающие доставки сообщений в Telegram
+        self.delivery_tasks = set()
 
         # Проверяем, что пользователь авторизован и является администратором
         if not self.user.is_authenticated or not self.user.is_staff:
             await self.close()
             return
 
+        # Обращение и его автор не меняются за время соединения: читаются один раз,
+        # заново - только по событию ticket_updated
+        self.ticket, self.target_user = await get_ticket_and_user(self.ticket_id, self.user)
+        if not self.ticket:
+            await self.close()
+            return
+
         # Присоединяемся к "комнате" чата
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -80,15 +70,33 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         await self.accept()
 
-        # Загружаем и отправляем историю сообщений
-        history = await get_ticket_history(await get_ticket_and_user(self.ticket_id, self.user))
-        for msg in history:
-            sender_name = "Вы (Админ)" if msg.sender == self.user else msg.sender.name
-            await self.send(text_data=json.dumps({
-                'message': msg.text,
-                'sender': sender_name
-            }))
-
+        # Последние сообщения одним кадром; более старые - по запросу load_older
+        await self.send_history()
+
+    async def send_history(self, cursor=None):
+        try:
+            # Курсор пришел от клиента: история упорядочена по времени, другие типы не подходят
+            if cursor is not None:
+                decode_cursor(cursor, kinds='t')
+            messages, has_older, oldest_cursor = await get_ticket_history(self.ticket_id, cursor)
+        except (ValueError, TypeError, ValidationError) as e:
+            logger.warning(f"Некорректный курсор истории обращения {self.ticket_id}: {e}")
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'history',
+            'older': cursor is not None,
+            'messages': [
+                {
+                    'message': msg.message,
+                    'sender': "Вы (Админ)" if msg.author_id == self.user.id else msg.author.name,
+                    'message_id': msg.id,
+                    'timestamp': msg.timestamp.isoformat(),
+                }
+                for msg in messages
+            ],
+            'has_older': has_older,
+            'cursor': oldest_cursor,
+        }))
 
     async def disconnect(self, close_code):
         # Отключаемся от "комнаты"
@@ -96,29 +104,61 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        # Сообщения этого администратора, еще не записанные в БД, дописываются до закрытия.
+        # При остановке Daphne отменяет задачи приложения: остаток очереди пишет atexit (support/writer.py)
+        await get_admin_chat_writer().flush()
 
     # Принимаем сообщение от WebSocket (от администратора с сайта)
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        
-        ticket, target_user = await get_ticket_and_user(self.ticket_id, self.user)
-        if not ticket:
+        if text_data_json.get('type') == 'load_older':
+            await self.send_history(str(text_data_json.get('cursor') or '') or None)
             return
+        message = text_data_json['message']
+        target_user = self.target_user
+        # id из БД появится только после записи пачки: статус доставки привязан к client_id
+        client_id = uuid.uuid4().hex
 
-        # Сохраняем сообщение в БД
-        await save_message(ticket, self.user, message)
-
-        # Отправляем сообщение пользователю в Telegram
-        send_telegram_message(target_user.telegram_id, message)
-        
-        # Отправляем сообщение в "комнату" (чтобы оно отобразилось у самого администратора)
+        # Отправляем сообщение в "комнату" сразу (чтобы оно отобразилось у самого администратора),
+        # а в БД оно попадет со следующей пачкой; если запись не удастся, придет событие save_failed
         await self.channel_layer.group_send(
             self.room_group_name,
             {
                 'type': 'chat_message',
                 'message': message,
-                'sender': 'Вы (Админ)'
+                'sender': 'Вы (Админ)',
+                'message_id': None,
+                'client_id': client_id,
+            }
+        )
+        get_admin_chat_writer().submit(self.ticket.id, self.user, message, client_id=client_id)
+
+        # Отправка в Telegram идет через общую очередь в фоне: receive не ждет Telegram,
+        # а статус доставки приходит в "комнату" отдельным событием
+        try:
+            future = get_outbox().enqueue(target_user.telegram_id, message)
+        except TelegramSendError as e:
+            await self.report_delivery(client_id, error=e)
+            return
+        task = asyncio.create_task(self.report_delivery(client_id, future))
+        self.delivery_tasks.add(task)
+        task.add_done_callback(self.delivery_tasks.discard)
+
+    async def report_delivery(self, client_id, future=None, error=None):
+        if future is not None:
+            try:
+                await asyncio.wrap_future(future)
+            except TelegramSendError as e:
+                error = e
+        if error is not None:
+            logger.warning(f"Не удалось отправить сообщение обращения {self.ticket_id} в Telegram: {error}")
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'delivery_status',
+                'client_id': client_id,
+                'status': 'failed' if error else 'delivered',
+                'error': str(error) if error else None,
             }
         )
 
@@ -130,5 +170,37 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Отправляем сообщение в WebSocket (в браузер администратору)
         await self.send(text_data=json.dumps({
             'message': message,
-            'sender': sender
+            'sender': sender,
+            'message_id': event.get('message_id'),
+            'client_id': event.get('client_id'),
+        }))
+
+    # Статус доставки сообщения администратора в Telegram
+    async def delivery_status(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'delivery_status',
+            'client_id': event['client_id'],
+            'status': event['status'],
+            'error': event['error'],
+        }))
+
+    # Сообщение администратора, показанное как отправленное, не удалось записать в БД
+    async def save_failed(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'save_failed',
+            'client_id': event['client_id'],
+            'error': event['error'],
+        }))
+
+    # Обращение изменено в админке (статус и т.п.): перечитываем его и сообщаем странице
+    async def ticket_updated(self, event):
+        ticket, target_user = await get_ticket_and_user(self.ticket_id, self.user)
+        if not ticket:
+            await self.close()
+            return
+        self.ticket, self.target_user = ticket, target_user
+        await self.send(text_data=json.dumps({
+            'type': 'ticket_updated',
+            'status': ticket.status,
+            'status_display': ticket.get_status_display(),
         }))
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет задержку рассылки group_send в чате поддержки: одно обращение, 1/10/100 '
+        'открытых вкладок администраторов. По умолчанию - слой из CHANNEL_LAYERS (Redis, если задан CHANNEL_REDIS_URL).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--admins', default='1,10,100', help='Число подписчиков группы, через запятую')
+        parser.add_argument('--messages', type=int, default=200, help='Сообщений на каждый замер')
+        parser.add_argument('--in-memory', action='store_true', help='Слой в памяти процесса вместо настроенного')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        if options['in_memory']:
+            layer = InMemoryChannelLayer(capacity=settings.CHANNEL_LAYER_CAPACITY, expiry=settings.CHANNEL_LAYER_EXPIRY)
+        else:
+            layer = get_channel_layer()
+        self.stdout.write(f"Слой: {type(layer).__name__}, сообщений на замер: {options['messages']}")
+        self.stdout.write(
+            f"{'админов':>7} | {'первый p50 мс':>13} | {'последний p50 мс':>16} | "
+            f"{'последний p95 мс':>16} | {'последний p99 мс':>16} | {'доставок/с':>10}"
+        )
+        for admins in (int(value) for value in options['admins'].split(',')):
+            await self.measure(layer, admins, options['messages'])
+
+    async def measure(self, layer, admins, messages):
+        group = f"chat_bench_{admins}"
+        channels = [await layer.new_channel() for _ in range(admins)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        first, last = [], []
+        try:
+            started = time.perf_counter()
+            for index in range(messages):
+                # Такое же событие, как у администратора в ChatConsumer.receive
+                event = {'type': 'chat_message', 'message': f"Сообщение {index}", 'sender': 'Бенчмарк', 'message_id': index}
+                sent = time.perf_counter()
+                receive = [asyncio.ensure_future(layer.receive(channel)) for channel in channels]
+                await layer.group_send(group, event)
+                arrivals = []
+                for future in asyncio.as_completed(receive):
+                    await future
+                    arrivals.append(time.perf_counter() - sent)
+                first.append(arrivals[0])
+                last.append(arrivals[-1])
+            elapsed = time.perf_counter() - started
+        finally:
+            for channel in channels:
+                await layer.group_discard(group, channel)
+        self.stdout.write(
+            f"{admins:>7} | {percentile(first, 0.5) * 1000:>13.2f} | {percentile(last, 0.5) * 1000:>16.2f} | "
+            f"{percentile(last, 0.95) * 1000:>16.2f} | {percentile(last, 0.99) * 1000:>16.2f} | {messages * admins / elapsed:>10.0f}"
+        )
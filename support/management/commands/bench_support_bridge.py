@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from support.models import SupportTicket
+from support.writer import chat_group_name, configure_chat_writer
+from users.bench_db import bench_database
+from users.db_executor import db_async
+from users.keyboards import SUPPORT_BTN
+from users.management.commands.loadtest_bot import (
+    TELEGRAM_ID_BASE, Harness, SyntheticUser, percentile,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет мост бот -> чат поддержки: пользователи пишут в открытые обращения через runbot '
+        '(без сети, как loadtest_bot), администраторы слушают группы chat_<id>. '
+        'Задержка - от апдейта Telegram до события у администратора. Прогон идет в отдельной тестовой БД.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Пользователей с открытым обращением')
+        parser.add_argument('--messages', type=int, default=20, help='Сообщений от каждого')
+
+    def handle(self, *args, **options):
+        with bench_database(self.stdout):
+            asyncio.run(self.run(options))
+
+    async def run(self, options):
+        harness = await Harness.open(concurrency=options['users'])
+        writes = []
+
+        # Считаем записи в БД: сколько bulk_create понадобилось на все сообщения
+        def counting_run_sync(func):
+            run = db_async(func)
+
+            async def wrapper(batch):
+                writes.append(len(batch))
+                return await run(batch)
+            return wrapper
+        configure_chat_writer(run_sync=counting_run_sync)
+
+        users = [SyntheticUser(harness, TELEGRAM_ID_BASE + n) for n in range(options['users'])]
+        await harness.run_phase(users, lambda user: user.register("Я Пассажир 🧍"))
+
+        async def open_ticket(user):
+            await user.send(SUPPORT_BTN)
+            await user.send("Вопрос по бронированию")
+        await harness.run_phase(users, open_ticket)
+        tickets = dict(await asyncio.to_thread(lambda: list(
+            SupportTicket.objects.filter(user__telegram_id__gte=TELEGRAM_ID_BASE).values_list('user__telegram_id', 'id')
+        )))
+
+        # Вкладка администратора на каждое обращение
+        layer = get_channel_layer()
+        admin_channels = {}
+        for user in users:
+            channel = await layer.new_channel()
+            await layer.group_add(chat_group_name(tickets[user.id]), channel)
+            admin_channels[user.id] = channel
+
+        latencies = []
+
+        async def chat(user):
+            for index in range(options['messages']):
+                sent = time.perf_counter()
+                await user.send(f"Подробность {index}")
+                event = await layer.receive(admin_channels[user.id])
+                latencies.append(time.perf_counter() - sent)
+                assert event['message'] == f"Подробность {index}", event
+
+        started = time.perf_counter()
+        await harness.run_phase(users, chat)
+        elapsed = time.perf_counter() - started
+        await harness.close()
+        configure_chat_writer(run_sync=db_async)
+
+        total = len(latencies)
+        self.stdout.write(f"Сообщений: {total} от {len(users)} пользователей за {elapsed:.2f} с ({total / elapsed:.0f} в с)")
+        self.stdout.write(
+            f"До администратора: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, p95 {percentile(latencies, 0.95) * 1000:.1f} мс, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс, max {max(latencies) * 1000:.1f} мс"
+        )
+        self.stdout.write(f"Записей в БД (bulk_create): {len(writes)}, в среднем {total / len(writes):.1f} сообщений за запись")
+        for error, count in harness.errors.most_common():
+            self.stdout.write(self.style.WARNING(f"Ошибка x{count}: {error}"))
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0003_alter_supportticket_options'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['ticket', 'timestamp'], name='chatmessage_ticket_ts_idx'),
+        ),
+    ]
@@ -37,4 +37,8 @@ class ChatMessage(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # История обращения по страницам: фильтр по тикету и курсор по времени
+            models.Index(fields=['ticket', 'timestamp'], name='chatmessage_ticket_ts_idx'),
+        ]
 
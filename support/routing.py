@@ -4,6 +4,5 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    # ПРАВИЛЬНО:
-    re_path(r'ws/support/(?P<ticket_id>\d+)/$', consumers.SupportConsumer.as_asgi()),
+    re_path(r'ws/support/(?P<ticket_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
 ]
@@ -1,3 +1,241 @@
-from django.test import TestCase
+import asyncio
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest.mock import Mock, patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from users.models import User
+
+from .consumers import ChatConsumer
+from .models import ChatMessage, SupportTicket
+from .writer import ChatMessageWriter, chat_group_name
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, SUPPORT_CHAT_HISTORY_SIZE=2)
+class ChatHistoryTests(TransactionTestCase):
+    """ChatConsumer: история обращения (первая страница и load_older) и сообщения администратора."""
+
+    def setUp(self):
+        self.admin = User.objects.create(username='admin', name='Администратор', is_staff=True)
+        author = User.objects.create(username='author', telegram_id=10, name='Пассажир')
+        self.ticket = SupportTicket.objects.create(user=author, message='Не приходит подтверждение')
+        start = timezone.now() - timedelta(hours=1)
+        for minute in range(3):
+            message = ChatMessage.objects.create(ticket=self.ticket, author=author, message=f'Сообщение {minute}')
+            # auto_now_add: время задается отдельным UPDATE
+            ChatMessage.objects.filter(id=message.id).update(timestamp=start + timedelta(minutes=minute))
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/support/{self.ticket.id}/')
+        communicator.scope['user'] = self.admin
+        communicator.scope['url_route'] = {'kwargs': {'ticket_id': self.ticket.id}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_history_pages(self):
+        communicator = await self.connect()
+        latest = await communicator.receive_json_from()
+        self.assertEqual(latest['type'], 'history')
+        self.assertFalse(latest['older'])
+        self.assertEqual([m['message'] for m in latest['messages']], ['Сообщение 1', 'Сообщение 2'])
+        self.assertTrue(latest['has_older'])
+
+        await communicator.send_json_to({'type': 'load_older', 'cursor': latest['cursor']})
+        older = await communicator.receive_json_from()
+        self.assertTrue(older['older'])
+        self.assertEqual([m['message'] for m in older['messages']], ['Сообщение 0'])
+        self.assertFalse(older['has_older'])
+        await communicator.disconnect()
+
+    async def test_malformed_cursor_is_ignored(self):
+        communicator = await self.connect()
+        latest = await communicator.receive_json_from()
+        for cursor in ('f1.5_3', 'd1.5_3', 't1.5_3', 'garbage', 't99999999999999999999999_1', 42):
+            await communicator.send_json_to({'type': 'load_older', 'cursor': cursor})
+            self.assertTrue(await communicator.receive_nothing())
+        # Соединение живо и отвечает на правильный курсор
+        await communicator.send_json_to({'type': 'load_older', 'cursor': latest['cursor']})
+        self.assertTrue((await communicator.receive_json_from())['older'])
+        await communicator.disconnect()
+
+    async def test_unsaved_message_is_reported(self):
+        writer = ChatMessageWriter(run_sync=RecordingWrites(failures=1), retries=0, publish=False)
+        delivered = Future()
+        delivered.set_result(None)
+        outbox = Mock(enqueue=Mock(return_value=delivered))
+        with patch('support.consumers.get_admin_chat_writer', return_value=writer), \
+                patch('support.consumers.get_outbox', return_value=outbox), \
+                self.assertLogs('support.writer', 'ERROR'):
+            communicator = await self.connect()
+            await communicator.receive_json_from()
+            await communicator.send_json_to({'message': 'Ответ администратора'})
+            events = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.disconnect()
+        echo = next(event for event in events if 'type' not in event)
+        failed = next(event for event in events if event.get('type') == 'save_failed')
+        # Страница уже показала сообщение: событие привязано к его client_id
+        self.assertEqual(failed['client_id'], echo['client_id'])
+        self.assertIn('database is locked', failed['error'])
+
+
+class RecordingWrites:
+    """
+    run_sync для ChatMessageWriter: запись в потоке теста (sync_to_async) и размеры пачек.
+    failures - сколько первых попыток записи падает временной ошибкой БД.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+
+    def __call__(self, func):
+        async def run(messages):
+            self.batches.append(len(messages))
+            if self.failures:
+                self.failures -= 1
+                raise OperationalError('database is locked')
+            return await sync_to_async(func)(messages)
+        return run
+
+
+class ChatWriterTestMixin:
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username='author', telegram_id=10, name='Пассажир')
+        cls.ticket = SupportTicket.objects.create(user=cls.author, message='Не приходит подтверждение')
+        cls.other_ticket = SupportTicket.objects.create(user=cls.author, message='Другой вопрос')
+
+    def setUp(self):
+        self.layer = InMemoryChannelLayer()
+        self.writes = RecordingWrites()
+
+    def writer(self, **kwargs):
+        writer = ChatMessageWriter(run_sync=self.writes, channel_layer=self.layer, **kwargs)
+        self.addCleanup(lambda: writer._task and writer._task.cancel())
+        return writer
+
+    async def subscribe(self, ticket):
+        channel = await self.layer.new_channel()
+        await self.layer.group_add(chat_group_name(ticket.id), channel)
+        return channel
+
+    async def receive(self, channel):
+        return await asyncio.wait_for(self.layer.receive(channel), 1)
+
+    async def saved(self):
+        return await sync_to_async(lambda: list(ChatMessage.objects.order_by('id').values_list('message', flat=True)))()
+
+
+class AdminChatWriterTests(ChatWriterTestMixin, TestCase):
+    """Запись сообщений администраторов (get_admin_chat_writer): пачки по времени, без рассылки."""
+
+    async def test_batches_are_limited_by_size(self):
+        writer = self.writer(batch_size=2, flush_interval=10, publish=False)
+        for n in range(5):
+            writer.submit(self.ticket.id, self.author, f'Сообщение {n}')
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.writes.batches, [2, 2])
+        await writer.flush()
+        self.assertEqual(self.writes.batches, [2, 2, 1])
+        self.assertEqual(await self.saved(), [f'Сообщение {n}' for n in range(5)])
+
+    async def test_batch_is_written_after_flush_interval(self):
+        writer = self.writer(flush_interval=0.05, publish=False)
+        writer.submit(self.ticket.id, self.author, 'Первое')
+        await asyncio.sleep(0.01)
+        writer.submit(self.ticket.id, self.author, 'Второе')
+        self.assertEqual(self.writes.batches, [])
+        # Без flush(): пачка уходит по истечении интервала
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.writes.batches, [2])
+        self.assertEqual(await self.saved(), ['Первое', 'Второе'])
+
+    async def test_exhausted_retries_are_reported(self):
+        self.writes.failures = 10
+        writer = self.writer(publish=False, retries=2, retry_delay=0)
+        channel = await self.subscribe(self.ticket)
+        writer.submit(self.ticket.id, self.author, 'С сайта', client_id='c1')
+        writer.submit(self.ticket.id, self.author, 'Без метки')
+        with self.assertLogs('support.writer', 'ERROR'):
+            await writer.flush()
+        self.assertEqual(self.writes.batches, [2, 2, 2])
+        event = await self.receive(channel)
+        self.assertEqual((event['type'], event['client_id']), ('save_failed', 'c1'))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.layer.receive(channel), 0.05)
+        self.assertEqual(await self.saved(), [])
+        # Потерянную пачку не дописывают при выходе процесса
+        self.assertEqual(writer._unsaved, {})
+
+    async def test_unsaved_messages_are_written_at_exit(self):
+        writer = self.writer(flush_interval=10, publish=False)
+        writer.submit(self.ticket.id, self.author, 'Первое')
+        writer.submit(self.ticket.id, self.author, 'Второе')
+        # Daphne отменяет задачи при остановке, запись дописывает atexit
+        writer._task.cancel()
+        await sync_to_async(writer.write_unsaved)()
+        self.assertEqual(await self.saved(), ['Первое', 'Второе'])
+        await sync_to_async(writer.write_unsaved)()
+        self.assertEqual(len(await self.saved()), 2)
+
+
+class BotChatWriterTests(ChatWriterTestMixin, TestCase):
+    """Запись сообщений из бота (get_chat_writer в runbot): пачки без ожидания и рассылка в группы chat_<id>."""
+
+    async def test_batches_are_limited_by_size(self):
+        writer = self.writer(batch_size=2)
+        channel = await self.subscribe(self.ticket)
+        for n in range(5):
+            writer.submit(self.ticket.id, self.author, f'Сообщение {n}')
+        await writer.flush()
+        self.assertEqual(self.writes.batches, [2, 2, 1])
+        events = [await self.receive(channel) for _ in range(5)]
+        self.assertEqual([event['message'] for event in events], [f'Сообщение {n}' for n in range(5)])
+
+    async def test_batch_is_written_after_flush_interval(self):
+        writer = self.writer(flush_interval=0.05)
+        channel = await self.subscribe(self.ticket)
+        writer.submit(self.ticket.id, self.author, 'Первое')
+        writer.submit(self.ticket.id, self.author, 'Второе')
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.writes.batches, [])
+        self.assertEqual(await self.receive(channel), {
+            'type': 'chat_message', 'message': 'Первое', 'sender': 'Пассажир',
+            'message_id': (await sync_to_async(ChatMessage.objects.get)(message='Первое')).id,
+        })
+        self.assertEqual(self.writes.batches, [2])
+
+    async def test_messages_fan_out_to_their_tickets(self):
+        writer = self.writer()
+        channels = {ticket.id: await self.subscribe(ticket) for ticket in (self.ticket, self.other_ticket)}
+        writer.submit(self.ticket.id, self.author, 'В первое')
+        writer.submit(self.other_ticket.id, self.author, 'Во второе')
+        await writer.flush()
+        self.assertEqual((await self.receive(channels[self.ticket.id]))['message'], 'В первое')
+        self.assertEqual((await self.receive(channels[self.other_ticket.id]))['message'], 'Во второе')
+        for channel in channels.values():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.layer.receive(channel), 0.05)
+
+    async def test_transient_error_is_retried(self):
+        self.writes.failures = 1
+        writer = self.writer(retry_delay=0)
+        channel = await self.subscribe(self.ticket)
+        writer.submit(self.ticket.id, self.author, 'После повтора')
+        with self.assertLogs('support.writer', 'WARNING'):
+            await writer.flush()
+        self.assertEqual(self.writes.batches, [1, 1])
+        self.assertEqual(await self.saved(), ['После повтора'])
+        # Рассылка одна: повтор записи не дублирует сообщение у администратора
+        self.assertEqual((await self.receive(channel))['message'], 'После повтора')
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.layer.receive(channel), 0.05)
@@ -0,0 +1,249 @@
+# support/writer.py
+
+import asyncio
+import atexit
+import logging
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+
+from .models import ChatMessage
+
+logger = logging.getLogger(__name__)
+
+
+def chat_group_name(ticket_id):
+    """Группа слоя каналов, на которую подписаны вкладки администраторов с этим обращением."""
+    return f'chat_{ticket_id}'
+
+
+def notify_ticket_updated(ticket_id):
+    """
+    Сообщает открытым вкладкам чата, что обращение изменилось: ChatConsumer
+    держит обращение в памяти на время соединения и перечитывает его по этому событию.
+    Вызывается из синхронного кода (админка); ошибка слоя каналов не мешает сохранению.
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(chat_group_name(ticket_id), {'type': 'ticket_updated'})
+    except Exception:
+        logger.exception(f"Не удалось оповестить чат об изменении обращения {ticket_id}")
+
+
+
+
+class ChatMessageWriter:
+    """
+    Сообщения чата поддержки: пишутся в БД пачками (bulk_create) в фоновой задаче,
+    отправитель не ждет ни БД, ни Redis.
+    flush_interval = 0 - пачка из того, что накопилось, пока писалась предыдущая:
+    одиночное сообщение уходит сразу, под нагрузкой запросов меньше, чем сообщений.
+    flush_interval > 0 - пачка копится до batch_size сообщений или flush_interval секунд.
+    publish - после записи разослать сообщения в группы chat_<id> (сообщения из бота);
+    сообщения администраторов ChatConsumer рассылает сам, не дожидаясь записи.
+    Временные ошибки БД (нет соединения, блокировка) повторяются retries раз с паузой.
+    Если записать не удалось, сообщения с client_id (отправленные с сайта) получают
+    в группу chat_<id> событие save_failed: страница уже показала их как отправленные.
+    """
+
+    def __init__(self, run_sync=database_sync_to_async, batch_size=None, channel_layer=None,
+                 flush_interval=0, publish=True, retries=None, retry_delay=0.2):
+        # run_sync превращает функцию ORM в корутину (в боте - db_async с его пулом потоков)
+        self.run_sync = run_sync
+        self.batch_size = batch_size or settings.SUPPORT_CHAT_BATCH_SIZE
+        self.channel_layer = channel_layer
+        self.flush_interval = flush_interval
+        self.publish = publish
+        self.retries = settings.SUPPORT_CHAT_WRITE_RETRIES if retries is None else retries
+        self.retry_delay = retry_delay
+        self._queue = None
+        self._task = None
+        # Принятые, но еще не записанные сообщения: их дописывает write_unsaved при выходе процесса
+        self._unsaved = {}
+        self._unsaved_lock = threading.Lock()
+
+    def _put(self, item):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._queue.put_nowait(item)
+
+    def submit(self, ticket_id, author, text, client_id=None):
+        """
+        Ставит сообщение в очередь; вызывается из цикла событий.
+        client_id - метка сообщения на странице администратора для события save_failed.
+        """
+        message = ChatMessage(ticket_id=ticket_id, author=author, message=text)
+        message.client_id = client_id
+        with self._unsaved_lock:
+            self._unsaved[id(message)] = message
+        self._put(message)
+
+    def _save_messages(self, messages):
+        # PostgreSQL и SQLite возвращают id из bulk_create: они нужны администраторам для статусов
+        saved = ChatMessage.objects.bulk_create(messages)
+        # Снимается в том же потоке БД, что и запись: при выходе процесса пачка не запишется дважды
+        self._forget(messages)
+        return saved
+
+    def _forget(self, messages):
+        with self._unsaved_lock:
+            for message in messages:
+                self._unsaved.pop(id(message), None)
+
+    def write_unsaved(self):
+        """
+        Синхронно дописывает сообщения, которые не успела записать фоновая задача.
+        Для выхода процесса (atexit): Daphne при остановке отменяет задачи приложения,
+        и disconnect ChatConsumer может не выполниться.
+        """
+        with self._unsaved_lock:
+            messages, self._unsaved = list(self._unsaved.values()), {}
+        if not messages:
+            return
+        try:
+            ChatMessage.objects.bulk_create(messages)
+            logger.info(f"При остановке дописаны сообщения чата поддержки: {len(messages)}")
+        except Exception:
+            logger.exception(f"Не удалось дописать сообщения чата поддержки при остановке: {len(messages)}")
+
+    async def flush(self):
+        """Ждет, пока будет записано все, что поставлено в очередь до вызова."""
+        if self._task is None:
+            return
+        # Метка в очереди: пачка перед ней записывается, затем метка срабатывает
+        done = asyncio.get_running_loop().create_future()
+        self._put(done)
+        await done
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        if not self.flush_interval:
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            return batch
+        deadline = asyncio.get_running_loop().time() + self.flush_interval
+        # Метка flush() или остановки не ждет конца интервала
+        while len(batch) < self.batch_size and isinstance(batch[-1], ChatMessage):
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            messages = [item for item in batch if isinstance(item, ChatMessage)]
+            if messages:
+                await self._write(messages)
+            for item in batch:
+                if isinstance(item, asyncio.Future) and not item.done():
+                    item.set_result(None)
+            # None в очереди - сигнал остановки от stop(), все до него уже записано
+            if None in batch:
+                return
+
+    async def _write(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                saved = await self.run_sync(self._save_messages)(batch)
+                break
+            except (OperationalError, InterfaceError) as e:
+                if attempt == self.retries:
+                    logger.exception(f"Не удалось сохранить сообщения чата поддержки: {len(batch)}, попыток {attempt + 1}")
+                    await self._report_failed(batch, e)
+                    return
+                logger.warning(f"Ошибка БД при записи сообщений чата поддержки, повтор {attempt + 1}", exc_info=True)
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+            except Exception as e:
+                # Ошибка данных (например, обращение удалено) при повторе не исчезнет
+                logger.exception(f"Не удалось сохранить сообщения чата поддержки: {len(batch)}")
+                await self._report_failed(batch, e)
+                return
+        if not self.publish:
+            return
+        layer = self.channel_layer or get_channel_layer()
+        # По одному group_send на сообщение и по порядку: у администратора сообщения не переставляются
+        for message in saved:
+            try:
+                await layer.group_send(chat_group_name(message.ticket_id), {
+                    'type': 'chat_message',
+                    'message': message.message,
+                    'sender': message.author.name,
+                    'message_id': message.id,
+                })
+            except Exception:
+                logger.exception(f"Не удалось отправить сообщение {message.id} в группу обращения {message.ticket_id}")
+
+    async def _report_failed(self, batch, error):
+        # Пачка потеряна: при выходе процесса дописывать ее уже не нужно
+        self._forget(batch)
+        layer = self.channel_layer or get_channel_layer()
+        for message in batch:
+            if message.client_id is None:
+                continue
+            try:
+                await layer.group_send(chat_group_name(message.ticket_id), {
+                    'type': 'save_failed',
+                    'client_id': message.client_id,
+                    'error': str(error),
+                })
+            except Exception:
+                logger.exception(f"Не удалось сообщить обращению {message.ticket_id} о несохраненном сообщении")
+
+    async def stop(self):
+        """Дописывает то, что осталось в очереди, и останавливает фоновую задачу."""
+        if self._task is None:
+            return
+        if not self._task.done():
+            self._queue.put_nowait(None)
+            await self._task
+        self._task = None
+        self._queue = None
+
+
+_writer = None
+
+
+def get_chat_writer():
+    global _writer
+    if _writer is None:
+        _writer = ChatMessageWriter()
+    return _writer
+
+
+def configure_chat_writer(**kwargs):
+    """Переопределяет параметры записи (например, run_sync бота) до первого сообщения."""
+    writer = get_chat_writer()
+    for name, value in kwargs.items():
+        if value is not None:
+            setattr(writer, name, value)
+    return writer
+
+
+async def stop_chat_writer():
+    if _writer is not None:
+        await _writer.stop()
+
+
+_admin_writer = None
+
+
+def get_admin_chat_writer():
+    """
+    Запись сообщений администраторов из ChatConsumer: одна на процесс Daphne,
+    поэтому пачка собирается из всех открытых чатов.
+    """
+    global _admin_writer
+    if _admin_writer is None:
+        _admin_writer = ChatMessageWriter(flush_interval=settings.SUPPORT_CHAT_FLUSH_MS / 1000, publish=False)
+        # Остаток очереди пишется при выходе процесса: цикл событий Daphne к этому моменту остановлен
+        atexit.register(_admin_writer.write_unsaved)
+    return _admin_writer
@@ -1,9 +1,20 @@
 from django.contrib import admin, messages
-from .models import Vehicle, Trip, Booking
+from .models import City, CityAlias, Vehicle, Trip, Booking
+
+class CityAliasInline(admin.TabularInline):
+    model = CityAlias
+    extra = 1
+
+@admin.register(City)
+class CityAdmin(admin.ModelAdmin):
+    list_display = ('name',)
+    search_fields = ('name', 'aliases__alias')
+    inlines = [CityAliasInline]
 
 @admin.register(Vehicle)
 class VehicleAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'driver')
+    list_select_related = ('driver',)
     search_fields = ('brand', 'model', 'license_plate', 'driver__name')
     list_filter = ('brand',)
 
@@ -13,6 +24,9 @@ class BookingInline(admin.TabularInline):
     readonly_fields = ('passenger', 'seats_booked', 'created_at')
     # Убираем возможность добавлять/изменять/удалять бронирования напрямую из поездки
     can_delete = False
+    def get_queryset(self, request):
+        # passenger выводится строкой в каждой строке инлайна
+        return super().get_queryset(request).select_related('passenger')
     def has_add_permission(self, request, obj=None):
         return False
     def has_change_permission(self, request, obj=None):
@@ -21,6 +35,7 @@ class BookingInline(admin.TabularInline):
 @admin.register(Trip)
 class TripAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'driver', 'status', 'departure_time', 'available_seats')
+    list_select_related = ('driver',)
     list_filter = ('status', 'departure_time', 'departure_location', 'destination_location')
     search_fields = ('departure_location', 'destination_location', 'driver__name', 'vehicle__license_plate')
     readonly_fields = ('created_at',)
@@ -48,4 +63,5 @@ class TripAdmin(admin.ModelAdmin):
 @admin.register(Booking)
 class BookingAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'trip', 'passenger', 'seats_booked', 'created_at')
+    list_select_related = ('trip', 'passenger')
     search_fields = ('trip__departure_location', 'passenger__name')
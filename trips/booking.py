@@ -0,0 +1,134 @@
+# trips/booking.py
+
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Trip, Booking, SeatHold
+
+
+def reserve_seats(trip_id, seats):
+    """
+    Списывает места одним условным UPDATE без блокировки строки на время брони.
+    Возвращает True, если мест хватило и поездка активна.
+    Отрицательное seats возвращает места в активную поездку.
+    """
+    updated = Trip.objects.filter(
+        id=trip_id, status=Trip.Status.ACTIVE, available_seats__gte=seats,
+    ).update(available_seats=F('available_seats') - seats)
+    return updated == 1
+
+
+def return_seats(seats_by_trip):
+    """Возвращает места в поездки: {trip_id: мест}."""
+    for trip_id, seats in seats_by_trip.items():
+        Trip.objects.filter(id=trip_id).update(available_seats=F('available_seats') + seats)
+
+
+# --- Удержание мест ---
+@transaction.atomic
+def create_hold(passenger, trip, seats=1, ttl=None):
+    """
+    Удерживает места на время ввода количества (SEAT_HOLD_TTL секунд).
+    Возвращает SeatHold или None, если мест уже нет.
+    """
+    if not reserve_seats(trip.id, seats):
+        return None
+    ttl = ttl if ttl is not None else settings.SEAT_HOLD_TTL
+    return SeatHold.objects.create(
+        trip=trip, passenger=passenger, seats=seats, expires_at=timezone.now() + timedelta(seconds=ttl),
+    )
+
+
+def take_hold(hold_id, passenger, trip_id):
+    """
+    Забирает удержание (удаляет запись) и возвращает число удержанных мест.
+    0 - удержание уже снято очисткой, использовано или относится к другой поездке.
+    """
+    hold = SeatHold.objects.filter(id=hold_id, passenger=passenger, trip_id=trip_id).only('seats').first()
+    if hold is None:
+        return 0
+    deleted, _ = SeatHold.objects.filter(id=hold.id).delete()
+    return hold.seats if deleted else 0
+
+
+@transaction.atomic
+def release_hold(hold_id, passenger):
+    """Досрочно снимает удержание и возвращает места в поездку."""
+    hold = SeatHold.objects.filter(id=hold_id, passenger=passenger).only('trip_id', 'seats').first()
+    if hold and SeatHold.objects.filter(id=hold.id).delete()[0]:
+        return_seats({hold.trip_id: hold.seats})
+
+
+def release_expired_holds(batch_size=500):
+    """
+    Возвращает места из просроченных удержаний. Читает только записи
+    с expires_at <= сейчас (по индексу), пачками по batch_size.
+    Возвращает число снятых удержаний.
+    """
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(
+                SeatHold.objects.select_for_update()
+                .filter(expires_at__lte=timezone.now())
+                .order_by('expires_at')
+                .values_list('id', 'trip_id', 'seats')[:batch_size]
+            )
+            if not holds:
+                return released
+            SeatHold.objects.filter(id__in=[hold_id for hold_id, _, _ in holds]).delete()
+            seats_by_trip = Counter()
+            for _, trip_id, seats in holds:
+                seats_by_trip[trip_id] += seats
+            return_seats(seats_by_trip)
+        released += len(holds)
+        if len(holds) < batch_size:
+            return released
+
+
+@transaction.atomic
+def set_available_seats(trip_id, seats):
+    """
+    Водитель задает число свободных мест. Удержанные места уже вычтены из
+    available_seats и вернутся в поездку, когда удержания истекут, поэтому
+    записывается seats минус удержанное. Если водитель оставил мест меньше,
+    чем удержано, удержания снимаются: пассажиры бронируют на общих основаниях.
+    Возвращает False, если поездки нет.
+    """
+    holds = SeatHold.objects.filter(trip_id=trip_id)
+    # Блокировки в том же порядке, что у очистки и брони: удержания, затем поездка.
+    # Новое удержание требует строки поездки, поэтому сумма ниже точна
+    list(holds.select_for_update().values_list('id', flat=True))
+    if not Trip.objects.select_for_update().filter(id=trip_id).exists():
+        return False
+    held = holds.aggregate(total=Sum('seats'))['total'] or 0
+    if held > seats:
+        holds.delete()
+        held = 0
+    Trip.objects.filter(id=trip_id).update(available_seats=seats - held)
+    return True
+
+
+# --- Бронирование ---
+@transaction.atomic
+def book_seats(passenger, trip, seats, hold_id=None):
+    """
+    Бронирует места: (booking, None) при успехе или (None, ошибка).
+    Ошибка "booking_unavailable" - поездка не активна или удалена.
+    Если есть удержание, его места засчитываются в бронь; удержание одноразовое.
+    """
+    held = take_hold(hold_id, passenger, trip.id) if hold_id else 0
+    if reserve_seats(trip.id, seats - held):
+        return Booking.objects.create(passenger=passenger, trip=trip, seats_booked=seats), None
+    if held:
+        return_seats({trip.id: held})
+    # Места не списались: перечитываем поездку только чтобы объяснить причину
+    current = Trip.objects.filter(id=trip.id).values('status', 'available_seats').first()
+    if current is None or current['status'] != Trip.Status.ACTIVE:
+        return None, "booking_unavailable"
+    return None, f"Недостаточно мест. Осталось только {current['available_seats']}."
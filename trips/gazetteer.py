@@ -0,0 +1,46 @@
+# trips/gazetteer.py
+
+import threading
+import time
+
+from django.conf import settings
+
+from .locations import CityMatcher
+from .models import City, CityAlias
+
+_lock = threading.Lock()
+_matcher = None
+_loaded_at = 0.0
+
+
+def load_city_matcher():
+    """Строит сопоставитель по всем названиям и вариантам написания из БД."""
+    return CityMatcher(
+        City.objects.values_list('id', 'name'),
+        CityAlias.objects.values_list('city_id', 'alias'),
+    )
+
+
+def get_city_matcher():
+    """
+    Сопоставитель, загруженный в память процесса. Перечитывается из БД
+    раз в GAZETTEER_RELOAD_SECONDS, чтобы подхватывать новые города.
+    """
+    global _matcher, _loaded_at
+    reload_seconds = getattr(settings, 'GAZETTEER_RELOAD_SECONDS', 600)
+    with _lock:
+        if _matcher is None or time.monotonic() - _loaded_at > reload_seconds:
+            _matcher = load_city_matcher()
+            _loaded_at = time.monotonic()
+        return _matcher
+
+
+def reset_city_matcher():
+    global _matcher
+    with _lock:
+        _matcher = None
+
+
+def resolve_city(value):
+    """Возвращает ID города по пользовательскому вводу или None."""
+    return get_city_matcher().resolve(value)
@@ -0,0 +1,118 @@
+# trips/locations.py
+
+import re
+from bisect import bisect_left
+
+# "г. Сочи", "г.Сочи", "город Сочи" -> "сочи"
+_CITY_PREFIX_RE = re.compile(r'^(?:г\.\s*|г\s+|город\s+)')
+
+
+def normalize_location(value):
+    """
+    Приводит название населенного пункта к виду, по которому идет поиск:
+    нижний регистр, ё -> е, без лишних пробелов и префикса "г.".
+    """
+    if not value:
+        return ''
+    value = ' '.join(value.lower().replace('ё', 'е').split())
+    return _CITY_PREFIX_RE.sub('', value).strip()
+
+
+# Транслитерация кириллицы (ru/uz/tj) в латиницу: "Сочи", "Sochi" и "сочи"
+# сводятся к одному ключу поиска.
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    # Узбекская и таджикская кириллица
+    'ў': 'o', 'қ': 'q', 'ғ': 'g', 'ҳ': 'h', 'ӣ': 'i', 'ӯ': 'u', 'ҷ': 'j',
+    # Узбекская латиница: o', g' (разные варианты апострофа)
+    "'": '', 'ʻ': '', 'ʼ': '', '`': '', '’': '',
+    '-': ' ',
+})
+
+
+def search_key(value):
+    """Ключ для сопоставления со справочником городов: нормализация + латиница."""
+    return ' '.join(normalize_location(value).translate(_TRANSLIT).split())
+
+
+def _within_distance(a, b, limit):
+    """Проверяет, что расстояние Левенштейна между a и b не больше limit."""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+class CityMatcher:
+    """
+    Сопоставляет пользовательский ввод с ID города.
+    Точное совпадение - поиск в словаре, затем однозначный префикс
+    по отсортированному массиву ключей (bisect), затем опечатки.
+    Префикс и опечатки считаются по официальным названиям; варианты написания
+    ("Ростов", "Питер") совпадают только целыми словами, иначе "Ростовка"
+    или "Ростов Великий" уходили бы в Ростов-на-Дону.
+    """
+
+    def __init__(self, names, aliases=()):
+        # names, aliases: итерируемые (city_id, название или вариант написания)
+        self._exact = {}
+        self._names = set()
+        for city_id, name in names:
+            key = search_key(name)
+            if key:
+                self._exact.setdefault(key, city_id)
+                self._names.add(key)
+        for city_id, alias in aliases:
+            key = search_key(alias)
+            if key:
+                self._exact.setdefault(key, city_id)
+        self._keys = sorted(self._exact)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def resolve(self, value):
+        key = search_key(value)
+        if not key:
+            return None
+        city_id = self._exact.get(key)
+        if city_id is not None:
+            return city_id
+        return self._resolve_prefix(key) or self._resolve_fuzzy(key)
+
+    def _resolve_prefix(self, key):
+        if len(key) < 3:
+            return None
+        found = set()
+        index = bisect_left(self._keys, key)
+        while index < len(self._keys) and self._keys[index].startswith(key):
+            candidate = self._keys[index]
+            index += 1
+            # Вариант написания - только если ввод заканчивается на границе слова
+            if candidate not in self._names and candidate[len(key)] != ' ':
+                continue
+            found.add(self._exact[candidate])
+            if len(found) > 1:
+                return None
+        return found.pop() if found else None
+
+    def _resolve_fuzzy(self, key):
+        if len(key) < 4:
+            return None
+        limit = 1 if len(key) <= 6 else 2
+        found = {self._exact[k] for k in self._names if _within_distance(key, k, limit)}
+        return found.pop() if len(found) == 1 else None
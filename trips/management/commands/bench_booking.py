@@ -0,0 +1,96 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from users.bench_db import bench_database
+from users.models import User
+from trips.booking import book_seats
+from trips.models import Vehicle, Trip, Booking
+
+
+@transaction.atomic
+def legacy_book_seats(passenger, trip, seats):
+    """Прежний вариант: блокировка строки поездки на время всей брони."""
+    trip_for_update = Trip.objects.select_for_update().get(id=trip.id)
+    if trip_for_update.status != Trip.Status.ACTIVE:
+        return None, "booking_unavailable"
+    if trip_for_update.available_seats < seats:
+        return None, f"Недостаточно мест. Осталось только {trip_for_update.available_seats}."
+    trip_for_update.available_seats -= seats
+    trip_for_update.save()
+    return Booking.objects.create(passenger=passenger, trip=trip_for_update, seats_booked=seats), None
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест бронирования: N потоков одновременно бронируют места в одной поездке. '
+        'Сравнивает блокировку строки (select_for_update) и условный UPDATE. Данные создаются в отдельной тестовой БД.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookers', type=int, default=200)
+        parser.add_argument('--seats', type=int, default=150, help='Мест в поездке (меньше, чем желающих)')
+        parser.add_argument('--seats-per-booking', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"БД: {connection.vendor}")
+        with bench_database(self.stdout):
+            driver = User.objects.create(username='bench_booking_driver', name='Bench')
+            vehicle = Vehicle.objects.create(driver=driver, brand='Bench', model='Car', license_plate='BENCH-BOOKING')
+            User.objects.bulk_create([
+                User(username=f'bench_booker_{i}', name=f'Booker {i}') for i in range(options['bookers'])
+            ])
+            passengers = list(User.objects.filter(username__startswith='bench_booker_'))
+            for name, func in [('select_for_update', legacy_book_seats), ('условный UPDATE', book_seats)]:
+                trip = Trip.objects.create(
+                    driver=driver, vehicle=vehicle, departure_location='Bench', destination_location='Bench',
+                    departure_time=timezone.now() + timedelta(days=1), available_seats=options['seats'], price=1,
+                )
+                self.run(name, func, trip, passengers, options)
+
+    def run(self, name, func, trip, passengers, options):
+        seats = options['seats_per_booking']
+        start = threading.Barrier(len(passengers))
+        timings = []
+        outcomes = {'booked': 0, 'rejected': 0, 'errors': 0}
+        lock = threading.Lock()
+
+        def book(passenger):
+            try:
+                start.wait()
+                started = time.perf_counter()
+                try:
+                    booking, error = func(passenger, trip, seats)
+                    outcome = 'booked' if booking else 'rejected'
+                except Exception:
+                    # Например, "database is locked" на SQLite или таймаут блокировки
+                    outcome = 'errors'
+                with lock:
+                    outcomes[outcome] += 1
+                    timings.append((time.perf_counter() - started) * 1000)
+            finally:
+                # У каждого потока свое соединение
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(passengers)) as executor:
+            list(executor.map(book, passengers))
+        elapsed = time.perf_counter() - started
+
+        trip.refresh_from_db()
+        booked_seats = Booking.objects.filter(trip=trip).aggregate(total=Sum('seats_booked'))['total'] or 0
+        consistent = booked_seats + trip.available_seats == options['seats']
+        timings.sort()
+        self.stdout.write(
+            f"{name:>18}: {len(passengers) / elapsed:.0f} броней/с, p50 {statistics.median(timings):.1f} мс, "
+            f"p99 {timings[int(len(timings) * 0.99) - 1]:.1f} мс | успешно {outcomes['booked']}, "
+            f"отказ {outcomes['rejected']}, ошибок {outcomes['errors']} | осталось мест {trip.available_seats}, "
+            f"{'сходится' if consistent else 'РАСХОЖДЕНИЕ'}"
+        )
@@ -0,0 +1,93 @@
+import random
+import statistics
+import time as time_module
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from users.models import User
+from trips.locations import normalize_location
+from trips.models import Vehicle, Trip
+from trips.search import search_trips
+
+CITIES = [
+    "Москва", "Санкт-Петербург", "Краснодар", "Сочи", "Ростов-на-Дону", "Казань",
+    "Самара", "Воронеж", "Волгоград", "Ставрополь", "Новороссийск", "Анапа",
+    "Екатеринбург", "Нижний Новгород", "Уфа", "Пермь", "Саратов", "Тула",
+]
+BATCH_SIZE = 5000
+DAYS_AHEAD = 60
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время поиска поездок на 10k/100k/1M записей (данные откатываются после замера).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--queries', type=int, default=200, help='Количество поисковых запросов на каждый размер')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"БД: {connection.vendor}")
+        try:
+            with transaction.atomic():
+                self.run(sorted(options['sizes']), options['queries'])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def run(self, sizes, queries):
+        driver = User.objects.create(username='bench_search_driver', name='Bench')
+        vehicle = Vehicle.objects.create(driver=driver, brand='Bench', model='Car', license_plate='BENCH-SEARCH')
+        now = timezone.now()
+        rng = random.Random(42)
+        created = 0
+
+        self.stdout.write(f"{'поездок':>10} | {'icontains p50':>14} | {'icontains p95':>14} | {'индекс p50':>11} | {'индекс p95':>11}")
+        for size in sizes:
+            while created < size:
+                count = min(BATCH_SIZE, size - created)
+                Trip.objects.bulk_create([self.make_trip(rng, driver, vehicle, now) for _ in range(count)])
+                created += count
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE trips_trip')
+
+            params = [
+                (rng.choice(CITIES), rng.choice(CITIES), (now + timedelta(days=rng.randrange(DAYS_AHEAD))).date())
+                for _ in range(queries)
+            ]
+            legacy = self.measure(lambda p: list(Trip.objects.filter(
+                departure_location__icontains=p[0], destination_location__icontains=p[1],
+                departure_time__date=p[2], departure_time__gte=timezone.now(), status=Trip.Status.ACTIVE,
+            )), params)
+            indexed = self.measure(lambda p: list(search_trips(*p)), params)
+            self.stdout.write(
+                f"{size:>10} | {legacy[0]:>11.2f} мс | {legacy[1]:>11.2f} мс | {indexed[0]:>8.2f} мс | {indexed[1]:>8.2f} мс"
+            )
+
+    def make_trip(self, rng, driver, vehicle, now):
+        departure, destination = rng.sample(CITIES, 2)
+        return Trip(
+            driver=driver, vehicle=vehicle,
+            departure_location=departure, destination_location=destination,
+            departure_normalized=normalize_location(departure),
+            destination_normalized=normalize_location(destination),
+            departure_time=now + timedelta(minutes=rng.randrange(DAYS_AHEAD * 24 * 60)),
+            available_seats=rng.randint(1, 4), price=rng.randint(500, 5000),
+            status=rng.choice([Trip.Status.ACTIVE, Trip.Status.ACTIVE, Trip.Status.COMPLETED, Trip.Status.CANCELED]),
+        )
+
+    def measure(self, func, params):
+        timings = []
+        for p in params:
+            started = time_module.perf_counter()
+            func(p)
+            timings.append((time_module.perf_counter() - started) * 1000)
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
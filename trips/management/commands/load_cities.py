@@ -0,0 +1,57 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from trips.gazetteer import load_city_matcher, reset_city_matcher
+from trips.locations import search_key
+from trips.models import City, CityAlias, Trip
+
+DEFAULT_CITIES_FILE = Path(__file__).resolve().parents[2] / 'data' / 'cities.json'
+
+
+class Command(BaseCommand):
+    help = 'Загружает справочник городов и проставляет города в поездках без них.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=str(DEFAULT_CITIES_FILE), help='JSON-файл: [{"name": ..., "aliases": [...]}]')
+        parser.add_argument('--skip-backfill', action='store_true', help='Не обновлять существующие поездки')
+
+    def handle(self, *args, **options):
+        with open(options['file'], encoding='utf-8') as f:
+            cities = json.load(f)
+
+        created_aliases = 0
+        with transaction.atomic():
+            known_keys = set(CityAlias.objects.values_list('key', flat=True))
+            for entry in cities:
+                city, _ = City.objects.get_or_create(name=entry['name'])
+                for alias in [entry['name'], *entry.get('aliases', [])]:
+                    key = search_key(alias)
+                    if key in known_keys:
+                        continue
+                    CityAlias.objects.create(city=city, alias=alias)
+                    known_keys.add(key)
+                    created_aliases += 1
+        reset_city_matcher()
+        self.stdout.write(f"Городов в справочнике: {City.objects.count()}, новых вариантов названий: {created_aliases}")
+
+        if not options['skip_backfill']:
+            self.stdout.write(f"Поездок с проставленными городами: {self.backfill_trips()}")
+
+    def backfill_trips(self):
+        matcher = load_city_matcher()
+        trips = Trip.objects.filter(departure_city__isnull=True) | Trip.objects.filter(destination_city__isnull=True)
+        batch = []
+        updated = 0
+        for trip in trips.only('id', 'departure_location', 'destination_location').iterator(chunk_size=2000):
+            trip.departure_city_id = matcher.resolve(trip.departure_location)
+            trip.destination_city_id = matcher.resolve(trip.destination_location)
+            batch.append(trip)
+            if len(batch) >= 2000:
+                updated += Trip.objects.bulk_update(batch, ['departure_city', 'destination_city'])
+                batch = []
+        if batch:
+            updated += Trip.objects.bulk_update(batch, ['departure_city', 'destination_city'])
+        return updated
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from trips.booking import release_expired_holds
+
+
+class Command(BaseCommand):
+    help = 'Возвращает в поездки места из просроченных удержаний (для cron, если бот не запущен).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        released = release_expired_holds(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Снято удержаний: {released}"))
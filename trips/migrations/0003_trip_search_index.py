@@ -0,0 +1,91 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:19
+
+import logging
+import re
+
+from django.conf import settings
+from django.db import migrations, models, transaction
+
+logger = logging.getLogger(__name__)
+
+# Копия trips.locations.normalize_location на момент миграции: миграция не зависит
+# от того, как код приложения будет нормализовать названия позже
+_CITY_PREFIX_RE = re.compile(r'^(?:г\.\s*|г\s+|город\s+)')
+
+
+def normalize_location(value):
+    if not value:
+        return ''
+    value = ' '.join(value.lower().replace('ё', 'е').split())
+    return _CITY_PREFIX_RE.sub('', value).strip()
+
+
+TRIGRAM_INDEXES = {
+    'trip_departure_trgm_idx': 'departure_normalized',
+    'trip_destination_trgm_idx': 'destination_normalized',
+}
+
+
+def fill_normalized_locations(apps, schema_editor):
+    Trip = apps.get_model('trips', 'Trip')
+    batch = []
+    for trip in Trip.objects.only('id', 'departure_location', 'destination_location').iterator(chunk_size=2000):
+        trip.departure_normalized = normalize_location(trip.departure_location)
+        trip.destination_normalized = normalize_location(trip.destination_location)
+        batch.append(trip)
+        if len(batch) >= 2000:
+            Trip.objects.bulk_update(batch, ['departure_normalized', 'destination_normalized'])
+            batch = []
+    if batch:
+        Trip.objects.bulk_update(batch, ['departure_normalized', 'destination_normalized'])
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # Триграммные индексы есть только в PostgreSQL; на SQLite поиск
+    # сужается составным индексом (status, departure_time).
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except Exception as e:
+        logger.warning(f"pg_trgm недоступен, триграммные индексы не созданы: {e}")
+        return
+    for name, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON trips_trip USING gin ({column} gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0002_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='departure_normalized',
+            field=models.CharField(default='', editable=False, max_length=100, verbose_name='Место отправления (поиск)'),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='destination_normalized',
+            field=models.CharField(default='', editable=False, max_length=100, verbose_name='Место назначения (поиск)'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'departure_time'], name='trip_status_departure_idx'),
+        ),
+        migrations.RunPython(fill_normalized_locations, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
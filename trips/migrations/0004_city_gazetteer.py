@@ -0,0 +1,59 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0003_trip_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='Название')),
+            ],
+            options={
+                'verbose_name': 'Город',
+                'verbose_name_plural': 'Города',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CityAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(max_length=100, verbose_name='Вариант написания')),
+                ('key', models.CharField(editable=False, max_length=100, unique=True, verbose_name='Ключ поиска')),
+            ],
+            options={
+                'verbose_name': 'Вариант названия города',
+                'verbose_name_plural': 'Варианты названий городов',
+            },
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='departure_city',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='departing_trips', to='trips.city', verbose_name='Город отправления'),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='destination_city',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='arriving_trips', to='trips.city', verbose_name='Город назначения'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['departure_city', 'destination_city', 'departure_time'], name='trip_route_departure_idx'),
+        ),
+        migrations.AddField(
+            model_name='cityalias',
+            name='city',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='trips.city', verbose_name='Город'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0004_city_gazetteer'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='trip',
+            constraint=models.CheckConstraint(condition=models.Q(('available_seats__gte', 0)), name='trip_available_seats_non_negative'),
+        ),
+    ]
@@ -0,0 +1,99 @@
+import re
+
+from django.db import migrations
+
+# Справочник на момент миграции (копия trips/data/cities.json): файл и код приложения
+# могут меняться, а миграция должна давать тот же результат. Дальнейшие обновления
+# справочника - командой load_cities.
+CITIES = [
+    ("Москва", ["Moskva", "Moscow", "Маскав", "Moskva shahri"]),
+    ("Санкт-Петербург", ["Питер", "СПб", "Петербург", "Saint Petersburg", "Sankt-Peterburg"]),
+    ("Краснодар", ["Krasnodar"]),
+    ("Сочи", ["Sochi", "Адлер"]),
+    ("Ростов-на-Дону", ["Ростов", "Rostov", "Rostov-on-Don"]),
+    ("Новороссийск", ["Novorossiysk"]),
+    ("Анапа", ["Anapa"]),
+    ("Ставрополь", ["Stavropol"]),
+    ("Волгоград", ["Volgograd"]),
+    ("Воронеж", ["Voronezh"]),
+    ("Казань", ["Kazan", "Qozon"]),
+    ("Самара", ["Samara"]),
+    ("Екатеринбург", ["Екб", "Yekaterinburg"]),
+    ("Нижний Новгород", ["Нижний", "Nizhny Novgorod"]),
+    ("Ташкент", ["Тошкент", "Toshkent", "Tashkent", "Тошканд"]),
+    ("Самарканд", ["Самарқанд", "Samarqand", "Samarkand"]),
+    ("Бухара", ["Бухоро", "Buxoro", "Bukhara"]),
+    ("Андижан", ["Андижон", "Andijon", "Andijan"]),
+    ("Фергана", ["Фарғона", "Farg'ona", "Fergana"]),
+    ("Наманган", ["Namangan"]),
+    ("Душанбе", ["Dushanbe"]),
+    ("Худжанд", ["Хуҷанд", "Хужанд", "Khujand", "Xo'jand"]),
+    ("Бохтар", ["Курган-Тюбе", "Bokhtar"]),
+    ("Куляб", ["Кӯлоб", "Кулоб", "Kulob", "Kulyab"]),
+    ("Истаравшан", ["Istaravshan"]),
+]
+
+# Копия trips.locations.search_key на момент миграции
+_CITY_PREFIX_RE = re.compile(r'^(?:г\.\s*|г\s+|город\s+)')
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p',
+    'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch',
+    'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+    'ў': 'o', 'қ': 'q', 'ғ': 'g', 'ҳ': 'h', 'ӣ': 'i', 'ӯ': 'u', 'ҷ': 'j',
+    "'": '', 'ʻ': '', 'ʼ': '', '`': '', '’': '',
+    '-': ' ',
+})
+
+
+def search_key(value):
+    if not value:
+        return ''
+    value = ' '.join(value.lower().replace('ё', 'е').split())
+    value = _CITY_PREFIX_RE.sub('', value).strip()
+    return ' '.join(value.translate(_TRANSLIT).split())
+
+
+def seed_cities(apps, schema_editor):
+    """
+    Справочник городов и города в уже созданных поездках. Поездки сопоставляются
+    только по точному ключу; с префиксом и опечатками их допишет load_cities.
+    """
+    City = apps.get_model('trips', 'City')
+    CityAlias = apps.get_model('trips', 'CityAlias')
+    Trip = apps.get_model('trips', 'Trip')
+
+    known_keys = set(CityAlias.objects.values_list('key', flat=True))
+    for name, aliases in CITIES:
+        city, _ = City.objects.get_or_create(name=name)
+        for alias in [name, *aliases]:
+            # В исторической модели нет save() с вычислением ключа
+            key = search_key(alias)
+            if key in known_keys:
+                continue
+            CityAlias.objects.create(city=city, alias=alias, key=key)
+            known_keys.add(key)
+
+    city_ids = dict(CityAlias.objects.values_list('key', 'city_id'))
+    trips = Trip.objects.filter(departure_city__isnull=True) | Trip.objects.filter(destination_city__isnull=True)
+    batch = []
+    for trip in trips.only('id', 'departure_location', 'destination_location').iterator(chunk_size=2000):
+        trip.departure_city_id = city_ids.get(search_key(trip.departure_location))
+        trip.destination_city_id = city_ids.get(search_key(trip.destination_location))
+        batch.append(trip)
+        if len(batch) >= 2000:
+            Trip.objects.bulk_update(batch, ['departure_city', 'destination_city'])
+            batch = []
+    if batch:
+        Trip.objects.bulk_update(batch, ['departure_city', 'destination_city'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0007_trip_driver_status_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_cities, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-18 01:34
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0008_seed_cities'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='trip',
+            name='trip_available_seats_non_negative',
+        ),
+    ]
@@ -2,6 +2,8 @@ from django.db import models
 from django.conf import settings
 from django.core.validators import MinValueValidator, MaxValueValidator
 
+from .locations import normalize_location, search_key
+
 class Vehicle(models.Model):
     driver = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -21,6 +23,34 @@ class Vehicle(models.Model):
         verbose_name = 'Автомобиль'
         verbose_name_plural = 'Автомобили'
 
+class City(models.Model):
+    name = models.CharField('Название', max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = 'Город'
+        verbose_name_plural = 'Города'
+        ordering = ['name']
+
+class CityAlias(models.Model):
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='aliases', verbose_name='Город')
+    alias = models.CharField('Вариант написания', max_length=100)
+    # Ключ поиска (нормализация + транслитерация), заполняется в save()
+    key = models.CharField('Ключ поиска', max_length=100, unique=True, editable=False)
+
+    def __str__(self):
+        return self.alias
+
+    def save(self, *args, **kwargs):
+        self.key = search_key(self.alias)
+        super().save(*args, **kwargs)
+
+    class Meta:
+        verbose_name = 'Вариант названия города'
+        verbose_name_plural = 'Варианты названий городов'
+
 class Trip(models.Model):
     class Status(models.TextChoices):
         ACTIVE = 'ACTIVE', 'Активна'
@@ -36,7 +66,20 @@ class Trip(models.Model):
     vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE, related_name='trips', verbose_name='Автомобиль')
     departure_location = models.CharField('Место отправления', max_length=100)
     destination_location = models.CharField('Место назначения', max_length=100)
+    # Нормализованные копии для поиска, заполняются в save()
+    departure_normalized = models.CharField('Место отправления (поиск)', max_length=100, default='', editable=False)
+    destination_normalized = models.CharField('Место назначения (поиск)', max_length=100, default='', editable=False)
+    departure_city = models.ForeignKey(
+        City, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='departing_trips', verbose_name='Город отправления'
+    )
+    destination_city = models.ForeignKey(
+        City, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='arriving_trips', verbose_name='Город назначения'
+    )
     departure_time = models.DateTimeField('Время отправления')
+    # PositiveSmallIntegerField создает в БД CHECK (available_seats >= 0) -
+    # последний рубеж для условного списания мест в trips/booking.py
     available_seats = models.PositiveSmallIntegerField('Свободные места')
     price = models.DecimalField('Цена за место', max_digits=8, decimal_places=2)
     created_at = models.DateTimeField('Дата создания', auto_now_add=True)
@@ -50,10 +93,47 @@ class Trip(models.Model):
     def __str__(self):
         return f"{self.departure_location} - {self.destination_location} ({self.departure_time.strftime('%d.%m.%Y')})"
 
+    def save(self, *args, **kwargs):
+        self.departure_normalized = normalize_location(self.departure_location)
+        self.destination_normalized = normalize_location(self.destination_location)
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = 'Поездка'
         verbose_name_plural = 'Поездки'
         ordering = ['-departure_time']
+        indexes = [
+            # Поиск всегда идет по активным поездкам в диапазоне времени
+            models.Index(fields=['status', 'departure_time'], name='trip_status_departure_idx'),
+            models.Index(fields=['departure_city', 'destination_city', 'departure_time'], name='trip_route_departure_idx'),
+            # Списки водителя по страницам: фильтр по статусу и курсор по времени
+            models.Index(fields=['driver', 'status', 'departure_time'], name='trip_driver_status_idx'),
+        ]
+
+class SeatHold(models.Model):
+    """
+    Места, временно снятые с продажи, пока пассажир вводит количество мест.
+    Места уже вычтены из Trip.available_seats; просроченные удержания
+    возвращает release_expired_holds (trips/booking.py).
+    """
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE, related_name='seat_holds', verbose_name='Поездка')
+    passenger = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='seat_holds',
+        verbose_name='Пассажир'
+    )
+    seats = models.PositiveSmallIntegerField('Удержано мест')
+    # Индекс: очистка читает только просроченные записи, без полного просмотра
+    expires_at = models.DateTimeField('Действует до', db_index=True)
+    created_at = models.DateTimeField('Создано', auto_now_add=True)
+
+    def __str__(self):
+        return f"Удержание {self.seats} мест в {self.trip} для {self.passenger}"
+
+    class Meta:
+        verbose_name = 'Удержание мест'
+        verbose_name_plural = 'Удержания мест'
 
 class Booking(models.Model):
     passenger = models.ForeignKey(
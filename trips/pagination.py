@@ -0,0 +1,87 @@
+# trips/pagination.py
+
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db.models import Q
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+NEXT = 'n'
+PREV = 'p'
+
+# Тип значения, число и id: курсор приходит от клиента, поэтому разбирается только такой вид
+_CURSOR_RE = re.compile(r'([tdf])(-?[0-9][0-9.eE+-]*)_([0-9]+)')
+
+
+def encode_cursor(value, pk):
+    """
+    Курсор (значение поля сортировки, id) в компактной строке для callback_data
+    (лимит Telegram - 64 байта). Первая буква - тип значения: t - время, d - Decimal, f - float.
+    """
+    if isinstance(value, datetime):
+        token = f"t{(value - EPOCH) // timedelta(microseconds=1)}"
+    elif isinstance(value, Decimal):
+        token = f"d{value}"
+    else:
+        token = f"f{float(value)!r}"
+    return f"{token}_{pk}"
+
+
+def decode_cursor(cursor, kinds='tdf'):
+    """
+    Обратное к encode_cursor. kinds - допустимые типы значения (для поля времени - 't').
+    ValueError, если строка не курсор или тип значения не подходит.
+    """
+    match = _CURSOR_RE.fullmatch(cursor) if isinstance(cursor, str) else None
+    if match is None or match[1] not in kinds:
+        raise ValueError(f"Некорректный курсор: {cursor!r}")
+    kind, raw, pk = match.groups()
+    try:
+        if kind == 't':
+            value = EPOCH + timedelta(microseconds=int(raw))
+        elif kind == 'd':
+            value = Decimal(raw)
+        else:
+            value = float(raw)
+    except (ValueError, ArithmeticError) as e:
+        raise ValueError(f"Некорректный курсор: {cursor!r}") from e
+    return value, int(pk)
+
+
+def keyset_page(queryset, field, page_size, cursor=None, direction=NEXT, descending=True):
+    """
+    Страница записей, упорядоченных по (field, id), без OFFSET: следующая
+    страница начинается после последней записи текущей, предыдущая - перед первой.
+    Возвращает (записи, есть_предыдущая, есть_следующая, курсор_первой, курсор_последней).
+    """
+    forward = [f'-{field}', '-id'] if descending else [field, 'id']
+    backward = [field, 'id'] if descending else [f'-{field}', '-id']
+    if cursor is None:
+        rows = list(queryset.order_by(*forward)[:page_size + 1])
+        has_prev, has_next = False, len(rows) > page_size
+        rows = rows[:page_size]
+    else:
+        value, pk = decode_cursor(cursor)
+        after = '__lt' if descending else '__gt'
+        before = '__gt' if descending else '__lt'
+        if direction == NEXT:
+            condition = Q(**{f'{field}{after}': value}) | Q(**{field: value, f'id{after}': pk})
+            rows = list(queryset.filter(condition).order_by(*forward)[:page_size + 1])
+            has_prev, has_next = True, len(rows) > page_size
+            rows = rows[:page_size]
+        else:
+            condition = Q(**{f'{field}{before}': value}) | Q(**{field: value, f'id{before}': pk})
+            rows = list(queryset.filter(condition).order_by(*backward)[:page_size + 1])
+            has_prev, has_next = len(rows) > page_size, True
+            rows = rows[:page_size][::-1]
+
+    def row_cursor(row):
+        value = row
+        for part in field.split('__'):
+            value = getattr(value, part)
+        return encode_cursor(value, row.id)
+
+    first = row_cursor(rows[0]) if rows else None
+    last = row_cursor(rows[-1]) if rows else None
+    return rows, has_prev, has_next, first, last
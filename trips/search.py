@@ -0,0 +1,68 @@
+# trips/search.py
+
+from datetime import datetime, time, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .gazetteer import resolve_city
+from .locations import normalize_location
+from .models import Trip
+from .pagination import keyset_page, NEXT
+
+
+def day_bounds(search_date):
+    """
+    Границы суток [начало, конец) в текущем часовом поясе.
+    В отличие от departure_time__date, диапазон использует индекс по времени.
+    """
+    start = timezone.make_aware(datetime.combine(search_date, time.min), timezone.get_current_timezone())
+    return start, start + timedelta(days=1)
+
+
+def search_trips(departure, destination, search_date):
+    """
+    Активные будущие поездки на дату. Город, найденный в справочнике,
+    сравнивается по ID (индекс trip_route_departure_idx); поездки без города
+    (созданы до справочника или с адресом, который справочник не распознал)
+    при этом ищутся по нормализованному тексту, как раньше. Город не из
+    справочника сравнивается только по тексту, а диапазон времени сужается
+    индексом (status, departure_time).
+    """
+    start, end = day_bounds(search_date)
+    trips = Trip.objects.filter(
+        status=Trip.Status.ACTIVE,
+        departure_time__gte=max(start, timezone.now()),
+        departure_time__lt=end,
+    )
+    return trips.filter(
+        location_filter('departure', departure),
+        location_filter('destination', destination),
+    )
+
+
+def location_filter(side, value):
+    """Условие на место отправления (side='departure') или назначения (side='destination')."""
+    text = Q(**{f'{side}_normalized__contains': normalize_location(value)})
+    city_id = resolve_city(value)
+    if not city_id:
+        return text
+    return Q(**{f'{side}_city_id': city_id}) | (Q(**{f'{side}_city__isnull': True}) & text)
+
+
+# Сортировки результатов поиска: поле и направление (рейтинг - от лучших)
+SEARCH_ORDERINGS = {
+    'time': ('departure_time', False),
+    'price': ('price', False),
+    'rating': ('driver__average_rating', True),
+}
+
+
+def search_trips_page(departure, destination, search_date, sort, page_size, cursor=None, direction=NEXT):
+    """
+    Одна страница результатов поиска. Следующая страница читается по курсору
+    с LIMIT, без повторного чтения всех найденных поездок.
+    """
+    field, descending = SEARCH_ORDERINGS.get(sort, SEARCH_ORDERINGS['time'])
+    trips = search_trips(departure, destination, search_date).select_related('driver', 'vehicle')
+    return keyset_page(trips, field, page_size, cursor, direction, descending=descending)
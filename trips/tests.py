@@ -1,3 +1,231 @@
+from datetime import timedelta, timezone as dt_timezone
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.test import TestCase
+from django.utils import timezone
+
+from users.management.commands import runbot
+from users.models import User
+
+from .booking import book_seats, create_hold, release_expired_holds, reserve_seats, return_seats
+from .gazetteer import reset_city_matcher, resolve_city
+from .models import SeatHold, Trip, Vehicle
+from .pagination import PREV, decode_cursor, encode_cursor, keyset_page
+from .search import search_trips
+
+
+class TripTestMixin:
+    """Водитель с автомобилем и поездки к нему (справочник городов засеян миграцией 0008)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver', telegram_id=1, name='Водитель', role=User.Role.DRIVER)
+        cls.passenger = User.objects.create(username='passenger', telegram_id=2, name='Пассажир', role=User.Role.PASSENGER)
+        cls.vehicle = Vehicle.objects.create(driver=cls.driver, brand='Lada', model='Vesta', license_plate='A001AA')
+        cls.departure = timezone.localtime() + timedelta(days=2)
+
+    def setUp(self):
+        reset_city_matcher()
+
+    def create_trip(self, departure='Москва', destination='Сочи', seats=3, price=Decimal('500'), **fields):
+        trip = Trip(
+            driver=self.driver, vehicle=self.vehicle, departure_location=departure, destination_location=destination,
+            departure_time=self.departure, available_seats=seats, price=price, **fields,
+        )
+        if 'departure_city_id' not in fields:
+            trip.departure_city_id = resolve_city(departure)
+            trip.destination_city_id = resolve_city(destination)
+        trip.save()
+        return trip
+
+
+class SearchTripsTests(TripTestMixin, TestCase):
+    def search(self, departure, destination):
+        return set(search_trips(departure, destination, self.departure.date()))
+
+    def test_city_ids_match_any_spelling(self):
+        trip = self.create_trip('г. Москва', 'Sochi')
+        self.assertEqual(self.search('Moskva', 'Сочи'), {trip})
+
+    def test_trips_without_city_fall_back_to_text(self):
+        # Адрес, который справочник не распознал, и поездка, созданная до справочника
+        unresolved = self.create_trip('Москва (м. Тёплый стан)', 'Сочи')
+        legacy = self.create_trip('Москва', 'Сочи', departure_city_id=None, destination_city_id=None)
+        self.assertIsNone(unresolved.departure_city_id)
+        self.assertEqual(self.search('Москва', 'Сочи'), {unresolved, legacy})
+
+    def test_other_city_is_not_found(self):
+        self.create_trip('Москва', 'Краснодар')
+        self.create_trip('Краснодар', 'Москва', departure_city_id=None, destination_city_id=None)
+        self.assertEqual(self.search('Москва', 'Сочи'), set())
+
+
+class ResolveCityTests(TripTestMixin, TestCase):
+    def test_aliases_match_whole_words(self):
+        rostov = resolve_city('Ростов-на-Дону')
+        self.assertEqual(resolve_city('Ростов'), rostov)
+        self.assertEqual(resolve_city('Rostov on'), rostov)
+        # Вариант "Ростов" не подхватывает другие города ни префиксом, ни как опечатка
+        self.assertIsNone(resolve_city('Ростов Великий'))
+        self.assertIsNone(resolve_city('Ростовка'))
+
+    def test_names_match_prefix_and_typos(self):
+        self.assertEqual(resolve_city('Рост'), resolve_city('Ростов-на-Дону'))
+        self.assertEqual(resolve_city('Samarqnd'), resolve_city('Самарканд'))
+
+
+class ReserveSeatsTests(TripTestMixin, TestCase):
+    def test_reserve_and_return(self):
+        trip = self.create_trip(seats=3)
+        self.assertTrue(reserve_seats(trip.id, 2))
+        self.assertFalse(reserve_seats(trip.id, 2))
+        return_seats({trip.id: 2})
+        trip.refresh_from_db()
+        self.assertEqual(trip.available_seats, 3)
+
+    def test_database_rejects_negative_seats(self):
+        # CHECK от PositiveSmallIntegerField, без отдельного ограничения в Meta
+        trip = self.create_trip(seats=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Trip.objects.filter(id=trip.id).update(available_seats=F('available_seats') - 2)
+
+    def test_inactive_trip_is_not_reserved(self):
+        trip = self.create_trip(status=Trip.Status.CANCELED)
+        self.assertFalse(reserve_seats(trip.id, 1))
+
+    def test_booking_reports_remaining_seats(self):
+        trip = self.create_trip(seats=1)
+        booking, error = book_seats(self.passenger, trip, 2)
+        self.assertIsNone(booking)
+        self.assertIn('1', error)
+        booking, error = book_seats(self.passenger, trip, 1)
+        self.assertIsNone(error)
+        self.assertEqual(booking.seats_booked, 1)
+
+
+class TripUpdateTests(TripTestMixin, TestCase):
+    """Изменения поездки из бота не затирают места, списанные за это время reserve_seats."""
+
+    def assert_no_lost_update(self, change):
+        trip = self.create_trip(seats=3)
+        get = Trip.objects.get
+
+        def get_then_book(*args, **kwargs):
+            # Бронь проходит между чтением поездки и ее сохранением
+            stale = get(*args, **kwargs)
+            self.assertTrue(reserve_seats(trip.id, 2))
+            return stale
+
+        with patch.object(Trip.objects, 'get', side_effect=get_then_book):
+            change(trip.id)
+        trip.refresh_from_db()
+        self.assertEqual(trip.available_seats, 1)
+        return trip
+
+    def test_status_change_keeps_reserved_seats(self):
+        trip = self.assert_no_lost_update(lambda trip_id: runbot.update_trip_status(trip_id, Trip.Status.COMPLETED))
+        self.assertEqual(trip.status, Trip.Status.COMPLETED)
+
+    def test_field_change_keeps_reserved_seats(self):
+        trip = self.assert_no_lost_update(lambda trip_id: runbot.update_trip_field(trip_id, 'price', 700))
+        self.assertEqual(trip.price, Decimal('700'))
+
+    def test_location_change_updates_city(self):
+        trip = self.create_trip()
+        runbot.update_trip_field(trip.id, 'destination_location', 'Краснодар')
+        trip.refresh_from_db()
+        self.assertEqual(trip.destination_normalized, 'краснодар')
+        self.assertEqual(trip.destination_city_id, resolve_city('Краснодар'))
+
+
+class SeatHoldTests(TripTestMixin, TestCase):
+    def seats(self, trip):
+        trip.refresh_from_db()
+        return trip.available_seats
+
+    def test_booking_uses_held_seats(self):
+        trip = self.create_trip(seats=3)
+        hold = create_hold(self.passenger, trip, seats=1)
+        self.assertEqual(self.seats(trip), 2)
+        booking, error = book_seats(self.passenger, trip, 2, hold_id=hold.id)
+        self.assertIsNone(error)
+        self.assertEqual(self.seats(trip), 1)
+        self.assertFalse(SeatHold.objects.exists())
+
+    def test_hold_of_another_trip_is_not_used(self):
+        held_trip, trip = self.create_trip(seats=3), self.create_trip(seats=1)
+        hold = create_hold(self.passenger, held_trip, seats=1)
+        # Устаревший seat_hold_id из user_data не дает мест в другой поездке
+        booking, error = book_seats(self.passenger, trip, 2, hold_id=hold.id)
+        self.assertIsNone(booking)
+        self.assertEqual(self.seats(trip), 1)
+        self.assertTrue(SeatHold.objects.filter(id=hold.id).exists())
+        self.assertEqual(self.seats(held_trip), 2)
+
+    async def test_cancel_releases_hold(self):
+        update = SimpleNamespace(message=SimpleNamespace(reply_text=AsyncMock()))
+        context = SimpleNamespace(user_data={'seat_hold_id': 7, 'booking_trip_id': 1}, db_user=self.passenger)
+        with patch.object(runbot, 'release_hold_async', AsyncMock()) as release_hold_async, \
+                patch.object(runbot, 'show_main_menu', AsyncMock(return_value=runbot.MAIN_MENU)):
+            self.assertEqual(await runbot.cancel(update, context), runbot.MAIN_MENU)
+        release_hold_async.assert_awaited_once_with(7, self.passenger)
+        self.assertNotIn('seat_hold_id', context.user_data)
+
+    def test_expired_hold_returns_seats(self):
+        trip = self.create_trip(seats=1)
+        create_hold(self.passenger, trip, seats=1, ttl=0)
+        self.assertIsNone(create_hold(self.passenger, trip, seats=1))
+        self.assertEqual(release_expired_holds(), 1)
+        self.assertEqual(self.seats(trip), 1)
+
+    def test_driver_edit_does_not_oversell_after_holds_expire(self):
+        trip = self.create_trip(seats=3)
+        create_hold(self.passenger, trip, seats=2, ttl=0)
+        runbot.update_trip_field(trip.id, 'available_seats', 4)
+        # Пока удержание действует, два из четырех мест заняты им
+        self.assertEqual(self.seats(trip), 2)
+        release_expired_holds()
+        self.assertEqual(self.seats(trip), 4)
+
+    def test_driver_edit_below_held_seats_drops_holds(self):
+        trip = self.create_trip(seats=3)
+        hold = create_hold(self.passenger, trip, seats=2, ttl=0)
+        runbot.update_trip_field(trip.id, 'available_seats', 1)
+        self.assertEqual(self.seats(trip), 1)
+        self.assertEqual(release_expired_holds(), 0)
+        self.assertEqual(self.seats(trip), 1)
+        # Бронь по снятому удержанию идет на общих основаниях
+        booking, error = book_seats(self.passenger, trip, 2, hold_id=hold.id)
+        self.assertIsNone(booking)
+        self.assertEqual(self.seats(trip), 1)
+
+
+class KeysetPageTests(TripTestMixin, TestCase):
+    def test_cursor_round_trip(self):
+        for value in (self.departure.astimezone(dt_timezone.utc), Decimal('500.00'), 4.5):
+            self.assertEqual(decode_cursor(encode_cursor(value, 7)), (value, 7))
+
+    def test_malformed_cursor(self):
+        for cursor in ('', 'garbage', 't1.5_3', 'd1.2.3_3', 't1_x', 't99999999999999999999999_1', None):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+        with self.assertRaises(ValueError):
+            decode_cursor('f1.5_3', kinds='t')
 
-# Create your tests here.
+    def test_pages_forward_and_back(self):
+        trips = [self.create_trip(price=Decimal(price)) for price in (300, 500, 500, 700, 900)]
+        queryset = Trip.objects.all()
+        rows, has_prev, has_next, first, last = keyset_page(queryset, 'price', 2, descending=False)
+        self.assertEqual(rows, trips[:2])
+        self.assertEqual((has_prev, has_next), (False, True))
+        # Равные цены различаются по id: ни одна поездка не теряется и не повторяется
+        rows, has_prev, has_next, first, last = keyset_page(queryset, 'price', 2, last, descending=False)
+        self.assertEqual(rows, trips[2:4])
+        rows, _, has_next, _, _ = keyset_page(queryset, 'price', 2, last, descending=False)
+        self.assertEqual((rows, has_next), (trips[4:], False))
+        rows, has_prev, _, _, _ = keyset_page(queryset, 'price', 2, first, PREV, descending=False)
+        self.assertEqual((rows, has_prev), (trips[:2], False))
@@ -1,24 +1,19 @@
-import os
-import httpx
+import logging
+
 from django.contrib import admin, messages
 from .models import User
+from .outbox import get_outbox, TelegramSendError
+from .user_cache import invalidate_user
+
+logger = logging.getLogger(__name__)
 
-# Новая функция для отправки уведомлений
+# Уведомления уходят через общую очередь отправки: действие админки не ждет Telegram
 def send_telegram_notification(chat_id, text):
-    bot_token = os.getenv("BOT_TOKEN")
-    if not bot_token:
-        print("Токен бота не найден для отправки уведомления.")
-        return False
-    
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {'chat_id': chat_id, 'text': text}
-    
     try:
-        response = httpx.post(url, json=payload)
-        response.raise_for_status()
+        get_outbox().enqueue(chat_id, text)
         return True
-    except Exception as e:
-        print(f"Ошибка отправки уведомления: {e}")
+    except TelegramSendError as e:
+        logger.error(f"Ошибка отправки уведомления: {e}")
         return False
 
 @admin.register(User)
@@ -32,10 +27,10 @@ class UserAdmin(admin.ModelAdmin):
     fieldsets = (
         ('Основная информация', {'fields': ('name', 'phone_number', 'telegram_id')}),
         ('Статус и Роль', {'fields': ('role', 'verification_status')}),
-        ('Рейтинг', {'fields': ('average_rating', 'rating_count')}),
+        ('Рейтинг', {'fields': ('average_rating', 'rating_count', 'rating_sum')}),
         ('Техническая информация', {'fields': ('username', 'password', 'date_joined', 'last_login'), 'classes': ('collapse',)}),
     )
-    readonly_fields = ('date_joined', 'last_login', 'average_rating', 'rating_count')
+    readonly_fields = ('date_joined', 'last_login', 'average_rating', 'rating_count', 'rating_sum')
 
 
     @admin.action(description='Одобрить выбранных пользователей (станут водителями)')
@@ -44,6 +39,7 @@ class UserAdmin(admin.ModelAdmin):
         
         # Отправляем уведомление каждому одобренному пользователю
         for user in queryset:
+            invalidate_user(user.telegram_id)
             if user.telegram_id:
                 message = "✅ Ваш аккаунт водителя был одобрен! Теперь вы можете создавать поездки в боте."
                 send_telegram_notification(user.telegram_id, message)
@@ -59,6 +55,7 @@ class UserAdmin(admin.ModelAdmin):
         updated_count = queryset.update(verification_status=User.VerificationStatus.REJECTED)
         
         for user in queryset:
+            invalidate_user(user.telegram_id)
             if user.telegram_id:
                 message = "❌ К сожалению, ваш аккаунт водителя был отклонен. Свяжитесь с поддержкой для уточнений."
                 send_telegram_notification(user.telegram_id, message)
@@ -0,0 +1,31 @@
+# users/bench_db.py
+
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import setup_databases, teardown_databases
+
+
+@contextmanager
+def bench_database(stdout=None, keep=False):
+    """
+    Отдельная БД для нагрузочных команд, которые создают и удаляют свои данные:
+    test_<имя> из настроек, как у manage.py test, с применением миграций.
+    Откат в transaction.atomic (как в bench_trip_search) здесь не подходит: такие прогоны
+    пишут из нескольких потоков, у каждого свое соединение.
+    keep - оставить БД после прогона (и взять уже созданную при следующем).
+    """
+    settings_dict = connections[DEFAULT_DB_ALIAS].settings_dict
+    if settings_dict['ENGINE'].endswith('sqlite3') and not settings_dict['TEST'].get('NAME'):
+        # Вместо общей БД в памяти - файл рядом с рабочим: потоки блокируют его так же, как рабочую БД
+        settings_dict['TEST']['NAME'] = f"{settings_dict['NAME']}.bench"
+    old_config = setup_databases(
+        verbosity=0, interactive=False, keepdb=keep, aliases={DEFAULT_DB_ALIAS}, serialized_aliases=set(),
+    )
+    if stdout is not None:
+        stdout.write(f"Тестовая БД: {connections[DEFAULT_DB_ALIAS].settings_dict['NAME']}")
+    try:
+        yield
+    finally:
+        connections.close_all()
+        teardown_databases(old_config, verbosity=0, keepdb=keep)
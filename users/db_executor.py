@@ -0,0 +1,62 @@
+# users/db_executor.py
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from .metrics import metrics, query_wrapper
+
+_executor = None
+
+
+def get_db_executor():
+    """
+    Пул потоков для запросов бота к БД. У каждого потока свое
+    соединение Django, поэтому запросы разных пользователей идут
+    параллельно, а не по одному, как при thread_sensitive=True.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'BOT_DB_THREADS', 8),
+            thread_name_prefix='bot-db',
+        )
+    return _executor
+
+
+def shutdown_db_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def _call_with_connection(func, args, kwargs):
+    # Как database_sync_to_async в channels: закрываем соединения,
+    # которые устарели (CONN_MAX_AGE) или сломались, до и после вызова
+    close_old_connections()
+    try:
+        if not metrics.enabled:
+            return func(*args, **kwargs)
+        # Запросы считаются в метриках обработчика, из которого вызвана функция
+        with connection.execute_wrapper(query_wrapper):
+            return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def db_async(func):
+    """Оборачивает синхронную функцию ORM в корутину, выполняемую в пуле потоков БД."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # contextvars переносятся в поток (как в asyncio.to_thread)
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            get_db_executor(), context.run, _call_with_connection, func, args, kwargs
+        )
+    return wrapper
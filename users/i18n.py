@@ -0,0 +1,73 @@
+# users/i18n.py
+
+import json
+import logging
+from pathlib import Path
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+
+LOCALE_DIR = Path(__file__).resolve().parent / 'locale'
+DEFAULT_LANGUAGE = 'ru'
+# Коды, под которыми язык может прийти из Telegram или старых записей
+LANGUAGE_ALIASES = {'tg': 'tj'}
+
+
+class Template:
+    """
+    Строка перевода, разобранная один раз при загрузке каталога:
+    fields - имена подстановок, format - готовый метод форматирования.
+    """
+    __slots__ = ('text', 'fields', 'format')
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = frozenset(name for _, name, _, _ in Formatter().parse(text) if name)
+        # Для строк без подстановок format не вызывается вовсе
+        self.format = text.format if self.fields else None
+
+
+class Catalog:
+    """
+    Переводы из users/locale/<язык>.json. При загрузке для каждого языка
+    строится плоский словарь, в котором недостающие ключи уже взяты из
+    DEFAULT_LANGUAGE, поэтому при отрисовке нет поиска с откатом.
+    """
+
+    def __init__(self, locale_dir=LOCALE_DIR, default_language=DEFAULT_LANGUAGE):
+        self.default_language = default_language
+        raw = {}
+        for path in sorted(Path(locale_dir).glob('*.json')):
+            with open(path, encoding='utf-8') as f:
+                raw[path.stem] = json.load(f)
+        base = raw[default_language]
+        self.languages = {}
+        for language, messages in raw.items():
+            unknown = set(messages) - set(base)
+            if unknown:
+                logger.warning(f"Ключи {sorted(unknown)} в {language}.json отсутствуют в {default_language}.json")
+            merged = {**base, **messages}
+            self.languages[language] = {key: Template(text) for key, text in merged.items()}
+        for alias, language in LANGUAGE_ALIASES.items():
+            if language in self.languages:
+                self.languages.setdefault(alias, self.languages[language])
+        self.default = self.languages[default_language]
+
+    def get(self, language, key, /, **kwargs):
+        template = self.languages.get(language, self.default)[key]
+        return template.format(**kwargs) if kwargs and template.format else template.text
+
+
+catalog = Catalog()
+_languages = catalog.languages
+_default = catalog.default
+
+
+def get_text(user, key, /, **kwargs):
+    """
+    Текст на языке пользователя (или на языке по умолчанию, если язык не выбран).
+    user и key - только позиционные: подстановка может называться user (rating_thanks).
+    """
+    # Тот же Catalog.get, но без лишнего вызова: функция вызывается на каждый ответ бота
+    template = _languages.get(user.language if user else None, _default)[key]
+    return template.format(**kwargs) if kwargs and template.format else template.text
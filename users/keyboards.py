@@ -0,0 +1,170 @@
+# users/keyboards.py
+
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from trips.pagination import NEXT, PREV
+from users.i18n import LANGUAGE_ALIASES, catalog
+from users.models import User
+
+# --- Кнопки ---
+FIND_TRIP_BTN = "Найти поездку 🔍"
+MY_BOOKINGS_BTN = "Мои бронирования 🗒️"
+CREATE_TRIP_BTN = "Создать поездку ➕"
+MY_TRIPS_BTN = "Мои поездки 🚕"
+MY_PROFILE_BTN = "Мой профиль 👤"
+SUPPORT_BTN = "Поддержка 💬"
+CHANGE_ROLE_BTN = "Смена роли ✏️"
+BACK_TO_MENU_BTN = "⬅️ Назад в главное меню"
+CONFIRM_YES_BTN = "Да, сменить"
+CONFIRM_NO_BTN = "Нет, отмена"
+TRIP_HISTORY_BTN = "История поездок 📜"
+SHARE_PHONE_BTN = "📱 Отправить мой номер телефона"
+
+LANGUAGE_BUTTONS = {"Русский 🇷🇺": "ru", "O'zbekcha 🇺🇿": "uz", "Тоҷикӣ 🇹🇯": "tj"}
+ROLE_BUTTONS = {"Я Пассажир 🧍": User.Role.PASSENGER, "Я Водитель 🚕": User.Role.DRIVER}
+
+# --- Статические меню ---
+MENU_MAIN = 'main'
+MENU_LANGUAGE = 'language'
+MENU_PHONE = 'phone'
+MENU_ROLE = 'role'
+MENU_PROFILE = 'profile'
+MENU_CONFIRM_ROLE = 'confirm_role'
+MENU_EDIT_TRIP = 'edit_trip'
+
+
+def _main_menu(language, role):
+    if role == User.Role.PASSENGER:
+        keyboard = [[FIND_TRIP_BTN], [MY_BOOKINGS_BTN, TRIP_HISTORY_BTN], [MY_PROFILE_BTN], [SUPPORT_BTN]]
+    else:
+        keyboard = [[CREATE_TRIP_BTN], [MY_TRIPS_BTN, TRIP_HISTORY_BTN], [MY_PROFILE_BTN], [SUPPORT_BTN]]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+def _language_menu(language, role):
+    return ReplyKeyboardMarkup([list(LANGUAGE_BUTTONS)], one_time_keyboard=True, resize_keyboard=True)
+
+
+def _phone_menu(language, role):
+    keyboard = [[KeyboardButton(SHARE_PHONE_BTN, request_contact=True)]]
+    return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+
+
+def _role_menu(language, role):
+    return ReplyKeyboardMarkup([list(ROLE_BUTTONS)], one_time_keyboard=True, resize_keyboard=True)
+
+
+def _profile_menu(language, role):
+    return ReplyKeyboardMarkup([[CHANGE_ROLE_BTN], [BACK_TO_MENU_BTN]], resize_keyboard=True)
+
+
+def _confirm_role_menu(language, role):
+    return ReplyKeyboardMarkup([[CONFIRM_YES_BTN, CONFIRM_NO_BTN]], resize_keyboard=True, one_time_keyboard=True)
+
+
+def _edit_trip_menu(language, role):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Время отправления", callback_data="edit_field_departure_time")],
+        [InlineKeyboardButton("Количество мест", callback_data="edit_field_available_seats")],
+        [InlineKeyboardButton("Цену", callback_data="edit_field_price")],
+    ])
+
+
+MENUS = {
+    MENU_MAIN: _main_menu,
+    MENU_LANGUAGE: _language_menu,
+    MENU_PHONE: _phone_menu,
+    MENU_ROLE: _role_menu,
+    MENU_PROFILE: _profile_menu,
+    MENU_CONFIRM_ROLE: _confirm_role_menu,
+    MENU_EDIT_TRIP: _edit_trip_menu,
+}
+# Меню, которые выглядят по-разному для пассажира и водителя
+ROLE_MENUS = {MENU_MAIN}
+
+
+@lru_cache(maxsize=None)
+def _build_menu(language, role, menu):
+    return MENUS[menu](language, role)
+
+
+def get_keyboard(menu, language=None, role=None):
+    """
+    Клавиатура статического меню. Собирается один раз на (язык, роль, меню)
+    и дальше переиспользуется: объекты PTB неизменяемы после создания.
+    Язык и роль приводятся к тем значениям, от которых меню действительно зависит,
+    чтобы кэш не рос от неизвестных кодов языка.
+    """
+    language = LANGUAGE_ALIASES.get(language, language)
+    if language not in catalog.languages:
+        language = catalog.default_language
+    if menu not in ROLE_MENUS:
+        role = None
+    return _build_menu(language, role, menu)
+
+
+def user_keyboard(user, menu):
+    return get_keyboard(menu, user.language if user else None, user.role if user else None)
+
+
+# --- Inline-клавиатуры для конкретных записей ---
+@lru_cache(maxsize=4096)
+def inline_button(text, callback_data):
+    """Кнопка с готовыми подписью и callback_data; одинаковые кнопки (одна поездка в разных выдачах) общие."""
+    return InlineKeyboardButton(text, callback_data=callback_data)
+
+
+class InlineKeyboard:
+    """
+    Шаблон inline-клавиатуры: подписи и шаблоны callback_data разбираются один раз,
+    при сборке подставляются только параметры записи (id поездки, номер в списке и т.п.).
+    shared=False - для кнопок, которые не повторяются (запрос оценки конкретной пары):
+    их незачем держать в общем кэше кнопок.
+    """
+    __slots__ = ('rows', 'button')
+
+    def __init__(self, *rows, shared=True):
+        self.button = inline_button if shared else InlineKeyboardButton
+        # Строки без подстановок не форматируются при сборке
+        self.rows = tuple(
+            tuple((text.format if '{' in text else text, callback.format if '{' in callback else callback) for text, callback in row)
+            for row in rows
+        )
+
+    def row(self, index=0, **params):
+        """Одна строка кнопок - для клавиатур, собранных из строк разных записей."""
+        return tuple(
+            self.button(
+                text if isinstance(text, str) else text(**params),
+                callback_data=callback if isinstance(callback, str) else callback(**params),
+            )
+            for text, callback in self.rows[index]
+        )
+
+    def __call__(self, **params):
+        return InlineKeyboardMarkup(tuple(self.row(index, **params) for index in range(len(self.rows))))
+
+
+RATING_KEYBOARD = InlineKeyboard([(f"{i} ⭐", f"rate_{{trip}}_{{rater}}_{{rated}}_{i}") for i in range(1, 6)], shared=False)
+CONTACT_PASSENGER_KEYBOARD = InlineKeyboard([("💬 Связаться с пассажиром", "contact_user_{booking}")], shared=False)
+CONTACT_DRIVER_KEYBOARD = InlineKeyboard([("💬 Связаться с водителем", "contact_user_{booking}")], shared=False)
+BOOK_TRIP_BUTTONS = InlineKeyboard([("✅ {number}", "book_trip_{trip}")])
+TRIP_ACTIONS_BUTTONS = InlineKeyboard([
+    ("✅ {number}", "complete_trip_{trip}"),
+    ("❌ {number}", "cancel_trip_{trip}"),
+    ("✏️ {number}", "edit_trip_{trip}"),
+])
+VEHICLE_BUTTONS = InlineKeyboard([("{vehicle}", "select_vehicle_{id}")])
+
+
+def navigation_row(prefix, page):
+    """Кнопки листания страницы из keyset_page: курсоры первой и последней записи в callback_data."""
+    _, has_prev, has_next, first_cursor, last_cursor = page
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}_{PREV}_{first_cursor}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}_{NEXT}_{last_cursor}"))
+    return navigation
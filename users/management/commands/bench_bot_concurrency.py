@@ -0,0 +1,65 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+from telegram import Chat, Message, Update, User as TelegramUser
+
+from users.update_processor import PerChatUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    chat = Chat(id=user_id, type=Chat.PRIVATE)
+    user = TelegramUser(id=user_id, first_name=f'user{user_id}', is_bot=False)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, from_user=user, text='ping')
+    return Update(update_id=update_id, message=message)
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест обработки апдейтов: N пользователей, обработчик с задержкой '
+        '(имитация ожидания БД и Bot API). Показывает рост пропускной способности '
+        'с числом одновременных апдейтов и проверяет порядок внутри чата.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--updates-per-user', type=int, default=5)
+        parser.add_argument('--handler-ms', type=float, default=20.0, help='Время работы одного обработчика, мс')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64, 256])
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'параллельно':>11} | {'апдейт/с':>9} | {'ожидало max':>11} | нарушений порядка")
+        for concurrency in options['concurrency']:
+            rate, stats, violations = asyncio.run(self.run(concurrency, options))
+            self.stdout.write(f"{concurrency:>11} | {rate:>9.0f} | {stats['max_waiting']:>11} | {violations}")
+
+    async def run(self, concurrency, options):
+        processor = PerChatUpdateProcessor(concurrency)
+        seen = {}
+        violations = 0
+        delay = options['handler_ms'] / 1000
+
+        async def handler(user_id, sequence):
+            nonlocal violations
+            if seen.get(user_id, -1) != sequence - 1:
+                violations += 1
+            await asyncio.sleep(delay)
+            seen[user_id] = sequence
+
+        # Апдейты приходят вперемешку, как из общей очереди getUpdates
+        updates = []
+        update_id = 0
+        for sequence in range(options['updates_per_user']):
+            for user_id in range(1, options['users'] + 1):
+                update_id += 1
+                updates.append((make_update(update_id, user_id), user_id, sequence))
+
+        started = time.perf_counter()
+        async with processor:
+            await asyncio.gather(*(
+                processor.process_update(update, handler(user_id, sequence))
+                for update, user_id, sequence in updates
+            ))
+        elapsed = time.perf_counter() - started
+        return len(updates) / elapsed, processor.stats(), violations
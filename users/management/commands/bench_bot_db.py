@@ -0,0 +1,90 @@
+import asyncio
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.bench_db import bench_database
+from users.db_executor import db_async, shutdown_db_executor
+from users.models import User
+from trips.models import Vehicle, Trip
+from trips.search import search_trips
+
+CITIES = ["Москва", "Краснодар", "Сочи", "Ростов-на-Дону", "Анапа", "Воронеж"]
+
+
+def handler_queries(telegram_id, departure, destination, search_date):
+    """Типичная работа обработчика поиска: пользователь + список поездок."""
+    User.objects.filter(telegram_id=telegram_id).first()
+    return len(list(search_trips(departure, destination, search_date).select_related('driver', 'vehicle')))
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает задержку обработчиков бота при thread_sensitive=True '
+        '(все запросы в одном потоке) и в пуле потоков БД. Данные создаются в отдельной тестовой БД.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Одновременных пользователей')
+        parser.add_argument('--requests', type=int, default=20, help='Запросов на пользователя')
+        parser.add_argument('--trips', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        with bench_database(self.stdout):
+            try:
+                driver = User.objects.create(username='bench_db_driver', name='Bench')
+                self.create_data(driver, options)
+                modes = [
+                    ('thread_sensitive=True', sync_to_async(handler_queries, thread_sensitive=True)),
+                    ('пул потоков БД', db_async(handler_queries)),
+                ]
+                for name, func in modes:
+                    timings, elapsed = asyncio.run(self.run(func, options))
+                    self.stdout.write(
+                        f"{name:>22}: p50 {statistics.median(timings):.1f} мс, "
+                        f"p99 {timings[int(len(timings) * 0.99) - 1]:.1f} мс, "
+                        f"{len(timings) / elapsed:.0f} обработчиков/с"
+                    )
+            finally:
+                # Соединения потоков пула закрываются до удаления тестовой БД
+                shutdown_db_executor()
+
+    def create_data(self, driver, options):
+        vehicle = Vehicle.objects.create(driver=driver, brand='Bench', model='Car', license_plate='BENCH-DB')
+        rng = random.Random(1)
+        now = timezone.now()
+        trips = []
+        for _ in range(options['trips']):
+            departure, destination = rng.sample(CITIES, 2)
+            trips.append(Trip(
+                driver=driver, vehicle=vehicle, departure_location=departure, destination_location=destination,
+                departure_normalized=departure.lower(), destination_normalized=destination.lower(),
+                departure_time=now + timedelta(hours=rng.randrange(1, 24 * 14)), available_seats=3, price=1000,
+            ))
+        Trip.objects.bulk_create(trips)
+        User.objects.bulk_create([
+            User(username=f'bench_db_{i}', name=f'Bench {i}', telegram_id=-(i + 1)) for i in range(options['users'])
+        ])
+
+    async def run(self, func, options):
+        timings = []
+        rng = random.Random(2)
+        today = timezone.localdate()
+
+        async def simulated_user(index):
+            for _ in range(options['requests']):
+                departure, destination = rng.sample(CITIES, 2)
+                started = time.perf_counter()
+                await func(-(index + 1), departure, destination, today + timedelta(days=rng.randrange(14)))
+                timings.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulated_user(i) for i in range(options['users'])))
+        elapsed = time.perf_counter() - started
+        timings.sort()
+        return timings, elapsed
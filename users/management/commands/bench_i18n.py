@@ -0,0 +1,56 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+from telegram import ReplyKeyboardMarkup
+
+from users.i18n import LOCALE_DIR, get_text
+from users.keyboards import (
+    get_keyboard, MENU_MAIN, FIND_TRIP_BTN, MY_BOOKINGS_BTN, TRIP_HISTORY_BTN, MY_PROFILE_BTN, SUPPORT_BTN,
+)
+from users.models import User
+
+# Прежний каталог: словари в коде и откат на русский при каждом вызове
+TRANSLATIONS = {
+    path.stem: json.loads(path.read_text(encoding='utf-8')) for path in LOCALE_DIR.glob('*.json')
+}
+
+
+def legacy_get_text(user, key, **kwargs):
+    lang = user.language if user and user.language in TRANSLATIONS else 'ru'
+    text = TRANSLATIONS[lang].get(key, TRANSLATIONS['ru'][key])
+    return text.format(**kwargs) if kwargs else text
+
+
+def legacy_main_menu_markup():
+    keyboard = [[FIND_TRIP_BTN], [MY_BOOKINGS_BTN, TRIP_HISTORY_BTN], [MY_PROFILE_BTN], [SUPPORT_BTN]]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+class Command(BaseCommand):
+    help = 'Микробенчмарк отрисовки текстов бота и клавиатуры главного меню (прежний и новый вариант).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200_000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        user_ru = User(language='ru')
+        user_uz = User(language='uz')
+        trip_kwargs = dict(dep='Москва', dest='Тула', time='01.01.2026 в 10:00', seats=3, price=500)
+        cases = [
+            ('текст без подстановок (ru)', lambda: legacy_get_text(user_ru, 'driver_menu'), lambda: get_text(user_ru, 'driver_menu')),
+            ('текст без подстановок (uz -> ru)', lambda: legacy_get_text(user_uz, 'driver_menu'), lambda: get_text(user_uz, 'driver_menu')),
+            (
+                'текст с подстановками',
+                lambda: legacy_get_text(user_ru, 'trip_active_info', **trip_kwargs),
+                lambda: get_text(user_ru, 'trip_active_info', **trip_kwargs),
+            ),
+            ('клавиатура главного меню', legacy_main_menu_markup, lambda: get_keyboard(MENU_MAIN, 'ru', User.Role.PASSENGER)),
+        ]
+        self.stdout.write(f"{'случай':>34} | {'прежний':>10} | {'новый':>10}")
+        for name, legacy, current in cases:
+            assert legacy() == current()
+            legacy_ns = min(timeit.repeat(legacy, number=number, repeat=3)) / number * 1e9
+            current_ns = min(timeit.repeat(current, number=number, repeat=3)) / number * 1e9
+            self.stdout.write(f"{name:>34} | {legacy_ns:>7.0f} нс | {current_ns:>7.0f} нс")
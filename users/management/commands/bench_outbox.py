@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from users.management.commands.replay_updates import BotApiStub
+from users.outbox import Outbox
+
+
+class RateLimitedStub(BotApiStub):
+    """Заглушка Bot API, которая запоминает время отправок и отвечает 429 на каждый N-й вызов."""
+
+    def __init__(self, reject_every, retry_after):
+        super().__init__()
+        self.reject_every = reject_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.rejected = 0
+        self.sent = defaultdict(list)  # chat_id -> времена принятых сообщений
+
+    def respond(self, method, params):
+        self.requests += 1
+        if self.reject_every and self.requests % self.reject_every == 0:
+            self.rejected += 1
+            return '429 Too Many Requests', {
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                'parameters': {'retry_after': self.retry_after},
+            }
+        self.sent[params.get('chat_id')].append(time.monotonic())
+        return super().respond(method, params)
+
+
+class Command(BaseCommand):
+    help = (
+        'Отправляет пачку уведомлений через очередь отправки на локальную заглушку Bot API '
+        'и проверяет лимиты: сообщений в секунду на бота, интервал в один чат, ответы 429.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chats', type=int, default=100)
+        parser.add_argument('--messages-per-chat', type=int, default=3)
+        parser.add_argument('--port', type=int, default=8082, help='Порт заглушки Bot API')
+        parser.add_argument('--reject-every', type=int, default=50, help='Каждый N-й запрос получает 429 (0 - никогда)')
+        parser.add_argument('--retry-after', type=int, default=1)
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        stub = RateLimitedStub(options['reject_every'], options['retry_after'])
+        server = await asyncio.start_server(stub.handle, '127.0.0.1', options['port'])
+        outbox = Outbox(token='bench', base_url=f"http://127.0.0.1:{options['port']}/bot")
+        async with server:
+            started = time.monotonic()
+            futures = [
+                outbox.enqueue(chat_id, f"Уведомление {index}")
+                for index in range(options['messages_per_chat'])
+                for chat_id in range(1, options['chats'] + 1)
+            ]
+            results = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures), return_exceptions=True)
+            elapsed = time.monotonic() - started
+            await asyncio.to_thread(outbox.stop)
+
+        failed = sum(isinstance(result, Exception) for result in results)
+        moments = sorted(moment for times in stub.sent.values() for moment in times)
+        # Максимум сообщений в любом окне длиной 1 секунда
+        peak, start = 0, 0
+        for end, moment in enumerate(moments):
+            while moment - moments[start] >= 1.0:
+                start += 1
+            peak = max(peak, end - start + 1)
+        chat_gaps = [later - earlier for times in stub.sent.values() for earlier, later in zip(times, times[1:])]
+
+        self.stdout.write(f"Сообщений: {len(futures)}, ошибок: {failed}, ответов 429: {stub.rejected}, время: {elapsed:.2f} с")
+        self.stdout.write(f"Средняя скорость: {len(futures) / elapsed:.1f} сообщений/с, максимум за 1 с: {peak}")
+        if chat_gaps:
+            self.stdout.write(f"Минимальный интервал между сообщениями в один чат: {min(chat_gaps):.2f} с")
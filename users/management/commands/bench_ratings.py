@@ -0,0 +1,78 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+
+from users.models import User
+from users.ratings import add_rating
+from trips.models import Vehicle, Trip, Rating
+
+
+class _Rollback(Exception):
+    pass
+
+
+def legacy_add_rating(rater, rated_user, trip, score):
+    """Прежний вариант: пересчет count() и Avg() по всем оценкам пользователя."""
+    Rating.objects.create(rater=rater, rated_user=rated_user, trip=trip, score=score)
+    user_to_update = User.objects.select_for_update().get(id=rated_user.id)
+    all_ratings = user_to_update.received_ratings.all()
+    user_to_update.rating_count = all_ratings.count()
+    user_to_update.average_rating = all_ratings.aggregate(models.Avg('score'))['score__avg']
+    user_to_update.save()
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время добавления оценки пользователю с 100/1k/10k+ оценками (данные откатываются).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1_000, 10_000, 50_000])
+        parser.add_argument('--inserts', type=int, default=100, help='Сколько оценок добавлять на каждый размер')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(sorted(options['sizes']), options['inserts'])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def run(self, sizes, inserts):
+        driver = User.objects.create(username='bench_rating_driver', name='Bench')
+        vehicle = Vehicle.objects.create(driver=driver, brand='Bench', model='Car', license_plate='BENCH-RATING')
+        raters_needed = max(sizes) + 2 * inserts * len(sizes)
+        User.objects.bulk_create(
+            [User(username=f'bench_rater_{i}', name=f'Rater {i}') for i in range(raters_needed)], batch_size=5000
+        )
+        raters = list(User.objects.filter(username__startswith='bench_rater_').order_by('id'))
+        trip = Trip.objects.create(
+            driver=driver, vehicle=vehicle, departure_location='A', destination_location='B',
+            departure_time=timezone.now() + timedelta(days=1), available_seats=1, price=1,
+        )
+        free_raters = iter(raters)
+        existing = 0
+
+        self.stdout.write(f"{'оценок у водителя':>18} | {'пересчет p50':>13} | {'инкремент p50':>14}")
+        for size in sizes:
+            Rating.objects.bulk_create(
+                [Rating(trip=trip, rater=next(free_raters), rated_user=driver, score=5) for _ in range(size - existing)],
+                batch_size=5000,
+            )
+            existing = size
+            legacy = self.measure(legacy_add_rating, free_raters, driver, trip, inserts)
+            incremental = self.measure(add_rating, free_raters, driver, trip, inserts)
+            existing += 2 * inserts
+            self.stdout.write(f"{size:>18} | {legacy:>10.3f} мс | {incremental:>11.3f} мс")
+
+    def measure(self, func, free_raters, driver, trip, inserts):
+        timings = []
+        for _ in range(inserts):
+            rater = next(free_raters)
+            started = time.perf_counter()
+            with transaction.atomic():
+                func(rater, driver, trip, 4)
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
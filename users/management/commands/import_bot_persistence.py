@@ -0,0 +1,52 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+from telegram.ext import PicklePersistence
+
+from users.models import BotPersistenceRecord
+from users.persistence import conversation_key_to_str, write_records
+
+Kind = BotPersistenceRecord.Kind
+
+
+class Command(BaseCommand):
+    help = 'Переносит состояние бота из файла PicklePersistence в БД.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default='bot_persistence', help='Путь к файлу PicklePersistence')
+
+    async def read_pickle(self, filepath):
+        persistence = PicklePersistence(filepath=filepath)
+        user_data = await persistence.get_user_data()
+        chat_data = await persistence.get_chat_data()
+        bot_data = await persistence.get_bot_data()
+        conversations = {}
+        for name in (persistence.conversations or {}):
+            conversations[name] = await persistence.get_conversations(name)
+        return user_data, chat_data, bot_data, conversations
+
+    def handle(self, *args, **options):
+        try:
+            user_data, chat_data, bot_data, conversations = asyncio.run(self.read_pickle(options['file']))
+        except (OSError, TypeError) as e:
+            raise CommandError(f"Не удалось прочитать {options['file']}: {e}")
+
+        changes = {}
+        for user_id, data in user_data.items():
+            if data:
+                changes[(Kind.USER_DATA, '', str(user_id))] = data
+        for chat_id, data in chat_data.items():
+            if data:
+                changes[(Kind.CHAT_DATA, '', str(chat_id))] = data
+        if bot_data:
+            changes[(Kind.BOT_DATA, '', '')] = bot_data
+        for name, states in conversations.items():
+            for key, state in states.items():
+                if state is not None:
+                    changes[(Kind.CONVERSATION, name, conversation_key_to_str(key))] = state
+
+        write_records(changes)
+        self.stdout.write(self.style.SUCCESS(
+            f"Импортировано: пользователей {len(user_data)}, чатов {len(chat_data)}, "
+            f"диалогов {sum(len(states) for states in conversations.values())}."
+        ))
@@ -0,0 +1,331 @@
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+import httpx
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from telegram import Update
+from telegram.request import BaseRequest
+
+from support.writer import configure_chat_writer, stop_chat_writer
+from trips.models import Booking, Trip
+from users.bench_db import bench_database
+from users.db_executor import db_async
+from users.keyboards import CREATE_TRIP_BTN, FIND_TRIP_BTN, MY_TRIPS_BTN
+from users.management.commands.replay_updates import BotApiStub
+from users.management.commands.runbot import build_application
+from users.metrics import configure_metrics, metrics
+from users.models import User
+from users.outbox import configure_outbox, stop_outbox
+from users.user_cache import invalidate_user
+
+# Синтетические пользователи получают telegram_id из этого диапазона и удаляются после прогона
+TELEGRAM_ID_BASE = 990_000_000_000
+
+
+class RecordingStub(BotApiStub):
+    """Заглушка Bot API, которая запоминает callback_data кнопок последнего сообщения в каждый чат."""
+
+    def __init__(self):
+        super().__init__()
+        self.buttons = {}  # chat_id -> [callback_data]
+        self.prompts = defaultdict(list)  # chat_id -> callback_data запросов оценки
+
+    def respond(self, method, params):
+        method = method.lower()
+        markup = params.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        chat_id = params.get('chat_id')
+        if markup and 'inline_keyboard' in markup:
+            callbacks = [button['callback_data'] for row in markup['inline_keyboard'] for button in row]
+            self.buttons[chat_id] = callbacks
+            if callbacks and callbacks[0].startswith('rate_'):
+                self.prompts[chat_id].append(callbacks)
+        return super().respond(method, params)
+
+
+class FakeBotRequest(BaseRequest):
+    """BaseRequest без сети: запросы бота сразу отвечает RecordingStub."""
+    __slots__ = ('stub',)
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        params = request_data.parameters if request_data else {}
+        status, response = self.stub.respond(url.rsplit('/', 1)[-1], params)
+        return int(status.split()[0]), json.dumps(response).encode()
+
+
+def stub_transport(stub):
+    """Транспорт httpx для очереди отправки: те же ответы заглушки, без сети."""
+    def handler(request):
+        status, response = stub.respond(request.url.path.rsplit('/', 1)[-1], json.loads(request.content or b'{}'))
+        return httpx.Response(int(status.split()[0]), json=response)
+    return httpx.MockTransport(handler)
+
+
+class SyntheticUser:
+    """Пользователь Telegram, который шлет боту сообщения и нажимает кнопки."""
+
+    def __init__(self, harness, telegram_id, route=None):
+        self.harness = harness
+        self.id = telegram_id
+        self.route = route  # (откуда, куда)
+
+    def _base(self):
+        return {'id': self.id, 'is_bot': False, 'first_name': f"Нагрузка {self.id - TELEGRAM_ID_BASE}", 'language_code': 'ru'}
+
+    async def send(self, text=None, contact=None):
+        message = {
+            'message_id': self.harness.next_id(),
+            'date': int(time.time()),
+            'chat': {'id': self.id, 'type': 'private'},
+            'from': self._base(),
+        }
+        if contact:
+            message['contact'] = {'phone_number': contact, 'first_name': 'Нагрузка', 'user_id': self.id}
+        else:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        await self.harness.process({'update_id': self.harness.next_id(), 'message': message})
+
+    async def press(self, callback_data):
+        query = {
+            'id': str(self.harness.next_id()),
+            'from': self._base(),
+            'chat_instance': str(self.id),
+            'data': callback_data,
+            'message': {
+                'message_id': self.harness.next_id(),
+                'date': int(time.time()),
+                'chat': {'id': self.id, 'type': 'private'},
+                'text': '',
+            },
+        }
+        await self.harness.process({'update_id': self.harness.next_id(), 'callback_query': query})
+
+    def buttons(self, prefix):
+        """callback_data кнопок последнего сообщения бота с данным префиксом."""
+        return [data for data in self.harness.stub.buttons.get(self.id, ()) if data.startswith(prefix)]
+
+    async def press_button(self, prefix):
+        """Нажимает кнопку из последнего сообщения бота; если кнопки нет, шаг сценария считается сорванным."""
+        buttons = self.buttons(prefix)
+        if not buttons:
+            self.harness.errors[f"нет кнопки {prefix}"] += 1
+            return False
+        await self.press(buttons[0])
+        return True
+
+    # --- Шаги сценариев ---
+    async def register(self, role_button):
+        await self.send('/start')
+        await self.send("Русский 🇷🇺")
+        await self.send(contact=f"+7900{self.id % 10_000_000:07d}")
+        await self.send(role_button)
+
+    async def create_trip(self, departure, seats, price=500):
+        """Первая поездка водителя: бот сначала просит добавить автомобиль."""
+        await self.send(CREATE_TRIP_BTN)
+        for text in ("Kia", "Rio", f"Н{self.id % 1000:03d}ТЕ"):
+            await self.send(text)
+        await self.enter_trip(departure, seats, price)
+
+    async def enter_trip(self, departure, seats, price=500):
+        for text in (*self.route, departure.strftime('%d.%m.%Y %H:%M'), str(seats), str(price)):
+            await self.send(text)
+
+    async def search(self, departure):
+        await self.send(FIND_TRIP_BTN)
+        for text in (*self.route, departure.strftime('%d.%m.%Y')):
+            await self.send(text)
+
+    async def book(self, seats=1):
+        if await self.press_button('book_trip_'):
+            await self.send(str(seats))
+
+    async def complete(self):
+        await self.send(MY_TRIPS_BTN)
+        await self.press_button('complete_trip_')
+
+    async def rate(self, score=5):
+        for callbacks in self.harness.stub.prompts.pop(self.id, []):
+            await self.press(callbacks[score - 1])
+
+
+class Harness:
+    """Application из runbot, заглушка Bot API и счетчики прогона."""
+
+    def __init__(self, application, stub, concurrency):
+        self.application = application
+        self.stub = stub
+        self.limit = asyncio.Semaphore(concurrency)
+        self.counter = 0
+        self.updates = 0
+        self.latencies = []
+        self.errors = Counter()
+        application.add_error_handler(self.on_error)
+
+    @classmethod
+    async def open(cls, concurrency):
+        configure_metrics(enabled=True, slow_handler_seconds=float('inf'), keep_samples=True)
+        metrics.reset()
+        stub = RecordingStub()
+        configure_outbox(
+            token='loadtest', base_url='http://bot-api.loadtest/bot',
+            global_rate=100_000, chat_interval=0, transport=stub_transport(stub),
+        )
+        configure_chat_writer(run_sync=db_async)
+        application = build_application('1:loadtest', request=FakeBotRequest(stub), concurrency=concurrency, rate_limit=False)
+        await application.initialize()
+        # Без start() Application не дожидается задач create_task (рассылка запросов оценок)
+        await application.start()
+        return cls(application, stub, concurrency)
+
+    async def close(self):
+        await self.application.stop()
+        await self.application.shutdown()
+        await stop_chat_writer()
+        await asyncio.to_thread(stop_outbox)
+
+    async def on_error(self, update, context):
+        # Вместо трассировки на каждое исключение - счетчик по типу ошибки
+        self.errors[f"{type(context.error).__name__}: {context.error}"[:120]] += 1
+
+    def next_id(self):
+        self.counter += 1
+        return self.counter
+
+    async def process(self, data):
+        """Апдейт проходит тот же путь, что и в runbot: процессор апдейтов по чатам, затем обработчики."""
+        application = self.application
+        update = Update.de_json(data, application.bot)
+        started = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        self.latencies.append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def run_phase(self, users, flow):
+        async def run(user):
+            async with self.limit:
+                await flow(user)
+        await asyncio.gather(*(run(user) for user in users))
+
+    async def wait_for_rating_prompts(self, timeout=30.0):
+        """Запросы оценок рассылаются в фоне через очередь отправки: по два на бронирование."""
+        expected = 2 * await asyncio.to_thread(
+            Booking.objects.filter(trip__driver__telegram_id__gte=TELEGRAM_ID_BASE, trip__status=Trip.Status.COMPLETED).count
+        )
+        deadline = time.monotonic() + timeout
+        while sum(len(prompts) for prompts in self.stub.prompts.values()) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+
+def verify_drivers(telegram_ids):
+    """Вместо администратора: водители проходят проверку сразу после регистрации."""
+    User.objects.filter(telegram_id__in=telegram_ids).update(verification_status=User.VerificationStatus.VERIFIED)
+    for telegram_id in telegram_ids:
+        invalidate_user(telegram_id)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный прогон бота без сети: Application из runbot с заглушкой Bot API, '
+        'синтетические водители и пассажиры проходят регистрацию, создание поездки, поиск, '
+        'бронирование, завершение поездки и оценку. Печатает пропускную способность, '
+        'p50/p95/p99 по обработчикам и запросы к БД на сценарий. Прогон идет в отдельной тестовой БД (test_<имя>), '
+        'рабочая БД из настроек не меняется.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=250)
+        parser.add_argument('--passengers-per-driver', type=int, default=3)
+        parser.add_argument('--concurrency', type=int, default=50, help='Сколько пользователей действуют одновременно')
+        parser.add_argument('--keep', action='store_true', help='Не удалять тестовую БД после прогона')
+
+    def handle(self, *args, **options):
+        with bench_database(self.stdout, keep=options['keep']):
+            asyncio.run(self.run(options))
+
+    async def run(self, options):
+        harness = await Harness.open(options['concurrency'])
+        per_driver = options['passengers_per_driver']
+        drivers = [
+            SyntheticUser(harness, TELEGRAM_ID_BASE + n, (f"Пункт {n} отправления", f"Пункт {n} назначения"))
+            for n in range(options['drivers'])
+        ]
+        passengers = [
+            SyntheticUser(harness, TELEGRAM_ID_BASE + len(drivers) * (1 + k) + n, driver.route)
+            for n, driver in enumerate(drivers)
+            for k in range(per_driver)
+        ]
+        departure = timezone.localtime() + timedelta(days=1)
+
+        phases = [
+            ('регистрация водителей', drivers, lambda user: user.register("Я Водитель 🚕")),
+            ('регистрация пассажиров', passengers, lambda user: user.register("Я Пассажир 🧍")),
+            ('создание поездки', drivers, lambda user: user.create_trip(departure, per_driver + 1)),
+            ('поиск', passengers, lambda user: user.search(departure)),
+            ('бронирование', passengers, lambda user: user.book()),
+            ('завершение поездки', drivers, lambda user: user.complete()),
+            ('оценка', drivers + passengers, lambda user: user.rate()),
+        ]
+        self.stdout.write(f"БД: {connection.vendor}, водителей: {len(drivers)}, пассажиров: {len(passengers)}")
+        self.stdout.write(f"{'сценарий':>24} | {'апдейтов':>8} | {'апд/с':>7} | {'p50 мс':>7} | {'p95 мс':>7} | {'p99 мс':>7} | {'запросов на польз.':>18}")
+        total_started = time.perf_counter()
+        for name, users, flow in phases:
+            if name == 'создание поездки':
+                await asyncio.to_thread(verify_drivers, [driver.id for driver in drivers])
+            if name == 'оценка':
+                await harness.wait_for_rating_prompts()
+            queries_before = sum(metrics.queries.values())
+            harness.latencies = []
+            updates_before = harness.updates
+            started = time.perf_counter()
+            await harness.run_phase(users, flow)
+            elapsed = time.perf_counter() - started
+            updates = harness.updates - updates_before
+            queries = sum(metrics.queries.values()) - queries_before
+            latencies = harness.latencies or [0]
+            self.stdout.write(
+                f"{name:>24} | {updates:>8} | {updates / elapsed:>7.0f} | {percentile(latencies, 0.5) * 1000:>7.1f} | "
+                f"{percentile(latencies, 0.95) * 1000:>7.1f} | {percentile(latencies, 0.99) * 1000:>7.1f} | {queries / len(users):>18.1f}"
+            )
+        total_elapsed = time.perf_counter() - total_started
+        await harness.close()
+
+        self.stdout.write(f"\nВсего апдейтов: {harness.updates} за {total_elapsed:.1f} с ({harness.updates / total_elapsed:.0f} апд/с)")
+        self.stdout.write(f"\n{'обработчик':>28} | {'вызовов':>7} | {'p50 мс':>7} | {'p95 мс':>7} | {'p99 мс':>7} | {'запросов/вызов':>14} | {'ошибок':>6}")
+        for handler, samples in sorted(metrics.samples.items(), key=lambda item: -sum(item[1])):
+            self.stdout.write(
+                f"{handler:>28} | {len(samples):>7} | {percentile(samples, 0.5) * 1000:>7.1f} | {percentile(samples, 0.95) * 1000:>7.1f} | "
+                f"{percentile(samples, 0.99) * 1000:>7.1f} | {metrics.queries[handler] / len(samples):>14.1f} | {metrics.errors[handler]:>6}"
+            )
+        completed = await asyncio.to_thread(
+            Trip.objects.filter(driver__telegram_id__gte=TELEGRAM_ID_BASE, status=Trip.Status.COMPLETED).count
+        )
+        self.stdout.write(f"\nЗавершено поездок: {completed} из {len(drivers)}")
+        for error, count in harness.errors.most_common():
+            self.stdout.write(self.style.WARNING(f"Ошибка x{count}: {error}"))
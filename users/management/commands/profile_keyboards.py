@@ -0,0 +1,98 @@
+import gc
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from users.keyboards import (
+    FIND_TRIP_BTN, MY_BOOKINGS_BTN, TRIP_HISTORY_BTN, MY_PROFILE_BTN, SUPPORT_BTN, CHANGE_ROLE_BTN, BACK_TO_MENU_BTN,
+    MENU_MAIN, MENU_PROFILE, MENU_ROLE, BOOK_TRIP_BUTTONS, RATING_KEYBOARD, user_keyboard,
+)
+from users.models import User
+
+
+# Прежние варианты: клавиатура собиралась заново при каждом ответе
+def legacy_main_menu():
+    keyboard = [[FIND_TRIP_BTN], [MY_BOOKINGS_BTN, TRIP_HISTORY_BTN], [MY_PROFILE_BTN], [SUPPORT_BTN]]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+def legacy_profile():
+    return ReplyKeyboardMarkup([[CHANGE_ROLE_BTN], [BACK_TO_MENU_BTN]], resize_keyboard=True)
+
+
+def legacy_role_selector():
+    keyboard = [[KeyboardButton("Я Пассажир 🧍"), KeyboardButton("Я Водитель 🚕")]]
+    return ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+
+
+def legacy_book_buttons(trip_ids):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"✅ {number}", callback_data=f"book_trip_{trip_id}")
+        for number, trip_id in enumerate(trip_ids, start=1)
+    ]])
+
+
+def legacy_rating(trip_id, rater_id, rated_id):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"{i} ⭐", callback_data=f"rate_{trip_id}_{rater_id}_{rated_id}_{i}") for i in range(1, 6)
+    ]])
+
+
+def book_buttons(trip_ids):
+    row = []
+    for number, trip_id in enumerate(trip_ids, start=1):
+        row.extend(BOOK_TRIP_BUTTONS.row(number=number, trip=trip_id))
+    return InlineKeyboardMarkup([row])
+
+
+class Command(BaseCommand):
+    help = (
+        'Профилирует память (tracemalloc) при сборке клавиатур бота: сколько объектов '
+        'остается на один ответ пользователю в прежнем и новом варианте.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--updates', type=int, default=10_000, help='Сколько ответов имитировать на каждый случай')
+
+    def handle(self, *args, **options):
+        updates = options['updates']
+        passenger = User(language='ru', role=User.Role.PASSENGER)
+        trip_ids = list(range(101, 106))
+        cases = [
+            ('главное меню', lambda n: legacy_main_menu(), lambda n: user_keyboard(passenger, MENU_MAIN)),
+            ('профиль', lambda n: legacy_profile(), lambda n: user_keyboard(passenger, MENU_PROFILE)),
+            ('выбор роли', lambda n: legacy_role_selector(), lambda n: user_keyboard(passenger, MENU_ROLE)),
+            # Одна и та же выдача поиска у разных пассажиров
+            ('кнопки брони в поиске', lambda n: legacy_book_buttons(trip_ids), lambda n: book_buttons(trip_ids)),
+            # Каждый запрос оценки уникален: выигрыш только на разборе шаблона
+            (
+                'запрос оценки',
+                lambda n: legacy_rating(7, n, n + 1),
+                lambda n: RATING_KEYBOARD(trip=7, rater=n, rated=n + 1),
+            ),
+        ]
+        self.stdout.write(f"{'случай':>24} | {'прежний':>22} | {'новый':>22}")
+        for name, legacy, current in cases:
+            assert legacy(1).to_dict() == current(1).to_dict()
+            legacy_blocks, legacy_bytes = self.measure(legacy, updates)
+            current_blocks, current_bytes = self.measure(current, updates)
+            self.stdout.write(
+                f"{name:>24} | {legacy_blocks:>6.1f} об. {legacy_bytes:>7.0f} Б | {current_blocks:>6.1f} об. {current_bytes:>7.0f} Б"
+            )
+
+    @staticmethod
+    def measure(build, updates):
+        """Объекты и байты на один ответ, которые живут, пока сообщение не отправлено."""
+        build(0)  # прогрев кэшей
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        markups = [build(n) for n in range(updates)]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        blocks = sum(stat.count_diff for stat in stats)
+        size = sum(stat.size_diff for stat in stats)
+        del markups
+        return blocks / updates, size / updates
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.ratings import find_rating_mismatches, rebuild_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинг пользователей (сумма, количество, среднее) по таблице оценок.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='Только проверить, ничего не изменяя')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            mismatches = find_rating_mismatches(options['batch_size'])
+            for user in mismatches[:20]:
+                self.stdout.write(
+                    f"  {user}: ожидается сумма {user.rating_sum}, оценок {user.rating_count}, "
+                    f"среднее {user.average_rating:.2f}"
+                )
+            if mismatches:
+                raise CommandError(f"Расхождений: {len(mismatches)}. Запустите без --verify для исправления.")
+            self.stdout.write(self.style.SUCCESS("Рейтинги совпадают с таблицей оценок."))
+            return
+
+        fixed = rebuild_rating_aggregates(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Исправлено пользователей: {fixed}"))
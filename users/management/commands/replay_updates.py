@@ -0,0 +1,168 @@
+import asyncio
+import json
+import statistics
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qs
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Методы Bot API, ответ на которые считается "ответом бота" на апдейт
+REPLY_METHODS = {'sendmessage', 'editmessagetext', 'editmessagereplymarkup'}
+
+
+def update_chat_id(update):
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        query = update['callback_query']
+        return query.get('message', {}).get('chat', {}).get('id', query['from']['id'])
+    return None
+
+
+class BotApiStub:
+    """
+    Минимальная заглушка Bot API: отвечает {"ok": true} на любой метод
+    и фиксирует время ответов бота по chat_id.
+    """
+
+    def __init__(self):
+        self.waiting = defaultdict(deque)  # chat_id -> deque[(время отправки, future)]
+        self.calls = defaultdict(int)
+        self.message_id = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                method = request_line.split()[1].decode().rsplit('/', 1)[-1].lower()
+                status, response = self.respond(method, self.parse(headers, body))
+                payload = json.dumps(response).encode()
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'.encode()
+                    + f'Content-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    def parse(self, headers, body):
+        if 'json' in headers.get('content-type', ''):
+            return json.loads(body or b'{}')
+        params = {}
+        for key, values in parse_qs(body.decode()).items():
+            try:
+                params[key] = json.loads(values[0])
+            except ValueError:
+                params[key] = values[0]
+        return params
+
+    def respond(self, method, params):
+        return '200 OK', {'ok': True, 'result': self.result(method, params)}
+
+    def result(self, method, params):
+        self.calls[method] += 1
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        if method not in REPLY_METHODS:
+            return True
+        chat_id = params.get('chat_id')
+        pending = self.waiting.get(chat_id)
+        if pending:
+            sent_at, future = pending.popleft()
+            if not future.done():
+                future.set_result(time.perf_counter() - sent_at)
+        self.message_id += 1
+        return {
+            'message_id': params.get('message_id', self.message_id),
+            'date': int(time.time()),
+            'chat': {'id': chat_id or 0, 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        'Отправляет записанные апдейты (JSONL, по одному Update на строку) на вебхук бота '
+        'и измеряет задержку до ответа. Бот запускается так: '
+        'manage.py runbot --webhook --webhook-url <URL> --bot-api-url http://127.0.0.1:<stub-port>/bot'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='Файл с апдейтами в формате JSONL')
+        parser.add_argument('--url', default='http://127.0.0.1:8001/telegram/webhook/')
+        parser.add_argument('--secret', default=settings.BOT_WEBHOOK_SECRET)
+        parser.add_argument('--stub-port', type=int, default=8081, help='Порт заглушки Bot API')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Сколько ждать ответа бота, секунд')
+        parser.add_argument('--startup-timeout', type=float, default=60.0, help='Сколько ждать запуска бота (вызова setWebhook)')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['file'], encoding='utf-8') as f:
+                updates = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Не удалось прочитать апдейты: {e}")
+        asyncio.run(self.replay(updates, options))
+
+    async def replay(self, updates, options):
+        stub = BotApiStub()
+        server = await asyncio.start_server(stub.handle, '127.0.0.1', options['stub_port'])
+        by_chat = defaultdict(list)
+        for update in updates:
+            by_chat[update_chat_id(update)].append(update)
+
+        latencies = []
+        lost = 0
+        headers = {'X-Telegram-Bot-Api-Secret-Token': options['secret']}
+
+        async def replay_chat(chat_id, chat_updates):
+            # Апдейты одного чата идут строго по очереди, как от живого пользователя
+            nonlocal lost
+            for update in chat_updates:
+                future = asyncio.get_running_loop().create_future()
+                stub.waiting[chat_id].append((time.perf_counter(), future))
+                response = await client.post(options['url'], json=update, headers=headers)
+                if response.status_code != 200:
+                    raise CommandError(f"Вебхук ответил {response.status_code}")
+                try:
+                    latencies.append(await asyncio.wait_for(future, options['timeout']))
+                except asyncio.TimeoutError:
+                    lost += 1
+                    stub.waiting[chat_id].clear()
+
+        async with server, httpx.AsyncClient() as client:
+            # Бот при старте обращается к заглушке (getMe, setWebhook), поэтому его запускают после нее
+            self.stdout.write(f"Заглушка Bot API на порту {options['stub_port']}, жду запуска бота...")
+            deadline = time.monotonic() + options['startup_timeout']
+            while not stub.calls['setwebhook']:
+                if time.monotonic() > deadline:
+                    raise CommandError("Бот не вызвал setWebhook, проверьте --bot-api-url у runbot")
+                await asyncio.sleep(0.1)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(replay_chat(chat_id, items) for chat_id, items in by_chat.items()))
+            elapsed = time.perf_counter() - started
+
+        self.stdout.write(f"Апдейтов: {len(updates)}, чатов: {len(by_chat)}, без ответа: {lost}, время: {elapsed:.2f} с")
+        if latencies:
+            latencies.sort()
+            self.stdout.write(
+                f"Задержка апдейт -> ответ: p50 {statistics.median(latencies) * 1000:.1f} мс, "
+                f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} мс, "
+                f"max {latencies[-1] * 1000:.1f} мс"
+            )
+        self.stdout.write(f"Вызовы Bot API: {dict(stub.calls)}")
@@ -1,13 +1,15 @@
 import os
+import asyncio
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
-from asgiref.sync import sync_to_async
-from django.db import transaction, models, IntegrityError
+from django.db import IntegrityError
 
+from django.conf import settings
 from django.utils import timezone
 from django.core.management.base import BaseCommand
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -16,12 +18,39 @@ from telegram.ext import (
     filters,
     ContextTypes,
     CallbackQueryHandler,
-    PicklePersistence,
+    TypeHandler,
 )
 
+from users.db_executor import db_async, shutdown_db_executor
+from users.i18n import get_text
+from users.keyboards import (
+    FIND_TRIP_BTN, MY_BOOKINGS_BTN, CREATE_TRIP_BTN, MY_TRIPS_BTN, MY_PROFILE_BTN, SUPPORT_BTN,
+    CHANGE_ROLE_BTN, BACK_TO_MENU_BTN, CONFIRM_YES_BTN, CONFIRM_NO_BTN, TRIP_HISTORY_BTN,
+    LANGUAGE_BUTTONS, ROLE_BUTTONS,
+    MENU_MAIN, MENU_LANGUAGE, MENU_PHONE, MENU_ROLE, MENU_PROFILE, MENU_CONFIRM_ROLE, MENU_EDIT_TRIP,
+    user_keyboard, navigation_row,
+    RATING_KEYBOARD, CONTACT_PASSENGER_KEYBOARD, CONTACT_DRIVER_KEYBOARD, BOOK_TRIP_BUTTONS,
+    TRIP_ACTIONS_BUTTONS, VEHICLE_BUTTONS,
+)
+from users.metrics import (
+    configure_metrics, dump_metrics, dump_metrics_periodically, instrument_application, metrics, register_update_processor,
+    start_metrics_server, InstrumentedRequest,
+)
 from users.models import User
+from users.outbox import configure_outbox, get_outbox, stop_outbox
+from users.persistence import DjangoPersistence
+from users.ratings import add_rating
+from users.rate_limit import BotRateLimiter
+from users.update_processor import PerChatUpdateProcessor
+from users.webhook import register_application
+from users.user_cache import user_cache
 from trips.models import Vehicle, Trip, Booking, Rating
+from trips.booking import book_seats, create_hold, release_hold, release_expired_holds, set_available_seats
+from trips.gazetteer import resolve_city
+from trips.pagination import keyset_page, NEXT as PAGE_NEXT
+from trips.search import search_trips_page, SEARCH_ORDERINGS
 from support.models import SupportTicket
+from support.writer import configure_chat_writer, get_chat_writer, stop_chat_writer
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -29,119 +58,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Константы ---
-FIND_TRIP_BTN = "Найти поездку 🔍"
-MY_BOOKINGS_BTN = "Мои бронирования 🗒️"
-CREATE_TRIP_BTN = "Создать поездку ➕"
-MY_TRIPS_BTN = "Мои поездки 🚕"
-MY_PROFILE_BTN = "Мой профиль 👤"
-SUPPORT_BTN = "Поддержка 💬"
-CHANGE_ROLE_BTN = "Смена роли ✏️"
-BACK_TO_MENU_BTN = "⬅️ Назад в главное меню"
-CONFIRM_YES_BTN = "Да, сменить"
-CONFIRM_NO_BTN = "Нет, отмена"
-TRIP_HISTORY_BTN = "История поездок 📜"  # Новая кнопка
+# Подписи кнопок и клавиатуры меню лежат в users/keyboards.py
 
 # --- Система локализации ---
-TRANSLATIONS = {
-    'ru': {
-        'select_language': "Пожалуйста, выберите ваш язык:",
-        'share_phone': "Спасибо! Теперь, пожалуйста, поделитесь вашим номером телефона.",
-        'select_role': "Отлично! Кем вы будете в нашем сервисе?",
-        'driver_pending': "Спасибо! Ваша заявка на роль водителя принята и отправлена на проверку. Мы сообщим вам, когда она будет одобрена.",
-        'registration_complete': "Поздравляем! 🎉 Регистрация успешно завершена!",
-        'profile_menu': "👤 Ваш профиль:\n\n<b>Имя:</b> {name}\n<b>Телефон:</b> {phone}\n<b>Роль:</b> {role}\n<b>Рейтинг:</b> {rating}",
-        'change_role_confirm': "Вы уверены, что хотите сменить вашу роль с <b>{current}</b> на <b>{new}</b>?",
-        'role_changed': "Ваша роль успешно изменена!",
-        'role_change_cancelled': "Смена роли отменена.",
-        'no_vehicles': "У вас еще нет добавленных автомобилей. Давайте сначала добавим ваш транспорт.\n\nВведите марку автомобиля (например, Kia):",
-        'select_vehicle': "Выберите автомобиль для поездки:",
-        'vehicle_selected': "Автомобиль выбран. Теперь начнем создание поездки.",
-        'enter_departure': "Откуда вы отправляетесь? (например, Краснодар)",
-        'enter_destination': "Куда вы поедете? (например, Москва)",
-        'enter_time': "Когда? Введите дату и время отправления в формате ДД.ММ.ГГГГ ЧЧ:ММ (например, 15.09.2025 18:00)",
-        'enter_seats': "Сколько свободных мест для пассажиров? (введите число)",
-        'enter_price': "Укажите цену за одно место в рублях (введите число):",
-        'trip_created': "✅ Поездка успешно создана!\n\n<b>Маршрут:</b> {departure} → {destination}\n<b>Время:</b> {time}\n<b>Авто:</b> {vehicle}\n<b>Мест:</b> {seats}\n<b>Цена:</b> {price} руб./место",
-        'invalid_time_past': "Нельзя создавать поездки в прошлом. Пожалуйста, введите будущую дату и время.",
-        'invalid_format_time': "Неверный формат. Пожалуйста, введите дату и время в формате ДД.ММ.ГГГГ ЧЧ:ММ",
-        'invalid_seats': "Пожалуйста, введите целое положительное число от 1 до 7.",
-        'invalid_price': "Пожалуйста, введите положительное число не менее 50.",
-        'vehicle_added': "Автомобиль {brand} {model} ({plate}) успешно добавлен!\n\nТеперь давайте создадим поездку.\nОткуда вы отправляетесь? (например, Краснодар)",
-        'find_trip_start': "Начинаем поиск поездки. Откуда вы хотите поехать? (например, Москва)",
-        'find_trip_destination': "Куда вы хотите поехать? (например, Санкт-Петербург)",
-        'find_trip_date': "На какую дату ищем? Введите в формате ДД.ММ.ГГГГ (например, 25.12.2025)",
-        'searching_trips': "Ищу поездки из г. {departure} в г. {destination} на {date}...",
-        'no_trips_found': "К сожалению, на эту дату поездок не найдено. Попробуйте поискать на другую дату.",
-        'trips_found': "Вот что удалось найти:",
-        'trip_info': "<b>Водитель:</b> {driver} ({rating})\n<b>Маршрут:</b> {dep} → {dest}\n<b>Время:</b> {time}\n<b>Авто:</b> {vehicle}\n<b>Свободных мест:</b> {seats}\n<b>Цена:</b> {price} руб.",
-        'invalid_date_format': "Неверный формат. Пожалуйста, введите дату в формате ДД.ММ.ГГГГ",
-        'book_trip_unavailable': "Извините, эта поездка уже недоступна, завершена или все места заняты.",
-        'select_seats_for_booking': "Вы выбрали поездку {dep} - {dest}.\n\nСколько мест вы хотите забронировать? (Свободно: {seats})",
-        'invalid_seats_booking': "Пожалуйста, введите целое положительное число.",
-        'booking_error': "Ошибка бронирования: {error}",
-        'booking_success': "✅ Поздравляем! Вы успешно забронировали {seats} мест(а)!\nОбщая стоимость: {cost} руб.",
-        'driver_notification': "🔔 Новое бронирование!\n\nПассажир: {passenger} ({phone})\nЗабронировал(а) мест: {seats}\nПоездка: {trip}",
-        'no_trips': "У вас пока нет созданных поездок.",
-        'my_trips': "Ваши активные поездки:",
-        'no_active_trips': "У вас нет активных поездок для управления.",
-        'trip_active_info': "<b>📍 Активна</b>\n<b>Маршрут:</b> {dep} → {dest}\n<b>Время:</b> {time}\n<b>Свободных мест:</b> {seats}\n<b>Цена:</b> {price} руб./место",
-        'trip_completed': "Поездка {trip} завершена.",
-        'trip_cancelled': "Поездка {trip} отменена.",
-        'trip_not_found': "Не удалось найти поездку.",
-        'no_bookings': "У вас пока нет активных бронирований.",
-        'my_bookings': "Ваши активные бронирования:",
-        'booking_info': "<b>Маршрут:</b> {dep} → {dest}\n<b>Время:</b> {time}\n<b>Водитель:</b> {driver}, тел: {phone}\n<b>Авто:</b> {vehicle}\n<b>Забронировано мест:</b> {seats}\n<b>Общая стоимость:</b> {cost} руб.",
-        'no_history': "У вас нет поездок в истории.",
-        'trip_history': "История ваших поездок:",
-        'history_completed': "✅ Завершена",
-        'history_cancelled': "❌ Отменена",
-        'history_trip_info': "<b>{status}</b>\n<b>Маршрут:</b> {dep} → {dest}\n<b>Время:</b> {time}\n<b>Авто:</b> {vehicle}\n<b>Мест:</b> {seats}\n<b>Цена:</b> {price} руб./место",
-        'history_booking_info': "<b>{status}</b>\n<b>Маршрут:</b> {dep} → {dest}\n<b>Время:</b> {time}\n<b>Водитель:</b> {driver}, тел: {phone}\n<b>Авто:</b> {vehicle}\n<b>Забронировано мест:</b> {seats}\n<b>Общая стоимость:</b> {cost} руб.",
-        'select_field_to_edit': "Что вы хотите изменить?",
-        'enter_new_value': "Пожалуйста, введите {prompt}:",
-        'invalid_value': "Неверный формат. Пожалуйста, попробуйте еще раз.",
-        'past_date_error': "Нельзя установить дату в прошлом. Попробуйте еще раз.",
-        'edit_success': "✅ Данные поездки успешно обновлены!",
-        'edit_error': "Ошибка: данные для редактирования не найдены.",
-        'support_start': "Опишите вашу проблему или вопрос одним сообщением. Мы сохраним ваше обращение, и администратор свяжется с вами.",
-        'support_message_too_long': "Ваше сообщение слишком длинное (максимум 1000 символов). Пожалуйста, сократите его.",
-        'support_submitted': "Спасибо! Ваше обращение принято. Администратор скоро его рассмотрит.",
-        'rate_driver': "Поездка с водителем {driver} завершена. Пожалуйста, оцените его:",
-        'rate_passenger': "Пожалуйста, оцените поездку с пассажиром {passenger}:",
-        'rating_thanks': "Спасибо! Вы поставили оценку {score} ⭐ пользователю {user}.",
-        'already_rated': "Вы уже оценили этого пользователя за эту поездку.",
-        'chat_started': "Вы вошли в чат с {role} {name}.\nВсе, что вы напишете, будет переслано. Чтобы выйти, отправьте /cancel.",
-        'chat_error': "Ошибка: бронирование не найдено.",
-        'not_participant': "Ошибка: вы не участник этого бронирования.",
-        'chat_not_initialized': "Ошибка: чат не инициализирован.",
-        'message_too_long': "Сообщение слишком длинное (максимум 1000 символов). Пожалуйста, сократите его.",
-        'message_sent': "Сообщение отправлено!",
-        'chat_cancelled': "Чат завершен.",
-        'action_cancelled': "Действие отменено.",
-        'unverified_driver': "Ваш аккаунт водителя еще не прошел проверку. Пожалуйста, дождитесь одобрения от администрации.",
-        'critical_error_vehicle': "Критическая ошибка: автомобиль не найден по ID. Пожалуйста, попробуйте создать поездку заново.",
-        'conflict_error': "Этот автомобиль уже используется в другой активной поездке в указанное время.",
-        'invalid_language': "Пожалуйста, выберите язык с помощью кнопок.",
-        'welcome_back': "С возвращением, {name}!",
-        'passenger_menu': "Меню пассажира:",
-        'driver_menu': "Меню водителя:",
-    },
-    'uz': {
-        # Здесь добавить переводы на узбекский, для примера оставим заглушки
-        'select_language': "Iltimos, tilingizni tanlang:",
-        # ... и так далее для всех ключей
-    },
-    'tj': {
-        # Здесь добавить переводы на таджикский
-        'select_language': "Лутфан, забонро интихоб кунед:",
-        # ... и так далее
-    }
-}
-
-def get_text(user, key, **kwargs):
-    lang = user.language if user and user.language in TRANSLATIONS else 'ru'
-    text = TRANSLATIONS[lang].get(key, TRANSLATIONS['ru'][key])
-    return text.format(**kwargs) if kwargs else text
+# Тексты лежат в users/locale/<язык>.json и загружаются один раз при импорте (users/i18n.py)
 
 # --- Состояния ---
 (
@@ -170,31 +90,48 @@ def get_text(user, key, **kwargs):
     EDIT_TRIP_ENTERING_VALUE,
     IN_CHAT,
     TRIP_HISTORY,  # Новое состояние
-) = range(25)
+    SUPPORT_CHAT,
+) = range(26)
+# Имена состояний для метрик переходов (все целые константы выше - состояния)
+STATE_NAMES = {value: name for name, value in list(globals().items()) if name.isupper() and type(value) is int}
 
 # --- Функции для работы с БД (users) ---
 def get_user(telegram_id):
+    user = user_cache.get(telegram_id)
+    if user is not None:
+        return user
     try:
-        return User.objects.get(telegram_id=telegram_id)
+        user = User.objects.get(telegram_id=telegram_id)
     except User.DoesNotExist:
         return None
+    user_cache.set(user)
+    return user
 
 def create_user(telegram_id, name):
-    return User.objects.create(telegram_id=telegram_id, name=name, username=f'user_{telegram_id}')
+    user = User.objects.create(telegram_id=telegram_id, name=name, username=f'user_{telegram_id}')
+    user_cache.set(user)
+    return user
 
+# Пользователь из кэша может быть устаревшим на BOT_USER_CACHE_TTL: сохраняются только
+# измененные поля, чтобы не затереть рейтинг и проверку, записанные за это время другими
 def update_user_language(user, language_code):
     user.language = language_code
-    user.save()
+    user.save(update_fields=['language'])
+    user_cache.invalidate(user.telegram_id)
 
 def update_user_phone(user, phone_number):
     user.phone_number = phone_number
-    user.save()
+    user.save(update_fields=['phone_number'])
+    user_cache.invalidate(user.telegram_id)
 
 def update_user_role(user, role):
     user.role = role
+    update_fields = ['role']
     if role == User.Role.DRIVER:
         user.verification_status = User.VerificationStatus.PENDING
-    user.save()
+        update_fields.append('verification_status')
+    user.save(update_fields=update_fields)
+    user_cache.invalidate(user.telegram_id)
 
 # --- Функции для работы с БД (trips & ratings) ---
 def get_vehicles_for_driver(driver):
@@ -224,14 +161,16 @@ def create_trip(driver, vehicle, departure, destination, time, seats, price):
     
     return Trip.objects.create(
         driver=driver, vehicle=vehicle, departure_location=departure, destination_location=destination,
+        departure_city_id=resolve_city(departure), destination_city_id=resolve_city(destination),
         departure_time=aware_time, available_seats=seats, price=price
     )
 
-def find_trips(departure, destination, search_date):
-    return list(Trip.objects.filter(
-        departure_location__icontains=departure, destination_location__icontains=destination,
-        departure_time__date=search_date, departure_time__gte=timezone.now(), status=Trip.Status.ACTIVE
-    ).select_related('driver', 'vehicle'))
+def find_trips_page(search, cursor=None, direction=PAGE_NEXT):
+    search_date = datetime.strptime(search['date'], '%Y-%m-%d').date()
+    return search_trips_page(
+        search['departure'], search['destination'], search_date, search['sort'],
+        settings.BOT_LIST_PAGE_SIZE, cursor, direction,
+    )
 
 def get_trip_by_id(trip_id):
     try:
@@ -245,104 +184,128 @@ def get_booking_by_id(booking_id):
     except Booking.DoesNotExist:
         return None
 
-@transaction.atomic
-def create_booking(passenger, trip, seats_to_book):
-    trip_for_update = Trip.objects.select_for_update().get(id=trip.id)
-    if trip_for_update.status != Trip.Status.ACTIVE:
-        return None, "booking_unavailable"
-    if trip_for_update.available_seats >= seats_to_book:
-        trip_for_update.available_seats -= seats_to_book
-        trip_for_update.save()
-        booking = Booking.objects.create(passenger=passenger, trip=trip_for_update, seats_booked=seats_to_book)
-        return booking, None
-    else:
-        error_message = f"Недостаточно мест. Осталось только {trip_for_update.available_seats}."
-        return None, error_message
+def create_booking(passenger, trip, seats_to_book, hold_id=None):
+    # Места списываются условным UPDATE, без select_for_update на строку поездки
+    return book_seats(passenger, trip, seats_to_book, hold_id=hold_id)
 
-def get_trips_for_driver(driver):
-    return list(driver.trips_as_driver.select_related('vehicle').prefetch_related('bookings__passenger').order_by('-departure_time'))
+def get_driver_trips_page(driver, statuses, cursor=None, direction=PAGE_NEXT):
+    trips = Trip.objects.filter(driver=driver, status__in=statuses).select_related('vehicle')
+    return keyset_page(trips, 'departure_time', settings.BOT_LIST_PAGE_SIZE, cursor, direction)
 
-def get_bookings_for_passenger(passenger, active_only=True):
-    query = passenger.bookings_as_passenger.select_related('trip__driver', 'trip__vehicle').order_by('-trip__departure_time')
-    if active_only:
-        query = query.filter(trip__status=Trip.Status.ACTIVE)
-    return list(query)
+def get_passenger_bookings_page(passenger, statuses, cursor=None, direction=PAGE_NEXT):
+    bookings = Booking.objects.filter(passenger=passenger, trip__status__in=statuses).select_related('trip__driver', 'trip__vehicle')
+    return keyset_page(bookings, 'trip__departure_time', settings.BOT_LIST_PAGE_SIZE, cursor, direction)
+
+def driver_has_trips(driver):
+    return Trip.objects.filter(driver=driver).exists()
 
 def update_trip_status(trip_id, new_status):
     try:
         trip = Trip.objects.get(id=trip_id)
-        trip.status = new_status
-        trip.save()
-        return trip
     except Trip.DoesNotExist:
         return None
+    trip.status = new_status
+    # Только статус: полный save() записал бы прочитанное available_seats поверх
+    # мест, списанных за это время условным UPDATE в reserve_seats
+    trip.save(update_fields=['status'])
+    return trip
 
-@transaction.atomic
 def add_rating_and_update_user(rater, rated_user, trip, score):
     try:
-        Rating.objects.create(rater=rater, rated_user=rated_user, trip=trip, score=score)
+        add_rating(rater, rated_user, trip, score)
     except IntegrityError:
         logger.warning(f"Attempt to add duplicate rating by {rater.id} for {rated_user.id} on trip {trip.id}")
         raise
-    user_to_update = User.objects.select_for_update().get(id=rated_user.id)
-    all_ratings = user_to_update.received_ratings.all()
-    new_rating_count = all_ratings.count()
-    new_average = all_ratings.aggregate(models.Avg('score'))['score__avg']
-    user_to_update.rating_count = new_rating_count
-    user_to_update.average_rating = new_average
-    user_to_update.save()
+
+def get_pending_rating_pairs(trip):
+    """
+    Пары (кто оценивает, кого оценивают) по поездке, для которых оценки еще нет:
+    водитель -> каждый пассажир и каждый пассажир -> водитель.
+    Бронирования с пассажирами уже подгружены в get_trip_by_id, оценки читаются одним запросом.
+    """
+    driver = trip.driver
+    passengers = {booking.passenger.id: booking.passenger for booking in trip.bookings.all()}
+    existing = set(Rating.objects.filter(trip=trip).values_list('rater_id', 'rated_user_id'))
+    pairs = [(driver, passenger) for passenger in passengers.values()]
+    pairs += [(passenger, driver) for passenger in passengers.values()]
+    return [(rater, rated) for rater, rated in pairs if (rater.id, rated.id) not in existing]
 
 def create_support_ticket(user, message):
     return SupportTicket.objects.create(user=user, message=message)
     
 def update_trip_field(trip_id, field, value):
+    if field == 'available_seats':
+        # Удержанные места уже вычтены и вернутся по истечении удержаний
+        set_available_seats(trip_id, value)
+        return Trip.objects.get(id=trip_id)
     trip = Trip.objects.get(id=trip_id)
     if field == 'departure_time':
         value = timezone.make_aware(value, timezone.get_current_timezone())
     setattr(trip, field, value)
-    trip.save()
+    # Как и в update_trip_status, пишется только измененное поле
+    update_fields = [field]
+    if field in ('departure_location', 'destination_location'):
+        side = field.split('_')[0]
+        setattr(trip, f'{side}_city_id', resolve_city(value))
+        update_fields += [f'{side}_normalized', f'{side}_city']
+    trip.save(update_fields=update_fields)
     return trip
 
 # --- Асинхронные "обертки" ---
-get_user_async = sync_to_async(get_user, thread_sensitive=True)
-create_user_async = sync_to_async(create_user, thread_sensitive=True)
-update_user_language_async = sync_to_async(update_user_language, thread_sensitive=True)
-update_user_phone_async = sync_to_async(update_user_phone, thread_sensitive=True)
-update_user_role_async = sync_to_async(update_user_role, thread_sensitive=True)
-get_vehicles_for_driver_async = sync_to_async(get_vehicles_for_driver, thread_sensitive=True)
-add_vehicle_async = sync_to_async(add_vehicle, thread_sensitive=True)
-get_vehicle_by_id_async = sync_to_async(get_vehicle_by_id, thread_sensitive=True)
-create_trip_async = sync_to_async(create_trip, thread_sensitive=True)
-find_trips_async = sync_to_async(find_trips, thread_sensitive=True)
-get_trip_by_id_async = sync_to_async(get_trip_by_id, thread_sensitive=True)
-create_booking_async = sync_to_async(create_booking, thread_sensitive=True)
-get_trips_for_driver_async = sync_to_async(get_trips_for_driver, thread_sensitive=True)
-get_bookings_for_passenger_async = sync_to_async(get_bookings_for_passenger, thread_sensitive=True)
-create_support_ticket_async = sync_to_async(create_support_ticket, thread_sensitive=True)
-update_trip_status_async = sync_to_async(update_trip_status, thread_sensitive=True)
-add_rating_and_update_user_async = sync_to_async(add_rating_and_update_user, thread_sensitive=True)
-update_trip_field_async = sync_to_async(update_trip_field, thread_sensitive=True)
-get_booking_by_id_async = sync_to_async(get_booking_by_id, thread_sensitive=True)
+get_user_async = db_async(get_user)
+create_user_async = db_async(create_user)
+update_user_language_async = db_async(update_user_language)
+update_user_phone_async = db_async(update_user_phone)
+update_user_role_async = db_async(update_user_role)
+get_vehicles_for_driver_async = db_async(get_vehicles_for_driver)
+add_vehicle_async = db_async(add_vehicle)
+get_vehicle_by_id_async = db_async(get_vehicle_by_id)
+create_trip_async = db_async(create_trip)
+find_trips_page_async = db_async(find_trips_page)
+get_trip_by_id_async = db_async(get_trip_by_id)
+create_booking_async = db_async(create_booking)
+create_hold_async = db_async(create_hold)
+release_hold_async = db_async(release_hold)
+release_expired_holds_async = db_async(release_expired_holds)
+get_driver_trips_page_async = db_async(get_driver_trips_page)
+get_passenger_bookings_page_async = db_async(get_passenger_bookings_page)
+driver_has_trips_async = db_async(driver_has_trips)
+create_support_ticket_async = db_async(create_support_ticket)
+update_trip_status_async = db_async(update_trip_status)
+add_rating_and_update_user_async = db_async(add_rating_and_update_user)
+get_pending_rating_pairs_async = db_async(get_pending_rating_pairs)
+update_trip_field_async = db_async(update_trip_field)
+get_booking_by_id_async = db_async(get_booking_by_id)
+
+# --- Пользователь текущего апдейта ---
+async def load_current_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Выполняется в группе -1 перед всеми обработчиками: загружает пользователя
+    один раз на апдейт и кладет его в context.db_user.
+    """
+    if update.effective_user:
+        context.db_user = await get_user_async(update.effective_user.id)
+
+async def get_current_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = getattr(context, 'db_user', None)
+    if user is None:
+        user = await get_user_async(update.effective_user.id)
+        context.db_user = user
+    return user
 
 # --- Основные обработчики ---
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     if not user or not user.role:
         return await start_registration(update, context)
 
     menu_text = get_text(user, 'passenger_menu' if user.role == User.Role.PASSENGER else 'driver_menu')
-    if user.role == User.Role.PASSENGER:
-        keyboard = [[FIND_TRIP_BTN], [MY_BOOKINGS_BTN, TRIP_HISTORY_BTN], [MY_PROFILE_BTN], [SUPPORT_BTN]]
-    elif user.role == User.Role.DRIVER:
-        keyboard = [[CREATE_TRIP_BTN], [MY_TRIPS_BTN, TRIP_HISTORY_BTN], [MY_PROFILE_BTN], [SUPPORT_BTN]]
-        
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text(menu_text, reply_markup=reply_markup)
+    await update.message.reply_text(menu_text, reply_markup=user_keyboard(user, MENU_MAIN))
     return MAIN_MENU
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     telegram_user = update.effective_user
-    user = await get_user_async(telegram_user.id)
+    user = await get_current_user(update, context)
     if user and user.role:
         welcome_text = get_text(user, 'welcome_back', name=telegram_user.first_name)
         await update.message.reply_text(welcome_text)
@@ -354,62 +317,54 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     user_name = update.effective_user.full_name
-    user = await get_user_async(user_id)
+    user = await get_current_user(update, context)
     if not user:
-        await create_user_async(user_id, user_name)
-    user = await get_user_async(user_id)  # Refresh user
+        user = await create_user_async(user_id, user_name)
+        context.db_user = user
     # Автоматическое определение языка, если не выбран
     if not user.language:
         lang_code = update.effective_user.language_code
         if lang_code in ['ru', 'uz', 'tg']:  # tg for Tajik
             await update_user_language_async(user, lang_code)
     
-    keyboard = [[KeyboardButton("Русский 🇷🇺"), KeyboardButton("O'zbekcha 🇺🇿"), KeyboardButton("Тоҷикӣ 🇹🇯")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
     lang_text = get_text(user, 'select_language')
-    await update.message.reply_text(lang_text, reply_markup=reply_markup)
+    await update.message.reply_text(lang_text, reply_markup=user_keyboard(user, MENU_LANGUAGE))
     return SELECTING_LANGUAGE
 
 async def select_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    language_map = {"Русский 🇷🇺": "ru", "O'zbekcha 🇺🇿": "uz", "Тоҷикӣ 🇹🇯": "tj"}
-    language_code = language_map.get(update.message.text)
+    language_code = LANGUAGE_BUTTONS.get(update.message.text)
     if not language_code:
-        user = await get_user_async(update.effective_user.id)
+        user = await get_current_user(update, context)
         lang_text = get_text(user, 'invalid_language')
         await update.message.reply_text(lang_text)
         return SELECTING_LANGUAGE
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     await update_user_language_async(user, language_code)
-    keyboard = [[KeyboardButton("📱 Отправить мой номер телефона", request_contact=True)]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
     phone_text = get_text(user, 'share_phone')
-    await update.message.reply_text(phone_text, reply_markup=reply_markup)
+    await update.message.reply_text(phone_text, reply_markup=user_keyboard(user, MENU_PHONE))
     return REQUESTING_PHONE
 
 async def request_phone_number(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     contact = update.message.contact
     if not contact:
-        user = await get_user_async(update.effective_user.id)
+        user = await get_current_user(update, context)
         phone_text = get_text(user, 'share_phone')
         await update.message.reply_text(phone_text)
         return REQUESTING_PHONE
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     await update_user_phone_async(user, contact.phone_number)
-    keyboard = [[KeyboardButton("Я Пассажир 🧍"), KeyboardButton("Я Водитель 🚕")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
     role_text = get_text(user, 'select_role')
-    await update.message.reply_text(role_text, reply_markup=reply_markup)
+    await update.message.reply_text(role_text, reply_markup=user_keyboard(user, MENU_ROLE))
     return SELECTING_ROLE
 
 async def select_role(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    role_map = {"Я Пассажир 🧍": User.Role.PASSENGER, "Я Водитель 🚕": User.Role.DRIVER}
-    role = role_map.get(update.message.text)
+    role = ROLE_BUTTONS.get(update.message.text)
     if not role:
-        user = await get_user_async(update.effective_user.id)
+        user = await get_current_user(update, context)
         role_text = get_text(user, 'select_role')
         await update.message.reply_text(role_text)
         return SELECTING_ROLE
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     await update_user_role_async(user, role)
     
     if role == User.Role.DRIVER:
@@ -423,33 +378,29 @@ async def select_role(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 # --- Профиль ---
 async def my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     role_text = user.get_role_display()
     rating_text = f"{user.average_rating:.1f} ⭐ ({user.rating_count} оценок)"
     profile_text = get_text(user, 'profile_menu', name=user.name, phone=user.phone_number, role=role_text, rating=rating_text)
-    keyboard = [[CHANGE_ROLE_BTN], [BACK_TO_MENU_BTN]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text(profile_text, parse_mode='HTML', reply_markup=reply_markup)
+    await update.message.reply_text(profile_text, parse_mode='HTML', reply_markup=user_keyboard(user, MENU_PROFILE))
     return PROFILE_MENU
 
 async def change_role(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     current_role_text = user.get_role_display()
     new_role_text = "Водитель" if user.role == User.Role.PASSENGER else "Пассажир"
     confirm_text = get_text(user, 'change_role_confirm', current=current_role_text, new=new_role_text)
-    keyboard = [[CONFIRM_YES_BTN, CONFIRM_NO_BTN]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(confirm_text, parse_mode='HTML', reply_markup=reply_markup)
+    await update.message.reply_text(confirm_text, parse_mode='HTML', reply_markup=user_keyboard(user, MENU_CONFIRM_ROLE))
     return CONFIRMING_ROLE_CHANGE
 
 async def confirm_role_change(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     answer = update.message.text
     if answer == CONFIRM_NO_BTN:
-        user = await get_user_async(update.effective_user.id)
+        user = await get_current_user(update, context)
         cancel_text = get_text(user, 'role_change_cancelled')
         await update.message.reply_text(cancel_text)
         return await my_profile(update, context)
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     new_role = User.Role.DRIVER if user.role == User.Role.PASSENGER else User.Role.PASSENGER
     await update_user_role_async(user, new_role)
     changed_text = get_text(user, 'role_changed')
@@ -458,7 +409,7 @@ async def confirm_role_change(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # --- Создание поездки ---
 async def create_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     
     if user.verification_status != User.VerificationStatus.VERIFIED:
         unverified_text = get_text(user, 'unverified_driver')
@@ -474,8 +425,7 @@ async def create_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return ADD_VEHICLE_ENTERING_BRAND
 
-    keyboard = [[InlineKeyboardButton(str(v), callback_data=f"select_vehicle_{v.id}")] for v in vehicles]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = InlineKeyboardMarkup([VEHICLE_BUTTONS.row(vehicle=v, id=v.id) for v in vehicles])
     select_vehicle_text = get_text(user, 'select_vehicle')
     await update.message.reply_text(select_vehicle_text, reply_markup=reply_markup)
     return SELECTING_VEHICLE
@@ -487,7 +437,7 @@ async def trip_select_vehicle(update: Update, context: ContextTypes.DEFAULT_TYPE
     vehicle_id = int(query.data.split("_")[-1])
     context.user_data['selected_vehicle_id'] = vehicle_id
     
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     selected_text = get_text(user, 'vehicle_selected')
     await query.edit_message_text(text=selected_text)
     departure_text = get_text(user, 'enter_departure')
@@ -500,7 +450,7 @@ async def trip_select_vehicle(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def add_vehicle_brand(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['vehicle_brand'] = update.message.text
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     model_prompt = "Отлично! Теперь введите модель (например, Rio):"  # Можно локализовать
     await update.message.reply_text(model_prompt)
     return ADD_VEHICLE_ENTERING_MODEL
@@ -512,7 +462,7 @@ async def add_vehicle_model(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ADD_VEHICLE_ENTERING_PLATE
 
 async def add_vehicle_plate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     brand = context.user_data.get('vehicle_brand')
     model = context.user_data.get('vehicle_model')
     plate = update.message.text
@@ -529,20 +479,20 @@ async def add_vehicle_plate(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def trip_enter_departure(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['trip_departure'] = update.message.text
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     destination_text = get_text(user, 'enter_destination')
     await update.message.reply_text(destination_text)
     return CREATE_TRIP_ENTERING_DESTINATION
 
 async def trip_enter_destination(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['trip_destination'] = update.message.text
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     time_text = get_text(user, 'enter_time')
     await update.message.reply_text(time_text)
     return CREATE_TRIP_ENTERING_TIME
 
 async def trip_enter_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     try:
         time_obj = datetime.strptime(update.message.text, '%d.%m.%Y %H:%M')
         if time_obj < datetime.now():
@@ -560,7 +510,7 @@ async def trip_enter_time(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return CREATE_TRIP_ENTERING_SEATS
 
 async def trip_enter_seats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     try:
         seats = int(update.message.text)
         if seats <= 0 or seats > 7:
@@ -576,7 +526,7 @@ async def trip_enter_seats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return CREATE_TRIP_ENTERING_PRICE
 
 async def trip_enter_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     try:
         price = float(update.message.text)
         if price < 50:
@@ -614,7 +564,7 @@ async def trip_enter_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 # --- Поиск поездки ---
 async def find_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     start_text = get_text(user, 'find_trip_start')
     await update.message.reply_text(
         start_text,
@@ -624,20 +574,20 @@ async def find_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def find_trip_enter_departure(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['find_departure'] = update.message.text
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     dest_text = get_text(user, 'find_trip_destination')
     await update.message.reply_text(dest_text)
     return FIND_TRIP_ENTERING_DESTINATION
 
 async def find_trip_enter_destination(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['find_destination'] = update.message.text
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     date_text = get_text(user, 'find_trip_date')
     await update.message.reply_text(date_text)
     return FIND_TRIP_ENTERING_DATE
 
 async def find_trip_enter_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     try:
         search_date_obj = datetime.strptime(update.message.text, '%d.%m.%Y').date()
     except ValueError:
@@ -651,27 +601,70 @@ async def find_trip_enter_date(update: Update, context: ContextTypes.DEFAULT_TYP
     searching_text = get_text(user, 'searching_trips', departure=departure, destination=destination, date=update.message.text)
     await update.message.reply_text(searching_text)
 
-    trips = await find_trips_async(departure, destination, search_date_obj)
+    # Параметры поиска хранятся в user_data, в callback_data - только номер поиска и курсор
+    previous = context.user_data.get('search')
+    search = {
+        'id': previous['id'] + 1 if previous else 1,
+        'departure': departure,
+        'destination': destination,
+        'date': search_date_obj.isoformat(),
+        'sort': 'time',
+    }
+    context.user_data['search'] = search
+    page = await find_trips_page_async(search)
 
-    if not trips:
+    if not page[0]:
         no_trips_text = get_text(user, 'no_trips_found')
         await update.message.reply_text(no_trips_text)
         return await show_main_menu(update, context)
 
-    found_text = get_text(user, 'trips_found')
-    await update.message.reply_text(found_text)
-    for trip in trips:
+    text, reply_markup = render_search_page(user, search, page)
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
+    return MAIN_MENU
+
+def render_search_page(user, search, page):
+    """Одна страница результатов поиска: поездки, кнопки брони, сортировка и листание."""
+    trips = page[0]
+    items = [get_text(user, 'trips_found')]
+    book_buttons = []
+    for number, trip in enumerate(trips, start=1):
         driver = trip.driver
         rating_text = f"{driver.average_rating:.1f} ⭐ ({driver.rating_count} оценок)"
-        dep = trip.departure_location
-        dest = trip.destination_location
-        time_str = trip.departure_time.strftime('%d.%m.%Y в %H:%M')
-        info_text = get_text(user, 'trip_info', driver=driver.name, rating=rating_text, dep=dep, dest=dest, time=time_str, vehicle=trip.vehicle, seats=trip.available_seats, price=trip.price)
-        keyboard = [[InlineKeyboardButton("✅ Забронировать", callback_data=f"book_trip_{trip.id}")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(info_text, parse_mode='HTML', reply_markup=reply_markup)
-    
-    return MAIN_MENU
+        items.append(f"{number}. " + get_text(user, 'trip_info', driver=driver.name, rating=rating_text, dep=trip.departure_location, dest=trip.destination_location, time=format_trip_time(trip), vehicle=trip.vehicle, seats=trip.available_seats, price=trip.price))
+        book_buttons.extend(BOOK_TRIP_BUTTONS.row(number=number, trip=trip.id))
+
+    prefix = f"search_{search['id']}_{search['sort']}"
+    keyboard = [book_buttons]
+    keyboard.append([
+        InlineKeyboardButton(get_text(user, f'search_sort_{sort}'), callback_data=f"search_{search['id']}_{sort}")
+        for sort in SEARCH_ORDERINGS if sort != search['sort']
+    ])
+    navigation = navigation_row(prefix, page)
+    if navigation:
+        keyboard.append(navigation)
+    return "\n\n".join(items), InlineKeyboardMarkup(keyboard)
+
+async def handle_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Листание и смена сортировки результатов поиска в том же сообщении."""
+    query = update.callback_query
+    await query.answer()
+    user = await get_current_user(update, context)
+    # search_<номер>_<сортировка>[_<n|p>_<курсор>]
+    parts = query.data.split('_', 4)
+    search = context.user_data.get('search')
+    if not search or search['id'] != int(parts[1]) or parts[2] not in SEARCH_ORDERINGS:
+        await query.edit_message_text(get_text(user, 'search_expired'))
+        return
+    search['sort'] = parts[2]
+    cursor, direction = (parts[4], parts[3]) if len(parts) == 5 else (None, PAGE_NEXT)
+    page = await find_trips_page_async(search, cursor, direction)
+    if not page[0] and cursor:
+        page = await find_trips_page_async(search)
+    if not page[0]:
+        await query.edit_message_text(get_text(user, 'no_trips_found'))
+        return
+    text, reply_markup = render_search_page(user, search, page)
+    await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
 
 # --- Бронирование поездки ---
 async def book_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -680,16 +673,23 @@ async def book_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     trip_id = int(query.data.split("_")[-1])
     trip = await get_trip_by_id_async(trip_id)
+    user = await get_current_user(update, context)
 
-    if not trip or trip.status != Trip.Status.ACTIVE or trip.available_seats == 0:
-        user = await get_user_async(update.effective_user.id)
+    # Предыдущее незавершенное удержание этого пользователя больше не нужно
+    previous_hold_id = context.user_data.pop('seat_hold_id', None)
+    if previous_hold_id:
+        await release_hold_async(previous_hold_id, user)
+
+    # Место удерживается, пока пассажир вводит количество мест
+    hold = await create_hold_async(user, trip) if trip else None
+    if not hold:
         unavailable_text = get_text(user, 'book_trip_unavailable')
         await query.edit_message_text(unavailable_text)
         return MAIN_MENU
     
     context.user_data['booking_trip_id'] = trip_id
+    context.user_data['seat_hold_id'] = hold.id
     
-    user = await get_user_async(update.effective_user.id)
     seats_text = get_text(user, 'select_seats_for_booking', dep=trip.departure_location, dest=trip.destination_location, seats=trip.available_seats)
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -698,7 +698,7 @@ async def book_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return BOOK_TRIP_ENTERING_SEATS
 
 async def book_trip_enter_seats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     try:
         seats_to_book = int(update.message.text)
         if seats_to_book <= 0: raise ValueError
@@ -716,7 +716,7 @@ async def book_trip_enter_seats(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(error_text)
         return await show_main_menu(update, context)
 
-    booking, error = await create_booking_async(passenger, trip, seats_to_book)
+    booking, error = await create_booking_async(passenger, trip, seats_to_book, context.user_data.pop('seat_hold_id', None))
 
     if error:
         if error == "booking_unavailable":
@@ -728,127 +728,133 @@ async def book_trip_enter_seats(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         # Уведомляем водителя
         driver_message = get_text(None, 'driver_notification', passenger=passenger.name, phone=passenger.phone_number, seats=seats_to_book, trip=trip)  # Use ru for admin
-        driver_keyboard = [[InlineKeyboardButton("💬 Связаться с пассажиром", callback_data=f"contact_user_{booking.id}")]]
-        await context.bot.send_message(
-            chat_id=trip.driver.telegram_id, 
-            text=driver_message, 
-            reply_markup=InlineKeyboardMarkup(driver_keyboard)
-        )
+        get_outbox().enqueue(trip.driver.telegram_id, driver_message, reply_markup=CONTACT_PASSENGER_KEYBOARD(booking=booking.id))
 
         # Отвечаем пассажиру
         total_cost = seats_to_book * trip.price
         success_text = get_text(user, 'booking_success', seats=seats_to_book, cost=total_cost)
-        passenger_keyboard = [[InlineKeyboardButton("💬 Связаться с водителем", callback_data=f"contact_user_{booking.id}")]]
         await update.message.reply_text(
             success_text, 
-            reply_markup=InlineKeyboardMarkup(passenger_keyboard)
+            reply_markup=CONTACT_DRIVER_KEYBOARD(booking=booking.id)
         )
 
     context.user_data.pop('booking_trip_id', None)
     return await show_main_menu(update, context)
 
-# --- "Мои поездки" ---
-async def my_trips(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    driver = await get_user_async(update.effective_user.id)
-    trips = await get_trips_for_driver_async(driver)
-    
-    if not trips:
-        no_trips_text = get_text(driver, 'no_trips')
-        await update.message.reply_text(no_trips_text)
+# --- Списки по страницам: "Мои поездки", "Мои бронирования", "История поездок" ---
+# Каждый список - одно сообщение; кнопки "назад/вперед" редактируют его на месте.
+# callback_data: page_<список>_<n|p>_<курсор>, курсор - (время, id) граничной записи.
+LIST_ACTIVE_TRIPS = 'trips'
+LIST_ACTIVE_BOOKINGS = 'bookings'
+LIST_DRIVER_HISTORY = 'dhist'
+LIST_PASSENGER_HISTORY = 'phist'
+HISTORY_STATUSES = [Trip.Status.COMPLETED, Trip.Status.CANCELED]
+LIST_EMPTY_TEXT = {
+    LIST_ACTIVE_TRIPS: 'no_active_trips',
+    LIST_ACTIVE_BOOKINGS: 'no_bookings',
+    LIST_DRIVER_HISTORY: 'no_history',
+    LIST_PASSENGER_HISTORY: 'no_history',
+}
+
+def format_trip_time(trip):
+    return trip.departure_time.strftime('%d.%m.%Y в %H:%M')
+
+def format_history_status(user, trip):
+    return get_text(user, 'history_completed' if trip.status == Trip.Status.COMPLETED else 'history_cancelled')
+
+async def load_list_page(user, list_name, cursor=None, direction=PAGE_NEXT):
+    if list_name == LIST_ACTIVE_TRIPS:
+        return await get_driver_trips_page_async(user, [Trip.Status.ACTIVE], cursor, direction)
+    if list_name == LIST_DRIVER_HISTORY:
+        return await get_driver_trips_page_async(user, HISTORY_STATUSES, cursor, direction)
+    if list_name == LIST_ACTIVE_BOOKINGS:
+        return await get_passenger_bookings_page_async(user, [Trip.Status.ACTIVE], cursor, direction)
+    return await get_passenger_bookings_page_async(user, HISTORY_STATUSES, cursor, direction)
+
+def render_list_page(user, list_name, page):
+    """Текст и клавиатура одной страницы списка."""
+    rows = page[0]
+    keyboard = []
+    if list_name == LIST_ACTIVE_TRIPS:
+        header = get_text(user, 'my_trips')
+        items = []
+        for number, trip in enumerate(rows, start=1):
+            items.append(f"{number}. " + get_text(user, 'trip_active_info', dep=trip.departure_location, dest=trip.destination_location, time=format_trip_time(trip), seats=trip.available_seats, price=trip.price))
+            keyboard.append(TRIP_ACTIONS_BUTTONS.row(number=number, trip=trip.id))
+    elif list_name == LIST_ACTIVE_BOOKINGS:
+        header = get_text(user, 'my_bookings')
+        items = []
+        for booking in rows:
+            trip = booking.trip
+            items.append(get_text(user, 'booking_info', dep=trip.departure_location, dest=trip.destination_location, time=format_trip_time(trip), driver=trip.driver.name, phone=trip.driver.phone_number, vehicle=trip.vehicle, seats=booking.seats_booked, cost=booking.seats_booked * trip.price))
+    elif list_name == LIST_DRIVER_HISTORY:
+        header = get_text(user, 'trip_history')
+        items = [
+            get_text(user, 'history_trip_info', status=format_history_status(user, trip), dep=trip.departure_location, dest=trip.destination_location, time=format_trip_time(trip), vehicle=trip.vehicle, seats=trip.available_seats, price=trip.price)
+            for trip in rows
+        ]
+    else:
+        header = get_text(user, 'trip_history')
+        items = []
+        for booking in rows:
+            trip = booking.trip
+            items.append(get_text(user, 'history_booking_info', status=format_history_status(user, trip), dep=trip.departure_location, dest=trip.destination_location, time=format_trip_time(trip), driver=trip.driver.name, phone=trip.driver.phone_number, vehicle=trip.vehicle, seats=booking.seats_booked, cost=booking.seats_booked * trip.price))
+
+    navigation = navigation_row(f"page_{list_name}", page)
+    if navigation:
+        keyboard.append(navigation)
+    text = "\n\n".join([header] + items)
+    return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def send_list(update: Update, user, list_name):
+    page = await load_list_page(user, list_name)
+    if not page[0]:
+        await update.message.reply_text(get_text(user, LIST_EMPTY_TEXT[list_name]))
         return MAIN_MENU
-        
-    my_trips_text = get_text(driver, 'my_trips')
-    await update.message.reply_text(my_trips_text)
-    active_trips_found = False
-    for trip in trips:
-        if trip.status == Trip.Status.ACTIVE:
-            active_trips_found = True
-            dep = trip.departure_location
-            dest = trip.destination_location
-            time_str = trip.departure_time.strftime('%d.%m.%Y в %H:%M')
-            info_text = get_text(driver, 'trip_active_info', dep=dep, dest=dest, time=time_str, seats=trip.available_seats, price=trip.price)
-            
-            keyboard = [[
-                InlineKeyboardButton("✅ Завершить", callback_data=f"complete_trip_{trip.id}"),
-                InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_trip_{trip.id}"),
-                InlineKeyboardButton("✏️ Редактировать", callback_data=f"edit_trip_{trip.id}")
-            ]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(info_text, parse_mode='HTML', reply_markup=reply_markup)
-    
-    if not active_trips_found:
-        no_active_text = get_text(driver, 'no_active_trips')
-        await update.message.reply_text(no_active_text)
-        
+    text, reply_markup = render_list_page(user, list_name, page)
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
     return MAIN_MENU
 
-# --- "Мои бронирования" ---
-async def my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    passenger = await get_user_async(update.effective_user.id)
-    bookings = await get_bookings_for_passenger_async(passenger, active_only=True)
-
-    if not bookings:
-        no_bookings_text = get_text(passenger, 'no_bookings')
-        await update.message.reply_text(no_bookings_text)
+async def my_trips(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    driver = await get_current_user(update, context)
+    page = await load_list_page(driver, LIST_ACTIVE_TRIPS)
+    if not page[0]:
+        # Отдельный запрос только в пустом случае: чтобы различать "нет поездок" и "нет активных"
+        empty_key = 'no_active_trips' if await driver_has_trips_async(driver) else 'no_trips'
+        await update.message.reply_text(get_text(driver, empty_key))
         return MAIN_MENU
-
-    my_bookings_text = get_text(passenger, 'my_bookings')
-    await update.message.reply_text(my_bookings_text)
-    for booking in bookings:
-        trip = booking.trip
-        total_cost = booking.seats_booked * trip.price
-        dep = trip.departure_location
-        dest = trip.destination_location
-        time_str = trip.departure_time.strftime('%d.%m.%Y в %H:%M')
-        info_text = get_text(passenger, 'booking_info', dep=dep, dest=dest, time=time_str, driver=trip.driver.name, phone=trip.driver.phone_number, vehicle=trip.vehicle, seats=booking.seats_booked, cost=total_cost)
-        await update.message.reply_text(info_text, parse_mode='HTML')
-
+    text, reply_markup = render_list_page(driver, LIST_ACTIVE_TRIPS, page)
+    await update.message.reply_text(text, parse_mode='HTML', reply_markup=reply_markup)
     return MAIN_MENU
 
-# --- "История поездок" ---
+async def my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    passenger = await get_current_user(update, context)
+    return await send_list(update, passenger, LIST_ACTIVE_BOOKINGS)
+
 async def trip_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
-    
+    user = await get_current_user(update, context)
     if user.role == User.Role.DRIVER:
-        trips = await get_trips_for_driver_async(user)
-        if not trips:
-            no_history_text = get_text(user, 'no_history')
-            await update.message.reply_text(no_history_text)
-            return MAIN_MENU
-        
-        history_text = get_text(user, 'trip_history')
-        await update.message.reply_text(history_text)
-        for trip in trips:
-            if trip.status in [Trip.Status.COMPLETED, Trip.Status.CANCELED]:
-                status_text = get_text(user, 'history_completed' if trip.status == Trip.Status.COMPLETED else 'history_cancelled')
-                dep = trip.departure_location
-                dest = trip.destination_location
-                time_str = trip.departure_time.strftime('%d.%m.%Y в %H:%M')
-                info_text = get_text(user, 'history_trip_info', status=status_text, dep=dep, dest=dest, time=time_str, vehicle=trip.vehicle, seats=trip.available_seats, price=trip.price)
-                await update.message.reply_text(info_text, parse_mode='HTML')
-    
-    elif user.role == User.Role.PASSENGER:
-        bookings = await get_bookings_for_passenger_async(user, active_only=False)
-        if not bookings:
-            no_history_text = get_text(user, 'no_history')
-            await update.message.reply_text(no_history_text)
-            return MAIN_MENU
-        
-        history_text = get_text(user, 'trip_history')
-        await update.message.reply_text(history_text)
-        for booking in bookings:
-            trip = booking.trip
-            if trip.status in [Trip.Status.COMPLETED, Trip.Status.CANCELED]:
-                status_text = get_text(user, 'history_completed' if trip.status == Trip.Status.COMPLETED else 'history_cancelled')
-                total_cost = booking.seats_booked * trip.price
-                dep = trip.departure_location
-                dest = trip.destination_location
-                time_str = trip.departure_time.strftime('%d.%m.%Y в %H:%M')
-                info_text = get_text(user, 'history_booking_info', status=status_text, dep=dep, dest=dest, time=time_str, driver=trip.driver.name, phone=trip.driver.phone_number, vehicle=trip.vehicle, seats=booking.seats_booked, cost=total_cost)
-                await update.message.reply_text(info_text, parse_mode='HTML')
-
+        return await send_list(update, user, LIST_DRIVER_HISTORY)
+    if user.role == User.Role.PASSENGER:
+        return await send_list(update, user, LIST_PASSENGER_HISTORY)
     return MAIN_MENU
 
+async def handle_list_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопки "назад/вперед" под списком: перерисовывает то же сообщение."""
+    query = update.callback_query
+    await query.answer()
+    _, list_name, direction, cursor = query.data.split('_', 3)
+    user = await get_current_user(update, context)
+    page = await load_list_page(user, list_name, cursor, direction)
+    if not page[0]:
+        # Записи на странице исчезли (поездки завершены или отменены) - начинаем с начала
+        page = await load_list_page(user, list_name)
+    if not page[0]:
+        await query.edit_message_text(get_text(user, LIST_EMPTY_TEXT[list_name]))
+        return
+    text, reply_markup = render_list_page(user, list_name, page)
+    await query.edit_message_text(text, parse_mode='HTML', reply_markup=reply_markup)
+
 # --- Управление поездкой ---
 async def edit_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
@@ -856,16 +862,10 @@ async def edit_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     trip_id = int(query.data.split("_")[-1])
     context.user_data['editing_trip_id'] = trip_id
 
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     select_field_text = get_text(user, 'select_field_to_edit')
 
-    keyboard = [
-        [InlineKeyboardButton("Время отправления", callback_data="edit_field_departure_time")],
-        [InlineKeyboardButton("Количество мест", callback_data="edit_field_available_seats")],
-        [InlineKeyboardButton("Цену", callback_data="edit_field_price")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(select_field_text, reply_markup=reply_markup)
+    await query.edit_message_text(select_field_text, reply_markup=user_keyboard(user, MENU_EDIT_TRIP))
     return EDIT_TRIP_SELECT_FIELD
 
 async def edit_trip_select_field(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -885,7 +885,7 @@ async def edit_trip_select_field(update: Update, context: ContextTypes.DEFAULT_T
     
     context.user_data['editing_field'] = field_to_edit
     
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     field_map = {
         "departure_time": "новое время отправления в формате ДД.ММ.ГГГГ ЧЧ:ММ",
         "available_seats": "новое количество свободных мест",
@@ -900,7 +900,7 @@ async def edit_trip_enter_value(update: Update, context: ContextTypes.DEFAULT_TY
     trip_id = context.user_data.get('editing_trip_id')
     field = context.user_data.get('editing_field')
     new_value_str = update.message.text
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     
     if not trip_id or not field:
         error_text = get_text(user, 'edit_error')
@@ -955,9 +955,10 @@ async def complete_trip(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update_trip_status_async(trip.id, Trip.Status.COMPLETED)
     completed_text = get_text(None, 'trip_completed', trip=trip)  # ru
     await query.edit_message_text(text=completed_text)
-    
-    await start_rating_process(context.bot, trip)
-        
+
+    # Запросы оценок рассылаются в фоне: водитель получает подтверждение сразу
+    context.application.create_task(start_rating_process(trip), update=update)
+
     return MAIN_MENU
 
 async def cancel_trip(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -978,7 +979,7 @@ async def cancel_trip(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 # --- Система поддержки ---
 async def support_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     start_text = get_text(user, 'support_start')
     await update.message.reply_text(
         start_text,
@@ -988,7 +989,7 @@ async def support_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     return SUPPORT_ENTERING_MESSAGE
 
 async def support_enter_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     message_text = update.message.text
     
     if len(message_text) > 1000:
@@ -997,47 +998,42 @@ async def support_enter_message(update: Update, context: ContextTypes.DEFAULT_TY
         return SUPPORT_ENTERING_MESSAGE
         
     logger.info(f"User {user.telegram_id} submitted support ticket: {message_text}")
-    await create_support_ticket_async(user, message_text)
-    
+    ticket = await create_support_ticket_async(user, message_text)
+    context.user_data['support_ticket_id'] = ticket.id
+
     submitted_text = get_text(user, 'support_submitted')
     await update.message.reply_text(
-        submitted_text
+        f"{submitted_text}\n\n{get_text(user, 'support_chat_hint')}"
     )
-    return await show_main_menu(update, context)
+    return SUPPORT_CHAT
+
+async def support_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Сообщение в открытое обращение: сохраняется и показывается администратору на странице чата."""
+    user = await get_current_user(update, context)
+    ticket_id = context.user_data.get('support_ticket_id')
+    if not ticket_id:
+        await update.message.reply_text(get_text(user, 'chat_not_initialized'))
+        return await show_main_menu(update, context)
+
+    message_text = update.message.text
+    if len(message_text) > 1000:
+        await update.message.reply_text(get_text(user, 'support_message_too_long'))
+        return SUPPORT_CHAT
+
+    # Запись в БД и рассылка в группу chat_<id> идут в фоне, пачками
+    get_chat_writer().submit(ticket_id, user, message_text)
+    await update.message.reply_text(get_text(user, 'message_sent'))
+    return SUPPORT_CHAT
 
 # --- Система рейтинга ---
-async def start_rating_process(bot, trip):
-    driver = await get_user_async(trip.driver.telegram_id)
-    bookings = await sync_to_async(list)(trip.bookings.select_related('passenger').all())
-    
-    if not bookings: return
-
-    passengers = [booking.passenger for booking in bookings]
-
-    if passengers:
-        for passenger in passengers:
-            rating_exists = await sync_to_async(Rating.objects.filter(trip=trip, rater=driver, rated_user=passenger).exists)()
-            if not rating_exists:
-                keyboard = [[InlineKeyboardButton(f"{i} ⭐", callback_data=f"rate_{trip.id}_{driver.id}_{passenger.id}_{i}") for i in range(1, 6)]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                rate_text = get_text(driver, 'rate_passenger', passenger=passenger.name)
-                await bot.send_message(
-                    chat_id=driver.telegram_id,
-                    text=rate_text,
-                    reply_markup=reply_markup
-                )
-
-    for passenger in passengers:
-        rating_exists = await sync_to_async(Rating.objects.filter(trip=trip, rater=passenger, rated_user=driver).exists)()
-        if not rating_exists:
-            keyboard = [[InlineKeyboardButton(f"{i} ⭐", callback_data=f"rate_{trip.id}_{passenger.id}_{driver.id}_{i}") for i in range(1, 6)]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            rate_text = get_text(passenger, 'rate_driver', driver=driver.name)
-            await bot.send_message(
-                chat_id=passenger.telegram_id,
-                text=rate_text,
-                reply_markup=reply_markup
-            )
+async def start_rating_process(trip):
+    """Рассылает участникам поездки запросы оценки через общую очередь отправки."""
+    for rater, rated_user in await get_pending_rating_pairs_async(trip):
+        if rater.id == trip.driver_id:
+            rate_text = get_text(rater, 'rate_passenger', passenger=rated_user.name)
+        else:
+            rate_text = get_text(rater, 'rate_driver', driver=rated_user.name)
+        get_outbox().enqueue(rater.telegram_id, rate_text, reply_markup=RATING_KEYBOARD(trip=trip.id, rater=rater.id, rated=rated_user.id))
 
 async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1049,9 +1045,9 @@ async def handle_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     rated_user_id = int(parts[3])
     score = int(parts[4])
 
-    trip = await sync_to_async(Trip.objects.get)(id=trip_id)
-    rater = await sync_to_async(User.objects.get)(id=rater_id)
-    rated_user = await sync_to_async(User.objects.get)(id=rated_user_id)
+    trip = await db_async(Trip.objects.get)(id=trip_id)
+    rater = await db_async(User.objects.get)(id=rater_id)
+    rated_user = await db_async(User.objects.get)(id=rated_user_id)
 
     try:
         await add_rating_and_update_user_async(rater, rated_user, trip, score)
@@ -1107,13 +1103,10 @@ async def forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(too_long_text)
         return IN_CHAT
     
-    user = await get_user_async(update.effective_user.id)
+    user = await get_current_user(update, context)
     
     sent_text = get_text(user, 'message_sent')
-    await context.bot.send_message(
-        chat_id=chat_partner_id,
-        text=f"Сообщение от {user.name}:\n{message_text}"
-    )
+    get_outbox().enqueue(chat_partner_id, f"Сообщение от {user.name}:\n{message_text}")
     await update.message.reply_text(sent_text)
     return IN_CHAT
 
@@ -1126,14 +1119,164 @@ async def cancel_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 # --- Вспомогательные обработчики ---
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.pop('chat_partner_id', None)
+    context.user_data.pop('support_ticket_id', None)
+    # Отмененная бронь не держит места до очистки по таймауту
+    hold_id = context.user_data.pop('seat_hold_id', None)
+    if hold_id:
+        await release_hold_async(hold_id, await get_current_user(update, context))
     cancelled_text = get_text(None, 'action_cancelled')  # ru
     await update.message.reply_text(cancelled_text)
     return await show_main_menu(update, context)
 
+# --- Фоновые задачи ---
+_background_tasks = set()
+
+async def sweep_seat_holds(interval):
+    """Периодически возвращает в поездки места из просроченных удержаний."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            released = await release_expired_holds_async()
+            if released:
+                logger.info(f"Снято просроченных удержаний мест: {released}")
+        except Exception:
+            logger.exception("Ошибка при очистке удержаний мест")
+
+async def start_background_tasks(application):
+    # JobQueue (python-telegram-bot[job-queue]) не установлен, поэтому обычная asyncio-задача
+    _background_tasks.add(asyncio.create_task(sweep_seat_holds(settings.SEAT_HOLD_SWEEP_SECONDS)))
+    if metrics.enabled and settings.BOT_METRICS_FILE:
+        _background_tasks.add(asyncio.create_task(
+            dump_metrics_periodically(settings.BOT_METRICS_FILE, settings.BOT_METRICS_DUMP_SECONDS)
+        ))
+
+async def stop_background_tasks(application):
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # Сообщения в чат поддержки, принятые до остановки, дописываются в БД
+    await stop_chat_writer()
+    if metrics.enabled and settings.BOT_METRICS_FILE:
+        await asyncio.to_thread(dump_metrics, settings.BOT_METRICS_FILE)
+
+# --- Сборка приложения ---
+def build_application(bot_token, base_url=None, concurrency=None, request=None, rate_limit=True):
+    """
+    Создает Application со всеми обработчиками бота.
+    request - свой BaseRequest вместо HTTPXRequest (например, заглушка Bot API в loadtest_bot).
+    rate_limit=False - ответы бота не ждут лимита Bot API (заглушка в нагрузочных прогонах).
+    """
+    # Состояние диалогов хранится в БД (перенос из старого файла: manage.py import_bot_persistence)
+    persistence = DjangoPersistence()
+    # Апдейты разных чатов обрабатываются параллельно, одного чата - по очереди
+    update_processor = PerChatUpdateProcessor(concurrency or settings.BOT_CONCURRENT_UPDATES)
+    builder = (
+        Application.builder().token(bot_token).persistence(persistence).concurrent_updates(update_processor)
+        .post_init(start_background_tasks).post_stop(stop_background_tasks)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if rate_limit:
+        # Ответы бота и очередь отправки расходуют один лимит (общий для процессов, если есть Redis)
+        builder = builder.rate_limiter(BotRateLimiter())
+    if metrics.enabled:
+        register_update_processor(update_processor)
+        # Вызовы Bot API из обработчиков считаются в метриках (long polling getUpdates - нет)
+        request = InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256))
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
+
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            SELECTING_LANGUAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_language)],
+            REQUESTING_PHONE: [MessageHandler(filters.CONTACT, request_phone_number)],
+            SELECTING_ROLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_role)],
+            
+            MAIN_MENU: [
+                MessageHandler(filters.Regex(f"^{MY_PROFILE_BTN}$"), my_profile),
+                MessageHandler(filters.Regex(f"^{CREATE_TRIP_BTN}$"), create_trip_start),
+                MessageHandler(filters.Regex(f"^{FIND_TRIP_BTN}$"), find_trip_start),
+                MessageHandler(filters.Regex(f"^{MY_BOOKINGS_BTN}$"), my_bookings),
+                MessageHandler(filters.Regex(f"^{MY_TRIPS_BTN}$"), my_trips),
+                MessageHandler(filters.Regex(f"^{SUPPORT_BTN}$"), support_start),
+                MessageHandler(filters.Regex(f"^{TRIP_HISTORY_BTN}$"), trip_history),
+                CallbackQueryHandler(book_trip_start, pattern="^book_trip_"),
+                CallbackQueryHandler(complete_trip, pattern="^complete_trip_"),
+                CallbackQueryHandler(cancel_trip, pattern="^cancel_trip_"),
+                CallbackQueryHandler(edit_trip_start, pattern="^edit_trip_"),
+                CallbackQueryHandler(start_chat, pattern="^contact_user_"),
+            ],
+
+            PROFILE_MENU: [
+                MessageHandler(filters.Regex(f"^{CHANGE_ROLE_BTN}$"), change_role),
+                MessageHandler(filters.Regex(f"^{BACK_TO_MENU_BTN}$"), show_main_menu),
+            ],
+
+            CONFIRMING_ROLE_CHANGE: [MessageHandler(filters.Regex(f"^({CONFIRM_YES_BTN}|{CONFIRM_NO_BTN})$"), confirm_role_change)],
+            
+            SELECTING_VEHICLE: [CallbackQueryHandler(trip_select_vehicle, pattern="^select_vehicle_")],
+
+            ADD_VEHICLE_ENTERING_BRAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_vehicle_brand)],
+            ADD_VEHICLE_ENTERING_MODEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_vehicle_model)],
+            ADD_VEHICLE_ENTERING_PLATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_vehicle_plate)],
+
+            CREATE_TRIP_ENTERING_DEPARTURE: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_departure)],
+            CREATE_TRIP_ENTERING_DESTINATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_destination)],
+            CREATE_TRIP_ENTERING_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_time)],
+            CREATE_TRIP_ENTERING_SEATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_seats)],
+            CREATE_TRIP_ENTERING_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_price)],
+
+            FIND_TRIP_ENTERING_DEPARTURE: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_trip_enter_departure)],
+            FIND_TRIP_ENTERING_DESTINATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_trip_enter_destination)],
+            FIND_TRIP_ENTERING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_trip_enter_date)],
+            
+            BOOK_TRIP_ENTERING_SEATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, book_trip_enter_seats)],
+
+            SUPPORT_ENTERING_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, support_enter_message)],
+            SUPPORT_CHAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, support_chat_message)],
+
+            EDIT_TRIP_SELECT_FIELD: [CallbackQueryHandler(edit_trip_select_field, pattern="^edit_field_")],
+            EDIT_TRIP_ENTERING_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_trip_enter_value)],
+
+            IN_CHAT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, forward_message),
+                CommandHandler("cancel", cancel_chat),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        persistent=True,
+        name="main_conversation"
+    )
+    
+    # Пользователь загружается один раз на апдейт, до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, load_current_user), group=-1)
+    application.add_handler(conv_handler)
+    
+    # Отдельный обработчик для рейтинга
+    application.add_handler(CallbackQueryHandler(handle_rating, pattern="^rate_"))
+    # Листание списков и результатов поиска работает в любом состоянии диалога
+    application.add_handler(CallbackQueryHandler(handle_list_page, pattern="^page_"))
+    application.add_handler(CallbackQueryHandler(handle_search_page, pattern="^search_"))
+
+    # Без BOT_METRICS_ENABLED обработчики не оборачиваются
+    instrument_application(application, STATE_NAMES)
+    return application
+
 # --- ГЛАВНЫЙ КЛАСС ЗАПУСКА ---
 class Command(BaseCommand):
     help = 'Запускает телеграм-бота'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--webhook', action='store_true', help='Принимать апдейты через вебхук вместо long polling')
+        parser.add_argument('--webhook-url', default=settings.BOT_WEBHOOK_URL, help='Публичный URL вебхука (…/telegram/webhook/)')
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес, на котором Daphne слушает в режиме вебхука')
+        parser.add_argument('--port', type=int, default=8001, help='Порт Daphne в режиме вебхука')
+        parser.add_argument('--bot-api-url', default=None, help='Альтернативный адрес Bot API (например, заглушка replay_updates)')
+        parser.add_argument('--concurrency', type=int, default=None, help='Сколько апдейтов обрабатывать одновременно (BOT_CONCURRENT_UPDATES)')
+
     def handle(self, *args, **options):
         self.stdout.write("Запуск телеграм-бота...")
         load_dotenv()
@@ -1142,76 +1285,66 @@ class Command(BaseCommand):
         if not bot_token:
             self.stderr.write(self.style.ERROR("Токен бота не найден."))
             return
-        
-        persistence = PicklePersistence(filepath="bot_persistence")
-        application = Application.builder().token(bot_token).persistence(persistence).build()
-
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start)],
-            states={
-                SELECTING_LANGUAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_language)],
-                REQUESTING_PHONE: [MessageHandler(filters.CONTACT, request_phone_number)],
-                SELECTING_ROLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_role)],
-                
-                MAIN_MENU: [
-                    MessageHandler(filters.Regex(f"^{MY_PROFILE_BTN}$"), my_profile),
-                    MessageHandler(filters.Regex(f"^{CREATE_TRIP_BTN}$"), create_trip_start),
-                    MessageHandler(filters.Regex(f"^{FIND_TRIP_BTN}$"), find_trip_start),
-                    MessageHandler(filters.Regex(f"^{MY_BOOKINGS_BTN}$"), my_bookings),
-                    MessageHandler(filters.Regex(f"^{MY_TRIPS_BTN}$"), my_trips),
-                    MessageHandler(filters.Regex(f"^{SUPPORT_BTN}$"), support_start),
-                    MessageHandler(filters.Regex(f"^{TRIP_HISTORY_BTN}$"), trip_history),
-                    CallbackQueryHandler(book_trip_start, pattern="^book_trip_"),
-                    CallbackQueryHandler(complete_trip, pattern="^complete_trip_"),
-                    CallbackQueryHandler(cancel_trip, pattern="^cancel_trip_"),
-                    CallbackQueryHandler(edit_trip_start, pattern="^edit_trip_"),
-                    CallbackQueryHandler(start_chat, pattern="^contact_user_"),
-                ],
-
-                PROFILE_MENU: [
-                    MessageHandler(filters.Regex(f"^{CHANGE_ROLE_BTN}$"), change_role),
-                    MessageHandler(filters.Regex(f"^{BACK_TO_MENU_BTN}$"), show_main_menu),
-                ],
-
-                CONFIRMING_ROLE_CHANGE: [MessageHandler(filters.Regex(f"^({CONFIRM_YES_BTN}|{CONFIRM_NO_BTN})$"), confirm_role_change)],
-                
-                SELECTING_VEHICLE: [CallbackQueryHandler(trip_select_vehicle, pattern="^select_vehicle_")],
-
-                ADD_VEHICLE_ENTERING_BRAND: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_vehicle_brand)],
-                ADD_VEHICLE_ENTERING_MODEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_vehicle_model)],
-                ADD_VEHICLE_ENTERING_PLATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_vehicle_plate)],
-
-                CREATE_TRIP_ENTERING_DEPARTURE: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_departure)],
-                CREATE_TRIP_ENTERING_DESTINATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_destination)],
-                CREATE_TRIP_ENTERING_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_time)],
-                CREATE_TRIP_ENTERING_SEATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_seats)],
-                CREATE_TRIP_ENTERING_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, trip_enter_price)],
-
-                FIND_TRIP_ENTERING_DEPARTURE: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_trip_enter_departure)],
-                FIND_TRIP_ENTERING_DESTINATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_trip_enter_destination)],
-                FIND_TRIP_ENTERING_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, find_trip_enter_date)],
-                
-                BOOK_TRIP_ENTERING_SEATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, book_trip_enter_seats)],
-
-                SUPPORT_ENTERING_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, support_enter_message)],
-
-                EDIT_TRIP_SELECT_FIELD: [CallbackQueryHandler(edit_trip_select_field, pattern="^edit_field_")],
-                EDIT_TRIP_ENTERING_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_trip_enter_value)],
-
-                IN_CHAT: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, forward_message),
-                    CommandHandler("cancel", cancel_chat),
-                ],
-            },
-            fallbacks=[CommandHandler("cancel", cancel)],
-            persistent=True,
-            name="main_conversation"
-        )
-        
-        application.add_handler(conv_handler)
-        
-        # Отдельный обработчик для рейтинга
-        application.add_handler(CallbackQueryHandler(handle_rating, pattern="^rate_"))
-        
+
+        configure_metrics()
+        if metrics.enabled and settings.BOT_METRICS_PORT:
+            start_metrics_server(settings.BOT_METRICS_PORT, settings.BOT_METRICS_HOST)
+        application = build_application(bot_token, base_url=options['bot_api_url'], concurrency=options['concurrency'])
+        # Уведомления другим пользователям идут через общую очередь с лимитами Telegram
+        configure_outbox(token=bot_token, base_url=options['bot_api_url'])
+        # Сообщения чата поддержки пишутся через тот же пул потоков БД, что и обработчики
+        configure_chat_writer(run_sync=db_async)
+
+        if options['webhook']:
+            self.run_webhook(application, options)
+            return
+
         self.stdout.write(self.style.SUCCESS("Бот успешно запущен! Нажмите Ctrl+C для остановки."))
         application.run_polling()
+        stop_outbox()
+        shutdown_db_executor()
+
+    def run_webhook(self, application, options):
+        """
+        Режим вебхука: Daphne в этом же процессе обслуживает config.asgi,
+        а view telegram_webhook кладет апдейты в application.update_queue.
+        """
+        # daphne.server должен импортироваться раньше остального Twisted (ставит asyncio-реактор)
+        from daphne.server import Server
+        from twisted.internet import defer, reactor
+        from config.asgi import application as asgi_application
+
+        if not options['webhook_url'] or not settings.BOT_WEBHOOK_SECRET:
+            self.stderr.write(self.style.ERROR("Для режима вебхука нужны BOT_WEBHOOK_URL (или --webhook-url) и BOT_WEBHOOK_SECRET."))
+            return
+
+        async def start_bot():
+            await application.initialize()
+            # post_init/post_stop сами вызываются только в run_polling/run_webhook
+            await application.post_init(application)
+            await application.start()
+            register_application(application)
+            await application.bot.set_webhook(
+                url=options['webhook_url'],
+                secret_token=settings.BOT_WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            self.stdout.write(self.style.SUCCESS(f"Бот принимает апдейты на {options['webhook_url']}"))
+
+        async def stop_bot():
+            register_application(None)
+            await application.stop()
+            await application.post_stop(application)
+            await application.shutdown()
+            await asyncio.to_thread(stop_outbox)
+            shutdown_db_executor()
+
+        server = Server(
+            asgi_application,
+            endpoints=[f"tcp:port={options['port']}:interface={options['host']}"],
+            ready_callable=lambda: asyncio.ensure_future(start_bot()),
+        )
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', lambda: defer.Deferred.fromFuture(asyncio.ensure_future(stop_bot()))
+        )
+        server.run()
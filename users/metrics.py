@@ -0,0 +1,349 @@
+# users/metrics.py
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from telegram.ext import ConversationHandler
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы времени обработчика, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATE_END = 'END'
+STATE_ENTRY = 'ENTRY'  # диалог еще не начат (точки входа)
+STATE_ANY = 'ANY'  # fallbacks: состояние заранее неизвестно
+
+# Показатели PerChatUpdateProcessor.stats(), которые отдаются в /metrics
+UPDATE_PROCESSOR_GAUGES = {
+    'concurrency': 'Сколько обработчиков может выполняться одновременно',
+    'active': 'Апдейты в обработке',
+    'pending': 'Принятые апдейты, ждущие своего чата или свободного слота',
+    'waiting': 'Апдейты, ждущие свободного слота',
+    'chats': 'Чаты с апдейтами в обработке или в очереди',
+    'max_waiting': 'Больше всего апдейтов, ждавших слота одновременно',
+    'max_chat_depth': 'Больше всего апдейтов одного чата в очереди одновременно',
+}
+
+
+class HandlerCall:
+    """Счетчики одного вызова обработчика: запросы к БД и к Bot API."""
+    __slots__ = ('queries', 'db_seconds', 'telegram_calls')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.telegram_calls = 0
+
+
+# Текущий вызов обработчика; contextvars переносятся в потоки БД (db_async)
+_current_call = contextvars.ContextVar('bot_handler_call', default=None)
+
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Метрики бота в памяти процесса. Пишутся из цикла событий, потоков БД
+    и потока очереди отправки, поэтому изменения идут под одной блокировкой.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_handler_seconds = 1.0
+        # Сырые времена вызовов (обработчик -> список) для перцентилей в нагрузочных прогонах;
+        # None - не копить
+        self.samples = None
+        self._lock = threading.Lock()
+        # Показатели, которые читаются в момент выдачи: имя -> (тип, описание, функция)
+        self._readings = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = defaultdict(Histogram)  # обработчик -> гистограмма
+            self.errors = defaultdict(int)
+            self.queries = defaultdict(int)
+            self.max_queries = defaultdict(int)  # обработчик -> больше всего запросов за один вызов
+            self.db_seconds = defaultdict(float)
+            self.handler_telegram_calls = defaultdict(int)
+            self.telegram_calls = defaultdict(int)  # (метод, ok|error) -> число
+            self.telegram_seconds = defaultdict(float)
+            self.transitions = defaultdict(int)  # (из, в) -> число
+            if self.samples is not None:
+                self.samples = defaultdict(list)
+
+    def observe_handler(self, handler, seconds, call, failed):
+        with self._lock:
+            self.latency[handler].observe(seconds)
+            if self.samples is not None:
+                self.samples[handler].append(seconds)
+            self.queries[handler] += call.queries
+            if call.queries > self.max_queries[handler]:
+                self.max_queries[handler] = call.queries
+            self.db_seconds[handler] += call.db_seconds
+            self.handler_telegram_calls[handler] += call.telegram_calls
+            if failed:
+                self.errors[handler] += 1
+        if seconds >= self.slow_handler_seconds:
+            logger.warning(
+                f"Медленный обработчик {handler}: {seconds:.3f} с, запросов к БД {call.queries} "
+                f"({call.db_seconds:.3f} с), вызовов Bot API {call.telegram_calls}"
+            )
+
+    def record_telegram_call(self, method, ok, seconds):
+        if not self.enabled:
+            return
+        call = _current_call.get()
+        if call is not None:
+            call.telegram_calls += 1
+        with self._lock:
+            self.telegram_calls[method, 'ok' if ok else 'error'] += 1
+            self.telegram_seconds[method] += seconds
+
+    def record_transition(self, source, target):
+        with self._lock:
+            self.transitions[source, target] += 1
+
+    def register_reading(self, name, kind, help_text, read):
+        """Показатель, значение которого берется из read() при каждой выдаче метрик (reset его не сбрасывает)."""
+        with self._lock:
+            self._readings[name] = (kind, help_text, read)
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus."""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            family('bot_handler_duration_seconds', 'histogram', 'Время обработки апдейта обработчиком')
+            for handler, histogram in sorted(self.latency.items()):
+                label = f'handler="{handler}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'bot_handler_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'bot_handler_duration_seconds_bucket{{{label},le="+Inf"}} {histogram.count}')
+                lines.append(f'bot_handler_duration_seconds_sum{{{label}}} {histogram.total:.6f}')
+                lines.append(f'bot_handler_duration_seconds_count{{{label}}} {histogram.count}')
+            for name, help_text, values in (
+                ('bot_handler_errors_total', 'Исключения в обработчике', self.errors),
+                ('bot_handler_db_queries_total', 'Запросы к БД из обработчика', self.queries),
+                ('bot_handler_db_seconds_total', 'Время запросов к БД из обработчика', self.db_seconds),
+                ('bot_handler_telegram_calls_total', 'Вызовы Bot API из обработчика', self.handler_telegram_calls),
+            ):
+                family(name, 'counter', help_text)
+                for handler, value in sorted(values.items()):
+                    lines.append(f'{name}{{handler="{handler}"}} {value:g}')
+            family('bot_handler_db_queries_max', 'gauge', 'Больше всего запросов к БД за один вызов обработчика')
+            for handler, value in sorted(self.max_queries.items()):
+                lines.append(f'bot_handler_db_queries_max{{handler="{handler}"}} {value}')
+            family('bot_telegram_api_calls_total', 'counter', 'Вызовы Bot API (бот и очередь отправки)')
+            for (method, status), value in sorted(self.telegram_calls.items()):
+                lines.append(f'bot_telegram_api_calls_total{{method="{method}",status="{status}"}} {value}')
+            family('bot_telegram_api_seconds_total', 'counter', 'Время вызовов Bot API')
+            for method, value in sorted(self.telegram_seconds.items()):
+                lines.append(f'bot_telegram_api_seconds_total{{method="{method}"}} {value:.6f}')
+            family('bot_state_transitions_total', 'counter', 'Переходы между состояниями диалога')
+            for (source, target), value in sorted(self.transitions.items()):
+                lines.append(f'bot_state_transitions_total{{from="{source}",to="{target}"}} {value}')
+            for name, (kind, help_text, read) in sorted(self._readings.items()):
+                family(name, kind, help_text)
+                lines.append(f'{name} {read():g}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def configure_metrics(enabled=None, slow_handler_seconds=None, keep_samples=False):
+    if keep_samples:
+        metrics.samples = defaultdict(list)
+    if enabled is None:
+        enabled = getattr(settings, 'BOT_METRICS_ENABLED', False)
+    metrics.enabled = enabled
+    if slow_handler_seconds is None:
+        slow_handler_seconds = getattr(settings, 'BOT_METRICS_SLOW_HANDLER_SECONDS', 1.0)
+    metrics.slow_handler_seconds = slow_handler_seconds
+    return metrics
+
+
+def register_update_processor(processor):
+    """Очереди PerChatUpdateProcessor в /metrics: глубина видна во время работы, а не только в логе остановки."""
+    for key, help_text in UPDATE_PROCESSOR_GAUGES.items():
+        metrics.register_reading(f'bot_updates_{key}', 'gauge', help_text, lambda key=key: processor.stats()[key])
+    metrics.register_reading(
+        'bot_updates_processed_total', 'counter', 'Обработанные апдейты', lambda: processor.stats()['processed']
+    )
+
+
+# --- Запросы к БД ---
+def query_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrapper: считает запросы и их время для текущего обработчика."""
+    call = _current_call.get()
+    if call is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        call.queries += 1
+        call.db_seconds += time.perf_counter() - started
+
+
+# --- Обработчики ---
+def instrument_callback(callback, name, state=None):
+    """
+    Оборачивает callback обработчика: время, запросы к БД, вызовы Bot API.
+    state - имя состояния диалога, в котором зарегистрирован обработчик
+    (None - обработчик вне диалога, переходы не считаются).
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        call = HandlerCall()
+        token = _current_call.set(call)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await callback(update, context)
+            failed = False
+        finally:
+            _current_call.reset(token)
+            metrics.observe_handler(name, time.perf_counter() - started, call, failed)
+        # None - ConversationHandler оставляет прежнее состояние
+        if state is not None and result is not None:
+            target = STATE_END if result == ConversationHandler.END else _state_names.get(result, str(result))
+            metrics.record_transition(state, target)
+        return result
+    wrapper.instrumented = True
+    return wrapper
+
+
+_state_names = {}
+
+
+def instrument_application(application, state_names=None):
+    """
+    Подменяет callback у всех обработчиков приложения, включая состояния
+    ConversationHandler. Если метрики выключены, ничего не делает:
+    обработчики остаются как есть и накладных расходов нет.
+    """
+    if not metrics.enabled:
+        return False
+    _state_names.update(state_names or {})
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler, None)
+    return True
+
+
+def _instrument_handler(handler, state):
+    if isinstance(handler, ConversationHandler):
+        for entry_point in handler.entry_points:
+            _instrument_handler(entry_point, STATE_ENTRY)
+        for key, handlers in handler.states.items():
+            for state_handler in handlers:
+                _instrument_handler(state_handler, _state_names.get(key, str(key)))
+        for fallback in handler.fallbacks:
+            _instrument_handler(fallback, STATE_ANY)
+        return
+    callback = handler.callback
+    if getattr(callback, 'instrumented', False):
+        return
+    handler.callback = instrument_callback(callback, getattr(callback, '__name__', repr(callback)), state)
+
+
+# --- Вызовы Bot API ---
+class InstrumentedRequest(BaseRequest):
+    """Обертка над запросом PTB: считает вызовы Bot API по методам."""
+    __slots__ = ('inner',)
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        ok = False
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, **timeouts)
+            ok = 200 <= code < 300
+            return code, payload
+        finally:
+            metrics.record_telegram_call(api_method, ok, time.perf_counter() - started)
+
+
+# --- Экспорт ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """HTTP-эндпоинт /metrics для Prometheus в отдельном потоке."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='bot-metrics', daemon=True).start()
+    logger.info(f"Метрики бота: http://{host}:{port}/metrics")
+    return server
+
+
+def dump_metrics(path):
+    """Записывает метрики в файл целиком (через временный файл, чтобы читатель не увидел половину)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(metrics.render())
+    os.replace(tmp_path, path)
+
+
+async def dump_metrics_periodically(path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(dump_metrics, path)
+        except OSError:
+            logger.exception(f"Не удалось записать метрики в {path}")
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotPersistenceRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('USER', 'user_data'), ('CHAT', 'chat_data'), ('BOT', 'bot_data'), ('CONV', 'conversation')], max_length=4, verbose_name='Тип')),
+                ('name', models.CharField(blank=True, default='', max_length=64, verbose_name='Имя')),
+                ('key', models.CharField(blank=True, default='', max_length=64, verbose_name='Ключ')),
+                ('data', models.JSONField(null=True, verbose_name='Данные')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Состояние бота',
+                'verbose_name_plural': 'Состояния бота',
+                'constraints': [models.UniqueConstraint(fields=('kind', 'name', 'key'), name='bot_persistence_record_unique')],
+            },
+        ),
+    ]
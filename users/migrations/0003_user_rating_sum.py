@@ -0,0 +1,34 @@
+# Generated by Django 5.2.6 on 2026-10-18 00:30
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_rating_sum(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    Rating = apps.get_model('trips', 'Rating')
+    totals = Rating.objects.values('rated_user').annotate(total=Sum('score'), count=Count('id'))
+    users = []
+    for row in totals.iterator():
+        users.append(User(
+            id=row['rated_user'], rating_sum=row['total'], rating_count=row['count'],
+            average_rating=row['total'] / row['count'],
+        ))
+    User.objects.bulk_update(users, ['rating_sum', 'rating_count', 'average_rating'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_bot_persistence_record'),
+        ('trips', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, verbose_name='Сумма оценок'),
+        ),
+        migrations.RunPython(fill_rating_sum, migrations.RunPython.noop),
+    ]
@@ -31,6 +31,8 @@ class User(AbstractUser):
     # НОВЫЕ ПОЛЯ ДЛЯ РЕЙТИНГА
     average_rating = models.FloatField('Средний рейтинг', default=0.0)
     rating_count = models.PositiveIntegerField('Количество оценок', default=0)
+    # Сумма всех оценок: средний рейтинг пересчитывается без обхода всех оценок (users/ratings.py)
+    rating_sum = models.PositiveIntegerField('Сумма оценок', default=0)
 
     # Поля для решения конфликтов с auth.User
     groups = models.ManyToManyField(
@@ -52,3 +54,32 @@ class User(AbstractUser):
 
     def __str__(self):
         return self.name or f"User {self.telegram_id}"
+
+
+class BotPersistenceRecord(models.Model):
+    """
+    Одна запись состояния бота (user_data, chat_data, bot_data или состояние
+    диалога). Хранится построчно, чтобы сохранять только изменившиеся данные.
+    """
+    class Kind(models.TextChoices):
+        USER_DATA = 'USER', 'user_data'
+        CHAT_DATA = 'CHAT', 'chat_data'
+        BOT_DATA = 'BOT', 'bot_data'
+        CONVERSATION = 'CONV', 'conversation'
+
+    kind = models.CharField('Тип', max_length=4, choices=Kind.choices)
+    # Для диалогов - имя ConversationHandler, для остальных - пустая строка
+    name = models.CharField('Имя', max_length=64, blank=True, default='')
+    key = models.CharField('Ключ', max_length=64, blank=True, default='')
+    data = models.JSONField('Данные', null=True)
+    updated_at = models.DateTimeField('Обновлено', auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind}:{self.name}:{self.key}"
+
+    class Meta:
+        verbose_name = 'Состояние бота'
+        verbose_name_plural = 'Состояния бота'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'name', 'key'], name='bot_persistence_record_unique'),
+        ]
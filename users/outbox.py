@@ -0,0 +1,273 @@
+# users/outbox.py
+
+import asyncio
+import atexit
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from importlib.util import find_spec
+
+import httpx
+from django.conf import settings
+
+from .metrics import metrics
+from .rate_limit import make_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 включается, только если установлен пакет h2
+HTTP2_AVAILABLE = find_spec('h2') is not None
+
+
+class TelegramSendError(Exception):
+    pass
+
+
+class Outbox:
+    """
+    Центральная очередь исходящих сообщений Telegram.
+
+    Работает в отдельном потоке со своим циклом событий и одним HTTP-клиентом,
+    поэтому ставить сообщения можно откуда угодно: из админки, consumer'ов и бота.
+    - не больше global_rate сообщений в секунду на весь бот;
+    - в один чат не чаще раза в chat_interval секунд, порядок сообщений в чате сохраняется;
+    - при 429 отправка приостанавливается на retry_after, сообщение уходит повторно.
+    Лимиты считает limiter (users/rate_limit.py): с Redis они общие для всех процессов
+    и для ответов бота, без Redis - только для этого процесса.
+    """
+
+    def __init__(self, token, base_url, global_rate=30, chat_interval=1.0, max_attempts=5, timeout=10.0, transport=None,
+                 limiter=None):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        # Транспорт httpx для тестов и нагрузочных прогонов (httpx.MockTransport); None - сеть
+        self.transport = transport
+        # None - make_rate_limiter() при запуске потока отправки
+        self.limiter = limiter
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    # --- Публичный API ---
+    def enqueue(self, chat_id, text, method='sendMessage', **params):
+        """
+        Ставит сообщение в очередь и сразу возвращает concurrent.futures.Future
+        с ответом Telegram. Можно вызывать и из синхронного кода, и из корутин.
+        """
+        if not self.token:
+            raise TelegramSendError("Токен бота не задан")
+        self._ensure_started()
+        payload = {'chat_id': chat_id, **{key: self._serialize(value) for key, value in params.items()}}
+        if text is not None:
+            payload['text'] = text
+        future = concurrent.futures.Future()
+        self._loop.call_soon_threadsafe(self._put, chat_id, [method, payload, future, 0])
+        return future
+
+    async def send(self, chat_id, text, method='sendMessage', **params):
+        """Асинхронная отправка: ждет, пока сообщение будет доставлено."""
+        return await asyncio.wrap_future(self.enqueue(chat_id, text, method, **params))
+
+    def stop(self, timeout=10.0):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает поток."""
+        with self._start_lock:
+            if self._thread is None:
+                return
+            loop, self._loop = self._loop, None
+            asyncio.run_coroutine_threadsafe(self._drain(timeout), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join()
+            self._thread = None
+
+    # --- Поток отправки ---
+    def _ensure_started(self):
+        if self._loop is not None:
+            return
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(loop, ready), name='telegram-outbox', daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+
+    def _run_loop(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        self._client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.global_rate, max_keepalive_connections=self.global_rate),
+            transport=self.transport,
+        )
+        self._limiter = self.limiter or make_rate_limiter()
+        self._queues = {}  # chat_id -> deque[[method, payload, future, попытки]]
+        self._ready = []  # куча (время готовности, порядковый номер, chat_id)
+        self._sequence = itertools.count()
+        self._chat_next_at = {}  # когда в чат можно писать снова
+        self._paused_until = 0
+        self._in_flight = set()
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+        worker = loop.create_task(self._dispatch())
+        ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            worker.cancel()
+            loop.run_until_complete(asyncio.gather(worker, return_exceptions=True))
+            loop.run_until_complete(self._client.aclose())
+            loop.run_until_complete(self._limiter.close())
+            loop.close()
+
+    def _put(self, chat_id, item):
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+        queue.append(item)
+        if len(queue) == 1 and chat_id not in self._in_flight:
+            self._schedule(chat_id, self._chat_next_at.pop(chat_id, 0))
+
+    def _schedule(self, chat_id, ready_at):
+        heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            ready_at, _, chat_id = self._ready[0]
+            delay = max(ready_at, self._paused_until) - loop.time()
+            if delay <= 0:
+                # Пока ждем лимит, в кучу могут добавиться чаты: запись снимается заранее
+                entry = heapq.heappop(self._ready)
+                delay, chat_wait = await self._limiter.acquire(chat_id, self.chat_interval)
+                if chat_wait > 0:
+                    # В этот чат недавно писал другой процесс: ждет только он
+                    heapq.heappush(self._ready, (loop.time() + chat_wait, entry[1], chat_id))
+                    continue
+                if delay > 0:
+                    heapq.heappush(self._ready, entry)
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._in_flight.add(chat_id)
+            task = loop.create_task(self._deliver(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, chat_id):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[chat_id]
+        item = queue[0]
+        method, payload, future, _ = item
+        retry_at = None
+        try:
+            while True:
+                item[3] += 1
+                started = time.perf_counter()
+                try:
+                    response = await self._client.post(f"{self.base_url}{self.token}/{method}", json=payload)
+                    data = response.json()
+                except (httpx.HTTPError, ValueError) as e:
+                    data = {'ok': False, 'description': str(e)}
+                metrics.record_telegram_call(method, bool(data.get('ok')), time.perf_counter() - started)
+                if data.get('ok'):
+                    self._resolve(future, result=data.get('result'))
+                    break
+                retry_after = data.get('parameters', {}).get('retry_after')
+                if retry_after and item[3] < self.max_attempts:
+                    # Лимит превышен: Telegram сам говорит, сколько ждать; паузу выдерживает вся очередь
+                    logger.warning(f"Telegram 429 для чата {chat_id}, пауза {retry_after} с")
+                    retry_at = loop.time() + retry_after
+                    self._paused_until = max(self._paused_until, retry_at)
+                    await self._limiter.pause(retry_after)
+                    return
+                if item[3] >= self.max_attempts or data.get('error_code', 500) < 500:
+                    logger.error(f"Не удалось отправить сообщение в чат {chat_id}: {data.get('description')}")
+                    self._resolve(future, error=TelegramSendError(data.get('description', 'unknown error')))
+                    break
+                await asyncio.sleep(min(2 ** item[3], 30))
+            queue.popleft()
+        finally:
+            self._in_flight.discard(chat_id)
+            next_at = retry_at or loop.time() + self.chat_interval
+            if queue:
+                self._schedule(chat_id, next_at)
+            else:
+                del self._queues[chat_id]
+                self._chat_next_at[chat_id] = next_at
+                if len(self._chat_next_at) > 10000:
+                    now = loop.time()
+                    self._chat_next_at = {key: at for key, at in self._chat_next_at.items() if at > now}
+
+    async def _drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while (self._queues or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._queues:
+            logger.warning(f"Очередь отправки остановлена, не отправлено чатов: {len(self._queues)}")
+
+    @staticmethod
+    def _resolve(future, result=None, error=None):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def _serialize(value):
+        # Объекты python-telegram-bot (клавиатуры) передаются как словари
+        return value.to_dict() if hasattr(value, 'to_dict') else value
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox(
+                    token=settings.BOT_TOKEN,
+                    base_url=settings.TELEGRAM_API_URL,
+                    global_rate=settings.OUTBOX_GLOBAL_RATE,
+                    chat_interval=settings.OUTBOX_CHAT_INTERVAL,
+                )
+                # Админка и gunicorn сами очередь не останавливают: остаток отправляется при выходе процесса
+                atexit.register(stop_outbox)
+    return _outbox
+
+
+def configure_outbox(**kwargs):
+    """Переопределяет параметры очереди (например, base_url заглушки Bot API) до первой отправки."""
+    outbox = get_outbox()
+    for name, value in kwargs.items():
+        if value is not None:
+            setattr(outbox, name, value.rstrip('/') if name == 'base_url' else value)
+    return outbox
+
+
+def stop_outbox(timeout=10.0):
+    if _outbox is not None:
+        _outbox.stop(timeout)
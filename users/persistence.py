@@ -0,0 +1,191 @@
+# users/persistence.py
+
+import asyncio
+import copy
+import json
+import logging
+
+from django.db import transaction
+from telegram.ext import BasePersistence, PersistenceInput
+
+from .db_executor import db_async
+from .models import BotPersistenceRecord
+
+logger = logging.getLogger(__name__)
+
+Kind = BotPersistenceRecord.Kind
+_DELETED = object()
+
+
+def conversation_key_to_str(key):
+    return json.dumps(list(key))
+
+
+def conversation_key_from_str(value):
+    return tuple(json.loads(value))
+
+
+# --- Функции для работы с БД ---
+def load_record(kind, key, name=''):
+    record = BotPersistenceRecord.objects.filter(kind=kind, name=name, key=key).only('data').first()
+    return record.data if record else None
+
+
+def load_conversations(name):
+    records = BotPersistenceRecord.objects.filter(kind=Kind.CONVERSATION, name=name).values_list('key', 'data')
+    return {conversation_key_from_str(key): state for key, state in records}
+
+
+@transaction.atomic
+def write_records(changes):
+    """
+    Записывает накопленные изменения одной транзакцией:
+    changes - словарь (kind, name, key) -> данные или _DELETED.
+    """
+    upserts = []
+    deletes = {}
+    for (kind, name, key), data in changes.items():
+        if data is _DELETED:
+            deletes.setdefault((kind, name), []).append(key)
+        else:
+            upserts.append(BotPersistenceRecord(kind=kind, name=name, key=key, data=data))
+    if upserts:
+        BotPersistenceRecord.objects.bulk_create(
+            upserts,
+            update_conflicts=True,
+            unique_fields=['kind', 'name', 'key'],
+            update_fields=['data', 'updated_at'],
+        )
+    for (kind, name), keys in deletes.items():
+        BotPersistenceRecord.objects.filter(kind=kind, name=name, key__in=keys).delete()
+
+
+load_record_async = db_async(load_record)
+load_conversations_async = db_async(load_conversations)
+write_records_async = db_async(write_records)
+
+
+class DjangoPersistence(BasePersistence):
+    """
+    Хранилище состояния бота в БД вместо PicklePersistence.
+
+    - user_data/chat_data загружаются лениво, при первом апдейте от пользователя/чата;
+    - записываются только изменившиеся пользователи, чаты и диалоги;
+    - изменения копятся в памяти и пишутся одной транзакцией раз в flush_delay
+      секунд или сразу после batch_size изменений.
+    """
+
+    def __init__(self, flush_delay=1.0, batch_size=500, update_interval=60):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.flush_delay = flush_delay
+        self.batch_size = batch_size
+        self._pending = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._loaded_users = set()
+        self._loaded_chats = set()
+        self._bot_data = None
+
+    # --- Загрузка ---
+    async def get_user_data(self):
+        # Данные пользователей подгружаются в refresh_user_data
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        self._bot_data = await load_record_async(Kind.BOT_DATA, '') or {}
+        return copy.deepcopy(self._bot_data)
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return await load_conversations_async(name)
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        stored = await load_record_async(Kind.USER_DATA, str(user_id))
+        if stored:
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        if chat_id in self._loaded_chats:
+            return
+        self._loaded_chats.add(chat_id)
+        stored = await load_record_async(Kind.CHAT_DATA, str(chat_id))
+        if stored:
+            for key, value in stored.items():
+                chat_data.setdefault(key, value)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Изменения ---
+    # Application передает живые словари: обработчики меняют их и дальше, а запись
+    # в БД идет позже в другом потоке. Поэтому в очередь кладутся копии.
+    async def update_user_data(self, user_id, data):
+        self._loaded_users.add(user_id)
+        await self._add_change(Kind.USER_DATA, '', str(user_id), copy.deepcopy(data))
+
+    async def update_chat_data(self, chat_id, data):
+        self._loaded_chats.add(chat_id)
+        await self._add_change(Kind.CHAT_DATA, '', str(chat_id), copy.deepcopy(data))
+
+    async def update_bot_data(self, data):
+        # Application передает bot_data на каждом цикле, даже без изменений;
+        # сравнение - с копией, сохраненной в прошлый раз
+        if data == self._bot_data:
+            return
+        self._bot_data = copy.deepcopy(data)
+        await self._add_change(Kind.BOT_DATA, '', '', self._bot_data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        data = _DELETED if new_state is None else new_state
+        await self._add_change(Kind.CONVERSATION, name, conversation_key_to_str(key), data)
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        await self._add_change(Kind.USER_DATA, '', str(user_id), _DELETED)
+
+    async def drop_chat_data(self, chat_id):
+        self._loaded_chats.discard(chat_id)
+        await self._add_change(Kind.CHAT_DATA, '', str(chat_id), _DELETED)
+
+    async def flush(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._flush_task = None
+        await self._write_pending()
+
+    # --- Пакетная запись ---
+    async def _add_change(self, kind, name, key, data):
+        self._pending[(kind, name, key)] = data
+        if len(self._pending) >= self.batch_size:
+            await self._write_pending()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            changes, self._pending = self._pending, {}
+            try:
+                await write_records_async(changes)
+            except Exception:
+                # Возвращаем изменения в очередь, не затирая более свежие
+                for record_key, data in changes.items():
+                    self._pending.setdefault(record_key, data)
+                logger.exception(f"Не удалось сохранить состояние бота ({len(changes)} записей)")
@@ -0,0 +1,212 @@
+# users/rate_limit.py
+
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Методы Bot API, которые Telegram считает отправкой сообщений
+SEND_METHOD_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+# Лимит на Redis (GCRA): ключ хранит время, раньше которого следующая отправка не разрешена.
+# Проверка и учет отправки - одна атомарная операция для всех процессов.
+# Возвращает {ждать_глобально_мс, ждать_чат_мс}; {0, 0} - отправка разрешена и учтена.
+ACQUIRE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + tonumber(now[2]) / 1000
+local global_interval = tonumber(ARGV[1])
+local chat_interval = tonumber(ARGV[2])
+local global_at = tonumber(redis.call('GET', KEYS[1]) or 0)
+local global_wait = math.max(0, global_at - now)
+local chat_wait = 0
+if KEYS[2] then
+    chat_wait = math.max(0, tonumber(redis.call('GET', KEYS[2]) or 0) - now)
+end
+if global_wait > 0 or chat_wait > 0 then
+    return {math.ceil(global_wait), math.ceil(chat_wait)}
+end
+redis.call('SET', KEYS[1], math.max(global_at, now) + global_interval, 'PX', math.ceil(global_interval) + 1000)
+if KEYS[2] and chat_interval > 0 then
+    redis.call('SET', KEYS[2], now + chat_interval, 'PX', math.ceil(chat_interval) + 1000)
+end
+return {0, 0}
+"""
+
+# Пауза после 429: глобальный ключ сдвигается не раньше, чем на retry_after
+PAUSE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + tonumber(now[2]) / 1000
+local until_at = now + tonumber(ARGV[1])
+local global_at = tonumber(redis.call('GET', KEYS[1]) or 0)
+if until_at > global_at then
+    redis.call('SET', KEYS[1], until_at, 'PX', math.ceil(tonumber(ARGV[1])) + 1000)
+end
+return 0
+"""
+
+
+class TokenBucket:
+    """
+    Глобальный лимит отправки: rate сообщений в секунду.
+    capacity - допустимый всплеск; по умолчанию 1, чтобы не превышать rate в любом окне в 1 секунду.
+    Потокобезопасен: общий для очереди отправки (свой поток) и ответов бота.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Забирает токен и возвращает 0 или сообщает, сколько секунд ждать следующего."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class LocalRateLimiter:
+    """
+    Лимит в памяти процесса. Интервал между сообщениями в один чат соблюдает
+    сама очередь отправки, поэтому здесь только глобальный лимит и пауза после 429.
+    """
+
+    def __init__(self, rate):
+        self.bucket = TokenBucket(rate)
+        # Пауза после 429 от любого отправителя: и очереди, и ответов бота
+        self.paused_until = 0.0
+
+    async def acquire(self, chat_id=None, chat_interval=0):
+        """(ждать_глобально, ждать_чат) в секундах; (0, 0) - отправка разрешена и учтена."""
+        paused = self.paused_until - time.monotonic()
+        if paused > 0:
+            return paused, 0
+        return self.bucket.delay(), 0
+
+    async def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def close(self):
+        pass
+
+
+class RedisRateLimiter:
+    """
+    Лимит, общий для всех процессов (runbot, Daphne, админка): счетчики в Redis.
+    Клиент Redis привязан к циклу событий, поэтому у каждого цикла свой экземпляр.
+    Если Redis недоступен, отправка не останавливается: лимит считается в процессе.
+    """
+
+    RETRY_SECONDS = 5.0
+
+    def __init__(self, url, rate, prefix='myroute:telegram'):
+        self.url = url
+        self.rate = rate
+        self.global_key = f'{prefix}:global'
+        self.chat_key_prefix = f'{prefix}:chat:'
+        self.fallback = LocalRateLimiter(rate)
+        # После ошибки Redis не опрашивается RETRY_SECONDS: не тратим время каждой отправки
+        self._retry_at = 0.0
+        self._client = None
+        self._acquire = None
+        self._pause = None
+
+    def _connect(self):
+        if self._client is None:
+            import redis.asyncio
+            self._client = redis.asyncio.Redis.from_url(self.url)
+            self._acquire = self._client.register_script(ACQUIRE_SCRIPT)
+            self._pause = self._client.register_script(PAUSE_SCRIPT)
+
+    async def acquire(self, chat_id=None, chat_interval=0):
+        """(ждать_глобально, ждать_чат) в секундах; (0, 0) - отправка разрешена и учтена."""
+        if time.monotonic() < self._retry_at:
+            return await self.fallback.acquire(chat_id, chat_interval)
+        keys = [self.global_key]
+        if chat_id is not None:
+            keys.append(f'{self.chat_key_prefix}{chat_id}')
+        try:
+            self._connect()
+            global_wait, chat_wait = await self._acquire(keys=keys, args=[1000 / self.rate, chat_interval * 1000])
+        except Exception as e:
+            logger.warning(f"Redis для лимита Bot API недоступен, {self.RETRY_SECONDS:g} с лимит считается в процессе: {e}")
+            self._retry_at = time.monotonic() + self.RETRY_SECONDS
+            return await self.fallback.acquire(chat_id, chat_interval)
+        return global_wait / 1000, chat_wait / 1000
+
+    async def pause(self, seconds):
+        try:
+            self._connect()
+            await self._pause(keys=[self.global_key], args=[seconds * 1000])
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить паузу Bot API в Redis: {e}")
+            await self.fallback.pause(seconds)
+
+    async def close(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+
+_local_limiter = None
+_local_limiter_lock = threading.Lock()
+
+
+def make_rate_limiter():
+    """
+    Лимит для нового цикла событий: Redis, если задан TELEGRAM_RATE_LIMIT_REDIS_URL,
+    иначе один лимит в памяти на процесс.
+    """
+    global _local_limiter
+    if settings.TELEGRAM_RATE_LIMIT_REDIS_URL:
+        return RedisRateLimiter(settings.TELEGRAM_RATE_LIMIT_REDIS_URL, settings.OUTBOX_GLOBAL_RATE)
+    with _local_limiter_lock:
+        if _local_limiter is None:
+            _local_limiter = LocalRateLimiter(settings.OUTBOX_GLOBAL_RATE)
+        return _local_limiter
+
+
+class BotRateLimiter(BaseRateLimiter):
+    """
+    Ответы бота (context.bot, reply_text) расходуют тот же глобальный лимит, что
+    и очередь отправки. Интервал чата к ним не применяется: на апдейт пользователь
+    ждет ответа сразу, часто из нескольких сообщений.
+    """
+
+    def __init__(self, limiter=None):
+        self.limiter = limiter
+
+    async def initialize(self):
+        if self.limiter is None:
+            self.limiter = make_rate_limiter()
+
+    async def shutdown(self):
+        if self.limiter is not None:
+            await self.limiter.close()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint.startswith(SEND_METHOD_PREFIXES):
+            while True:
+                wait, _ = await self.limiter.acquire()
+                if not wait:
+                    break
+                await asyncio.sleep(wait)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            # Пауза действует на всех отправителей, а ошибку обрабатывает бот, как раньше
+            retry_after = e.retry_after
+            await self.limiter.pause(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after)
+            raise
@@ -0,0 +1,61 @@
+# users/ratings.py
+
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Sum
+from django.db.models.functions import Cast
+
+from trips.models import Rating
+from .models import User
+from .user_cache import invalidate_user
+
+
+def apply_rating(user_id, score):
+    """
+    Учитывает новую оценку одним UPDATE: сумма, количество и среднее
+    считаются в БД от текущих значений строки, без чтения всех оценок.
+    """
+    return User.objects.filter(id=user_id).update(
+        rating_sum=F('rating_sum') + score,
+        rating_count=F('rating_count') + 1,
+        # В UPDATE правая часть видит значения строки до изменения
+        average_rating=Cast(F('rating_sum') + score, FloatField()) / (F('rating_count') + 1),
+    )
+
+
+@transaction.atomic
+def add_rating(rater, rated_user, trip, score):
+    """Сохраняет оценку и обновляет рейтинг получателя в одной транзакции."""
+    rating = Rating.objects.create(rater=rater, rated_user=rated_user, trip=trip, score=score)
+    apply_rating(rated_user.id, score)
+    transaction.on_commit(lambda: invalidate_user(rated_user.telegram_id))
+    return rating
+
+
+def compute_rating_aggregates():
+    """Возвращает {user_id: (сумма, количество)} по таблице оценок."""
+    rows = Rating.objects.values('rated_user').annotate(total=Sum('score'), count=Count('id'))
+    return {row['rated_user']: (row['total'], row['count']) for row in rows.iterator()}
+
+
+def find_rating_mismatches(batch_size=2000):
+    """Пользователи, у которых сохраненный рейтинг расходится с таблицей оценок."""
+    expected = compute_rating_aggregates()
+    users = User.objects.only('id', 'telegram_id', 'rating_sum', 'rating_count', 'average_rating').iterator(chunk_size=batch_size)
+    mismatches = []
+    for user in users:
+        total, count = expected.get(user.id, (0, 0))
+        average = total / count if count else 0.0
+        if (user.rating_sum, user.rating_count) != (total, count) or abs(user.average_rating - average) > 1e-9:
+            user.rating_sum, user.rating_count, user.average_rating = total, count, average
+            mismatches.append(user)
+    return mismatches
+
+
+def rebuild_rating_aggregates(batch_size=2000):
+    """Исправляет расхождения пакетным bulk_update. Возвращает число исправленных пользователей."""
+    mismatches = find_rating_mismatches(batch_size)
+    with transaction.atomic():
+        User.objects.bulk_update(mismatches, ['rating_sum', 'rating_count', 'average_rating'], batch_size=batch_size)
+    for user in mismatches:
+        invalidate_user(user.telegram_id)
+    return len(mismatches)
@@ -1,3 +1,715 @@
-from django.test import TestCase
+import asyncio
+import functools
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
 
-# Create your tests here.
+import httpx
+from django.contrib import admin
+from django.contrib.auth.models import Group
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from telegram.error import RetryAfter
+from telegram.ext import ConversationHandler
+
+from support.models import ChatMessage, SupportTicket
+from support.writer import get_chat_writer
+from trips.models import Booking, City, CityAlias, Trip, Vehicle
+
+from . import db_executor, outbox as outbox_module
+from .keyboards import MY_BOOKINGS_BTN, MY_PROFILE_BTN, MY_TRIPS_BTN, SUPPORT_BTN, TRIP_HISTORY_BTN
+from .management.commands import runbot
+from .management.commands.loadtest_bot import TELEGRAM_ID_BASE, Harness, SyntheticUser, verify_drivers
+from .metrics import configure_metrics, metrics, register_update_processor
+from .models import BotPersistenceRecord, User
+from .outbox import Outbox, get_outbox, stop_outbox
+from .persistence import DjangoPersistence
+from .ratings import add_rating, apply_rating
+from .rate_limit import BotRateLimiter, LocalRateLimiter
+from .update_processor import PerChatUpdateProcessor
+from .user_cache import UserCache, invalidate_user, user_cache
+
+Kind = BotPersistenceRecord.Kind
+SAVEPOINT_RE = re.compile(r'(RELEASE |ROLLBACK TO )?SAVEPOINT ')
+
+
+class DjangoPersistenceTests(SimpleTestCase):
+    """Очередь записи без БД: flush_delay больше времени теста."""
+
+    def setUp(self):
+        self.persistence = DjangoPersistence(flush_delay=3600)
+
+    def tearDown(self):
+        if self.persistence._flush_task:
+            self.persistence._flush_task.cancel()
+
+    async def test_bot_data_changes_after_first_write_are_queued(self):
+        bot_data = {'counters': {'trips': 1}}
+        await self.persistence.update_bot_data(bot_data)
+        self.persistence._pending.clear()
+        bot_data['counters']['trips'] = 2
+        await self.persistence.update_bot_data(bot_data)
+        self.assertEqual(self.persistence._pending[(Kind.BOT_DATA, '', '')], {'counters': {'trips': 2}})
+
+    async def test_queued_user_data_is_a_snapshot(self):
+        user_data = {'search': {'date': '2026-10-20'}}
+        await self.persistence.update_user_data(7, user_data)
+        user_data['search']['date'] = '2026-10-21'
+        self.assertEqual(self.persistence._pending[(Kind.USER_DATA, '', '7')], {'search': {'date': '2026-10-20'}})
+
+
+class UserCacheTests(SimpleTestCase):
+    def user(self, telegram_id):
+        return User(telegram_id=telegram_id, name=f'Пользователь {telegram_id}')
+
+    def test_entries_expire_after_ttl(self):
+        cache = UserCache(maxsize=10, ttl=60)
+        user = self.user(1)
+        with patch('users.user_cache.time.monotonic', return_value=1000.0):
+            cache.set(user)
+        with patch('users.user_cache.time.monotonic', return_value=1059.0):
+            self.assertIs(cache.get(1), user)
+        with patch('users.user_cache.time.monotonic', return_value=1061.0):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = UserCache(maxsize=2, ttl=60)
+        for telegram_id in (1, 2):
+            cache.set(self.user(telegram_id))
+        cache.get(1)
+        cache.set(self.user(3))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNotNone(cache.get(3))
+
+    def test_invalidate(self):
+        cache = UserCache(maxsize=10, ttl=60)
+        cache.set(self.user(1))
+        cache.set(User(name='Без Telegram'))
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+
+class BotUserLookupTests(TestCase):
+    """Пользователь бота читается из БД один раз и перечитывается после изменений."""
+
+    def setUp(self):
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        User.objects.create(username='user_5', telegram_id=5, name='Пассажир')
+
+    def test_cached_until_changed(self):
+        with self.assertNumQueries(1):
+            user = runbot.get_user(5)
+            self.assertIs(runbot.get_user(5), user)
+        runbot.update_user_role(user, User.Role.DRIVER)
+        with self.assertNumQueries(1):
+            reloaded = runbot.get_user(5)
+        self.assertIsNot(reloaded, user)
+        self.assertEqual(reloaded.verification_status, User.VerificationStatus.PENDING)
+
+    def test_admin_verification_invalidates(self):
+        user = runbot.get_user(5)
+        User.objects.filter(id=user.id).update(verification_status=User.VerificationStatus.VERIFIED)
+        invalidate_user(5)
+        self.assertEqual(runbot.get_user(5).verification_status, User.VerificationStatus.VERIFIED)
+
+    def assert_no_lost_update(self, change):
+        user = runbot.get_user(5)
+        # Пока пользователь лежит в кэше, админка проверила его, а поездка получила оценку
+        User.objects.filter(id=user.id).update(
+            verification_status=User.VerificationStatus.VERIFIED, rating_sum=5, rating_count=1, average_rating=5.0,
+        )
+        change(user)
+        user.refresh_from_db()
+        self.assertEqual((user.rating_sum, user.rating_count, user.average_rating), (5, 1, 5.0))
+        return user
+
+    def test_language_change_keeps_concurrent_updates(self):
+        user = self.assert_no_lost_update(lambda user: runbot.update_user_language(user, 'en'))
+        self.assertEqual(user.language, 'en')
+        self.assertEqual(user.verification_status, User.VerificationStatus.VERIFIED)
+
+    def test_phone_change_keeps_concurrent_updates(self):
+        user = self.assert_no_lost_update(lambda user: runbot.update_user_phone(user, '+79990000000'))
+        self.assertEqual(user.phone_number, '+79990000000')
+        self.assertEqual(user.verification_status, User.VerificationStatus.VERIFIED)
+
+    def test_role_change_keeps_concurrent_updates(self):
+        user = self.assert_no_lost_update(lambda user: runbot.update_user_role(user, User.Role.PASSENGER))
+        self.assertEqual(user.role, User.Role.PASSENGER)
+        self.assertEqual(user.verification_status, User.VerificationStatus.VERIFIED)
+        # Смена роли на водителя отправляет на проверку
+        user = self.assert_no_lost_update(lambda user: runbot.update_user_role(user, User.Role.DRIVER))
+        self.assertEqual(user.verification_status, User.VerificationStatus.PENDING)
+
+    async def test_current_user_is_loaded_once_per_update(self):
+        user = User(telegram_id=5, name='Пассажир')
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=5))
+        context = SimpleNamespace()
+        with patch.object(runbot, 'get_user_async', AsyncMock(return_value=user)) as get_user_async:
+            self.assertIs(await runbot.get_current_user(update, context), user)
+            self.assertIs(await runbot.get_current_user(update, context), user)
+        get_user_async.assert_awaited_once_with(5)
+
+
+class RatingAggregateTests(TestCase):
+    """Рейтинг пользователя: сумма, количество и среднее ведутся в БД (users/ratings.py)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver', telegram_id=1, name='Водитель', role=User.Role.DRIVER)
+        cls.passengers = [
+            User.objects.create(username=f'passenger{n}', telegram_id=10 + n, name=f'Пассажир {n}') for n in range(3)
+        ]
+        vehicle = Vehicle.objects.create(driver=cls.driver, brand='Lada', model='Vesta', license_plate='A001AA')
+        cls.trip = Trip.objects.create(
+            driver=cls.driver, vehicle=vehicle, departure_location='Москва', destination_location='Сочи',
+            departure_time=timezone.now() + timedelta(days=1), available_seats=3, price=Decimal('500'),
+        )
+
+    def setUp(self):
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+
+    def assert_rating(self, user, rating_sum, rating_count, average):
+        user.refresh_from_db()
+        self.assertEqual((user.rating_sum, user.rating_count), (rating_sum, rating_count))
+        self.assertAlmostEqual(user.average_rating, average)
+
+    def test_average_is_computed_in_update(self):
+        apply_rating(self.driver.id, 5)
+        self.assert_rating(self.driver, 5, 1, 5.0)
+        apply_rating(self.driver.id, 2)
+        # Целочисленное деление дало бы 3
+        self.assert_rating(self.driver, 7, 2, 3.5)
+
+    def test_ratings_through_stale_instances_all_count(self):
+        # Как два процесса бота: у каждого свой экземпляр, прочитанный до обеих оценок
+        first, second = User.objects.get(id=self.driver.id), User.objects.get(id=self.driver.id)
+        add_rating(self.passengers[0], first, self.trip, 5)
+        add_rating(self.passengers[1], second, self.trip, 4)
+        self.assertEqual(first.rating_count, 0)
+        self.assert_rating(self.driver, 9, 2, 4.5)
+
+    def test_cache_is_invalidated_on_commit(self):
+        user_cache.set(self.driver)
+        with self.captureOnCommitCallbacks(execute=True):
+            add_rating(self.passengers[0], self.driver, self.trip, 4)
+            # До фиксации транзакции другие потоки еще читают старый рейтинг - запись остается
+            self.assertIs(user_cache.get(self.driver.telegram_id), self.driver)
+        self.assertIsNone(user_cache.get(self.driver.telegram_id))
+
+    def test_rebuild_ratings_verify_and_fix(self):
+        for passenger, score in zip(self.passengers, (5, 4, 3)):
+            add_rating(passenger, self.driver, self.trip, score)
+        add_rating(self.driver, self.passengers[0], self.trip, 2)
+        call_command('rebuild_ratings', '--verify', stdout=StringIO())
+        # Сбой вне add_rating: агрегаты водителя разошлись с таблицей оценок
+        User.objects.filter(id=self.driver.id).update(rating_sum=1, rating_count=1, average_rating=1.0)
+        user_cache.set(User.objects.get(id=self.driver.id))
+        stdout = StringIO()
+        with self.assertRaisesMessage(CommandError, 'Расхождений: 1'):
+            call_command('rebuild_ratings', '--verify', stdout=stdout)
+        self.assertIn('ожидается сумма 12, оценок 3, среднее 4.00', stdout.getvalue())
+        self.assert_rating(self.driver, 1, 1, 1.0)
+
+        stdout = StringIO()
+        call_command('rebuild_ratings', stdout=stdout)
+        self.assertIn('Исправлено пользователей: 1', stdout.getvalue())
+        self.assert_rating(self.driver, 12, 3, 4.0)
+        self.assert_rating(self.passengers[0], 2, 1, 2.0)
+        self.assertIsNone(user_cache.get(self.driver.telegram_id))
+        call_command('rebuild_ratings', '--verify', stdout=StringIO())
+
+
+class UpdateProcessorMetricsTests(SimpleTestCase):
+    async def test_queue_depth_is_exported(self):
+        processor = PerChatUpdateProcessor(concurrency=1)
+        register_update_processor(processor)
+        self.addCleanup(metrics._readings.clear)
+        release = asyncio.Event()
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=1))
+        # Два апдейта одного чата и один другого: второй ждет свой чат, третий - слот
+        tasks = [
+            asyncio.create_task(processor.do_process_update(update, release.wait())),
+            asyncio.create_task(processor.do_process_update(update, release.wait())),
+            asyncio.create_task(processor.do_process_update(SimpleNamespace(effective_chat=SimpleNamespace(id=2)), release.wait())),
+        ]
+        await asyncio.sleep(0)
+        rendered = metrics.render()
+        self.assertIn('bot_updates_active 1\n', rendered)
+        self.assertIn('bot_updates_pending 2\n', rendered)
+        self.assertIn('bot_updates_chats 2\n', rendered)
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertIn('bot_updates_processed_total 3\n', metrics.render())
+        self.assertIn('bot_updates_pending 0\n', metrics.render())
+
+
+class ChatBusyLimiter(LocalRateLimiter):
+    """Общий лимит, в котором в чат 1 только что писал другой процесс."""
+
+    def __init__(self):
+        super().__init__(rate=1000)
+        self.busy = {1: 0.2}
+        self.acquired = []
+
+    async def acquire(self, chat_id=None, chat_interval=0):
+        wait = self.busy.pop(chat_id, 0)
+        if wait:
+            return 0, wait
+        self.acquired.append(chat_id)
+        return await super().acquire(chat_id, chat_interval)
+
+
+class OutboxRateLimitTests(SimpleTestCase):
+    def test_chat_busy_in_another_process_does_not_block_others(self):
+        sent = []
+
+        def handler(request):
+            sent.append(json.loads(request.content)['chat_id'])
+            return httpx.Response(200, json={'ok': True, 'result': {}})
+
+        limiter = ChatBusyLimiter()
+        outbox = Outbox('1:test', 'http://telegram.test/bot', transport=httpx.MockTransport(handler), limiter=limiter)
+        self.addCleanup(outbox.stop)
+        first = outbox.enqueue(1, 'Первое')
+        second = outbox.enqueue(2, 'Второе')
+        first.result(timeout=5)
+        second.result(timeout=5)
+        self.assertEqual(sent, [2, 1])
+        self.assertEqual(limiter.acquired, [2, 1])
+
+    async def test_bot_replies_take_global_tokens(self):
+        limiter = LocalRateLimiter(rate=1000)
+        bot_limiter = BotRateLimiter(limiter)
+        callback = AsyncMock(return_value=True)
+        await bot_limiter.process_request(callback, (), {}, 'sendMessage', {'chat_id': 1}, None)
+        # Токен забран ответом: следующий доступен только через 1/rate секунды
+        self.assertGreater(limiter.bucket.delay(), 0)
+        await bot_limiter.process_request(callback, (), {}, 'answerCallbackQuery', {}, None)
+        self.assertEqual(callback.await_count, 2)
+
+    async def test_retry_after_pauses_local_limiter(self):
+        limiter = LocalRateLimiter(rate=1000)
+        bot_limiter = BotRateLimiter(limiter)
+        with self.assertRaises(RetryAfter):
+            await bot_limiter.process_request(AsyncMock(side_effect=RetryAfter(5)), (), {}, 'sendMessage', {}, None)
+        # Без Redis пауза после 429 тоже общая: очередь отправки ждет вместе с ответами бота
+        wait, _ = await limiter.acquire(2)
+        self.assertGreater(wait, 4)
+
+    def test_outbox_is_stopped_at_exit(self):
+        with patch.object(outbox_module, '_outbox', None), patch.object(outbox_module.atexit, 'register') as register:
+            get_outbox()
+        register.assert_called_once_with(stop_outbox)
+
+
+@override_settings(BOT_WEBHOOK_SECRET='secret')
+class TelegramWebhookTests(SimpleTestCase):
+    def post(self, body):
+        application = SimpleNamespace(update_queue=SimpleNamespace(put=AsyncMock()), bot=None)
+        with patch('users.views.get_application', return_value=application):
+            response = self.client.post(
+                reverse('telegram_webhook'), body, content_type='application/json',
+                headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'},
+            )
+        return response, application.update_queue.put
+
+    def test_update_is_queued(self):
+        response, put = self.post('{"update_id": 1}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(put.await_args.args[0].update_id, 1)
+
+    def test_malformed_body_is_rejected(self):
+        for body in ('not json', '[]', '1', '{}', '{"update_id": 1, "message": 5}'):
+            response, put = self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+            put.assert_not_awaited()
+
+
+class QueryCountTestMixin:
+    """
+    Проверки числа запросов к БД. assertMaxQueries - бюджет на один шаг (обработчик бота);
+    assert_same_queries - число запросов не растет с числом записей (N+1).
+    """
+
+    def count_queries(self, run):
+        with CaptureQueriesContext(connection) as context:
+            run()
+        return context
+
+    @contextmanager
+    def assertMaxQueries(self, budget, label):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        # Точки сохранения - от транзакции TestCase вокруг теста, в работе их нет
+        queries = [query['sql'] for query in context.captured_queries if not SAVEPOINT_RE.match(query['sql'])]
+        self.assertLessEqual(
+            len(queries), budget, f"{label}: {len(queries)} запросов при бюджете {budget}\n" + "\n".join(queries),
+        )
+
+    def assert_same_queries(self, label, fewer, more):
+        self.assertEqual(
+            len(fewer), len(more),
+            f"{label}: {len(fewer)} -> {len(more)} запросов с ростом числа записей\n"
+            + "\n".join(query['sql'] for query in more.captured_queries),
+        )
+
+
+class BotQueryCountTests(QueryCountTestMixin, TestCase):
+    """Страницы списков и поиска бота: запрос за страницу, сколько бы записей на ней ни было."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.driver = User.objects.create(username='driver', telegram_id=1, name='Водитель', role=User.Role.DRIVER)
+        cls.passengers = [
+            User.objects.create(username=f'passenger{n}', telegram_id=10 + n, name=f'Пассажир {n}', role=User.Role.PASSENGER)
+            for n in range(3)
+        ]
+        cls.departure = timezone.localtime() + timedelta(days=2)
+        statuses = [Trip.Status.ACTIVE] * 4 + [Trip.Status.COMPLETED] * 2 + [Trip.Status.CANCELED] * 2
+        cls.trips = []
+        for n, status in enumerate(statuses):
+            vehicle = Vehicle.objects.create(driver=cls.driver, brand='Lada', model='Vesta', license_plate=f'A{n:03}AA')
+            trip = Trip.objects.create(
+                driver=cls.driver, vehicle=vehicle, departure_location='Москва', destination_location='Сочи',
+                departure_time=cls.departure + timedelta(minutes=n), available_seats=4, price=Decimal('500'), status=status,
+            )
+            Booking.objects.create(passenger=cls.passengers[0], trip=trip, seats_booked=1)
+            cls.trips.append(trip)
+
+    def assert_page_queries(self, label, render):
+        render()  # кэши процесса (справочник городов и т.п.) - не в счет
+        with override_settings(BOT_LIST_PAGE_SIZE=1):
+            single = self.count_queries(render)
+        with override_settings(BOT_LIST_PAGE_SIZE=4):
+            full = self.count_queries(render)
+        self.assert_same_queries(label, single, full)
+
+    def test_list_pages(self):
+        lists = {
+            runbot.LIST_ACTIVE_TRIPS: (self.driver, runbot.get_driver_trips_page, [Trip.Status.ACTIVE]),
+            runbot.LIST_DRIVER_HISTORY: (self.driver, runbot.get_driver_trips_page, runbot.HISTORY_STATUSES),
+            runbot.LIST_ACTIVE_BOOKINGS: (self.passengers[0], runbot.get_passenger_bookings_page, [Trip.Status.ACTIVE]),
+            runbot.LIST_PASSENGER_HISTORY: (self.passengers[0], runbot.get_passenger_bookings_page, runbot.HISTORY_STATUSES),
+        }
+        for list_name, (user, load, statuses) in lists.items():
+            with self.subTest(list_name):
+                def render():
+                    page = load(user, statuses)
+                    self.assertTrue(page[0])
+                    runbot.render_list_page(user, list_name, page)
+                self.assert_page_queries(list_name, render)
+
+    def test_search_page(self):
+        search = {'id': 1, 'departure': 'Москва', 'destination': 'Сочи', 'date': self.departure.date().isoformat()}
+        for sort in runbot.SEARCH_ORDERINGS:
+            with self.subTest(sort):
+                def render():
+                    page = runbot.find_trips_page({**search, 'sort': sort})
+                    self.assertTrue(page[0])
+                    runbot.render_search_page(self.passengers[1], {**search, 'sort': sort}, page)
+                self.assert_page_queries(sort, render)
+
+    def test_rating_pairs(self):
+        few, many = self.trips[0], self.trips[1]
+        for passenger in self.passengers[1:]:
+            Booking.objects.create(passenger=passenger, trip=many, seats_booked=1)
+        counts = [
+            self.count_queries(lambda: self.assertTrue(runbot.get_pending_rating_pairs(runbot.get_trip_by_id(trip.id))))
+            for trip in (few, many)
+        ]
+        self.assert_same_queries('get_pending_rating_pairs', *counts)
+
+
+class AdminQueryCountTests(QueryCountTestMixin, TestCase):
+    """Все страницы админки: список и карточка при росте данных делают столько же запросов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username='admin', password=None, name='Администратор')
+        cls.batches = 0
+
+    def create_batch(self, size):
+        """Набор связанных записей; size - сколько пассажиров, броней и сообщений на каждую запись."""
+        n = self.batches = self.batches + 1
+        driver = User.objects.create(username=f'driver{n}', telegram_id=100 * n, name=f'Водитель {n}')
+        passengers = [
+            User.objects.create(username=f'passenger{n}_{k}', telegram_id=100 * n + k + 1, name=f'Пассажир {n}.{k}')
+            for k in range(size)
+        ]
+        Group.objects.create(name=f'Группа {n}')
+        city = City.objects.create(name=f'Город {n}')
+        CityAlias.objects.bulk_create([CityAlias(city=city, alias=f'Город {n}.{k}', key=f'gorod {n} {k}') for k in range(size)])
+        for k in range(2):
+            vehicle = Vehicle.objects.create(driver=driver, brand='Lada', model='Vesta', license_plate=f'B{n}{k}BB')
+            trip = Trip.objects.create(
+                driver=driver, vehicle=vehicle, departure_location=f'Город {n}', destination_location='Сочи',
+                departure_city=city, departure_time=timezone.now() + timedelta(days=n, hours=k),
+                available_seats=4, price=Decimal('500'),
+            )
+            Booking.objects.bulk_create([Booking(passenger=passenger, trip=trip, seats_booked=1) for passenger in passengers])
+        for passenger in passengers:
+            ticket = SupportTicket.objects.create(user=passenger, message='Вопрос')
+            ChatMessage.objects.bulk_create([ChatMessage(ticket=ticket, author=passenger, message=f'Сообщение {k}') for k in range(size)])
+
+    def page_queries(self, client, url):
+        def get():
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+        return self.count_queries(get)
+
+    def measure(self, client):
+        counts = {}
+        for model in admin.site._registry:
+            info = (model._meta.app_label, model._meta.model_name)
+            latest = model._default_manager.order_by('-pk').values_list('pk', flat=True).first()
+            counts[model._meta.label_lower, 'список'] = self.page_queries(client, reverse('admin:%s_%s_changelist' % info))
+            counts[model._meta.label_lower, 'карточка'] = self.page_queries(client, reverse('admin:%s_%s_change' % info, args=[latest]))
+        return counts
+
+    def test_pages_do_not_grow_with_data(self):
+        client = Client()
+        client.force_login(self.admin)
+        self.create_batch(size=1)
+        self.measure(client)  # кэши процесса (типы содержимого и т.п.) - не в счет
+        fewer = self.measure(client)
+        self.create_batch(size=3)
+        more = self.measure(client)
+        for page, queries in more.items():
+            with self.subTest(page):
+                self.assert_same_queries(' '.join(page), fewer[page], queries)
+
+
+def registered_callbacks(application):
+    """Имена callback всех обработчиков приложения, включая состояния диалогов."""
+    names = set()
+    pending = [handler for handlers in application.handlers.values() for handler in handlers]
+    while pending:
+        handler = pending.pop()
+        if isinstance(handler, ConversationHandler):
+            pending += handler.entry_points + handler.fallbacks
+            pending += [state_handler for handlers in handler.states.values() for state_handler in handlers]
+        else:
+            names.add(handler.callback.__name__)
+    return names
+
+
+class BotHarnessMixin:
+    """
+    Application из runbot с заглушкой Bot API (Harness из loadtest_bot) на тестовой БД.
+    Цикл событий бота работает в своем потоке, а запросы обработчиков идут через
+    один поток БД с соединением теста: они видят данные теста и откатываются вместе с ним.
+    """
+
+    def setUp(self):
+        super().setUp()
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        db = connections[DEFAULT_DB_ALIAS]
+        db.inc_thread_sharing()
+        self.addCleanup(db.dec_thread_sharing)
+        executor = ThreadPoolExecutor(max_workers=1, initializer=connections.__setitem__, initargs=(DEFAULT_DB_ALIAS, db))
+        self.addCleanup(executor.shutdown)
+        patches = [
+            patch.object(db_executor, '_executor', executor),
+            # Соединение теста не закрывается: в нем транзакция TestCase
+            patch.object(db_executor, 'close_old_connections', lambda: None),
+            # Состояние диалогов пишется при остановке, а не посреди шага с подсчетом запросов
+            patch.object(runbot, 'DjangoPersistence', functools.partial(DjangoPersistence, flush_delay=3600)),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, name='bot-loop', daemon=True)
+        thread.start()
+
+        def close():
+            try:
+                self.run_async(self.harness.close())
+            finally:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                thread.join()
+                self.loop.close()
+                configure_metrics(enabled=False)
+                metrics.samples = None
+                metrics._readings.clear()
+                metrics.reset()
+
+        self.harness = self.run_async(Harness.open(concurrency=4))
+        self.addCleanup(close)
+
+    def run_async(self, coroutine, timeout=30):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def synthetic_user(self, number, route=('Москва', 'Сочи')):
+        return SyntheticUser(self.harness, TELEGRAM_ID_BASE + number, route)
+
+
+class HandlerQueryBudgetTests(BotHarnessMixin, QueryCountTestMixin, TestCase):
+    """Каждый обработчик runbot укладывается в бюджет запросов (пользователь уже в кэше, если не сказано иное)."""
+
+    # Бюджет обработчика - запросы одного апдейта вместе с загрузкой пользователя и состояния диалога
+    BUDGETS = {
+        # Регистрация: пользователя и его состояния еще нет (три поиска пользователя - по числу get_current_user)
+        'start': 7,
+        'select_language': 2,
+        'request_phone_number': 2,
+        'select_role': 2,
+        # Водитель: первая поездка вместе с автомобилем (справочник городов загружается один раз)
+        'create_trip_start': 2,
+        'add_vehicle_brand': 0,
+        'add_vehicle_model': 0,
+        'add_vehicle_plate': 1,
+        'trip_select_vehicle': 0,
+        'trip_enter_departure': 0,
+        'trip_enter_destination': 0,
+        'trip_enter_time': 0,
+        'trip_enter_seats': 0,
+        'trip_enter_price': 5,
+        'my_trips': 1,
+        'edit_trip_start': 0,
+        'edit_trip_select_field': 0,
+        'edit_trip_enter_value': 2,
+        # Вместе с фоновой рассылкой запросов оценки
+        'complete_trip': 6,
+        'cancel_trip': 2,
+        'trip_history': 1,
+        # Пассажир
+        'find_trip_start': 1,
+        'find_trip_enter_departure': 0,
+        'find_trip_enter_destination': 0,
+        'find_trip_enter_date': 1,
+        'handle_search_page': 1,
+        'book_trip_start': 4,
+        'book_trip_enter_seats': 6,
+        'my_bookings': 1,
+        'handle_list_page': 1,
+        'start_chat': 1,
+        'forward_message': 0,
+        'cancel_chat': 0,
+        'my_profile': 0,
+        'change_role': 0,
+        'confirm_role_change': 0,
+        'show_main_menu': 0,
+        'support_start': 0,
+        'support_enter_message': 1,
+        # Вместе с фоновой записью сообщения
+        'support_chat_message': 1,
+        # Вместе со снятием удержания мест
+        'cancel': 3,
+        'handle_rating': 5,
+    }
+
+    def step(self, handler, action):
+        """Один апдейт: должен сработать обработчик handler и уложиться в свой бюджет."""
+        calls = metrics.latency[handler].count
+        with self.assertMaxQueries(self.BUDGETS[handler], handler):
+            self.run_async(action)
+        self.assertEqual(metrics.latency[handler].count, calls + 1, f"апдейт не дошел до {handler}")
+        self.assertFalse(self.harness.errors, handler)
+
+    async def wait_for_prompts(self, user, count, timeout=5.0):
+        """Запросы оценок уходят в фоне (start_rating_process) - их запросы тоже в счет complete_trip."""
+        deadline = self.loop.time() + timeout
+        while len(self.harness.stub.prompts.get(user.id, ())) < count and self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def complete(self, driver, trip_id, passengers):
+        await driver.press(f'complete_trip_{trip_id}')
+        for user in (driver, *passengers):
+            await self.wait_for_prompts(user, 1)
+
+    async def chat_message(self, user, text):
+        """Сообщение в обращение пишется в фоне - запись тоже в счет обработчика."""
+        await user.send(text)
+        await get_chat_writer().flush()
+
+    def register(self, user, role_button):
+        self.step('start', user.send('/start'))
+        self.step('select_language', user.send("Русский 🇷🇺"))
+        self.step('request_phone_number', user.send(contact=f"+7900{user.id % 10_000_000:07d}"))
+        self.step('select_role', user.send(role_button))
+
+    def test_handlers_within_budget(self):
+        departure = timezone.localtime() + timedelta(days=1)
+        driver, passenger = self.synthetic_user(1), self.synthetic_user(2)
+        self.register(driver, "Я Водитель 🚕")
+        self.register(passenger, "Я Пассажир 🧍")
+        verify_drivers([driver.id])
+
+        # Водитель: первая поездка с добавлением автомобиля, затем вторая на том же автомобиле
+        self.step('create_trip_start', driver.send(runbot.CREATE_TRIP_BTN))
+        for handler, text in (('add_vehicle_brand', "Kia"), ('add_vehicle_model', "Rio"), ('add_vehicle_plate', "Н001ТЕ")):
+            self.step(handler, driver.send(text))
+        trip_steps = ['trip_enter_departure', 'trip_enter_destination', 'trip_enter_time', 'trip_enter_seats', 'trip_enter_price']
+        for hours in (0, 5):
+            if hours:
+                self.step('create_trip_start', driver.send(runbot.CREATE_TRIP_BTN))
+                self.step('trip_select_vehicle', driver.press_button('select_vehicle_'))
+            texts = ['Москва', 'Сочи', (departure + timedelta(hours=hours)).strftime('%d.%m.%Y %H:%M'), '3', '500']
+            for handler, text in zip(trip_steps, texts):
+                self.step(handler, driver.send(text))
+        self.step('my_trips', driver.send(MY_TRIPS_BTN))
+        self.step('edit_trip_start', driver.press_button('edit_trip_'))
+        self.step('edit_trip_select_field', driver.press('edit_field_price'))
+        self.step('edit_trip_enter_value', driver.send('700'))
+
+        # Пассажир: поиск, смена сортировки, отмененная и состоявшаяся брони
+        self.step('find_trip_start', passenger.send(runbot.FIND_TRIP_BTN))
+        self.step('find_trip_enter_departure', passenger.send('Москва'))
+        self.step('find_trip_enter_destination', passenger.send('Сочи'))
+        self.step('find_trip_enter_date', passenger.send(departure.strftime('%d.%m.%Y')))
+        self.step('handle_search_page', passenger.press_button('search_1_price'))
+        self.step('book_trip_start', passenger.press_button('book_trip_'))
+        self.step('cancel', passenger.send('/cancel'))
+        self.step('book_trip_start', passenger.press_button('book_trip_'))
+        self.step('book_trip_enter_seats', passenger.send('1'))
+        self.step('start_chat', passenger.press_button('contact_user_'))
+        self.step('forward_message', passenger.send('Где встречаемся?'))
+        self.step('cancel_chat', passenger.send('/cancel'))
+        with override_settings(BOT_LIST_PAGE_SIZE=1):
+            self.step('my_bookings', passenger.send(MY_BOOKINGS_BTN))
+            self.step('my_trips', driver.send(MY_TRIPS_BTN))
+            self.step('handle_list_page', driver.press_button('page_'))
+        self.step('my_profile', passenger.send(MY_PROFILE_BTN))
+        self.step('change_role', passenger.send(runbot.CHANGE_ROLE_BTN))
+        self.step('confirm_role_change', passenger.send(runbot.CONFIRM_NO_BTN))
+        self.step('show_main_menu', passenger.send(runbot.BACK_TO_MENU_BTN))
+        self.step('support_start', passenger.send(SUPPORT_BTN))
+        self.step('support_enter_message', passenger.send('Не приходит уведомление'))
+        self.step('support_chat_message', self.chat_message(passenger, 'Повторяю вопрос'))
+        self.step('cancel', passenger.send('/cancel'))
+
+        # Водитель завершает одну поездку и отменяет другую, оба оценивают друг друга
+        booked = Booking.objects.get(passenger__telegram_id=passenger.id).trip_id
+        self.step('my_trips', driver.send(MY_TRIPS_BTN))
+        self.step('complete_trip', self.complete(driver, booked, [passenger]))
+        self.step('my_trips', driver.send(MY_TRIPS_BTN))
+        self.step('cancel_trip', driver.press_button('cancel_trip_'))
+        self.step('trip_history', driver.send(TRIP_HISTORY_BTN))
+        self.step('trip_history', passenger.send(TRIP_HISTORY_BTN))
+        for user in (driver, passenger):
+            self.step('handle_rating', user.rate())
+        self.assertEqual(User.objects.get(telegram_id=driver.id).rating_count, 1)
+        self.assertEqual(User.objects.get(telegram_id=passenger.id).rating_count, 1)
+        # Новый обработчик в runbot должен получить бюджет и шаг в этом сценарии
+        handled = {name for name, histogram in metrics.latency.items() if histogram.count}
+        self.assertEqual(handled - {'load_current_user'}, set(self.BUDGETS))
+        self.assertEqual(registered_callbacks(self.harness.application) - {'load_current_user'}, set(self.BUDGETS))
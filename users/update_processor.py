@@ -0,0 +1,103 @@
+# users/update_processor.py
+
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Сколько апдейтов может ждать своей очереди внутри процессора
+MAX_PENDING_UPDATES = 10_000
+
+
+def ordering_key(update):
+    """Апдейты с одинаковым ключом (чат, иначе пользователь) обрабатываются строго по очереди."""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    return user.id if user is not None else None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов разных чатов с сохранением порядка
+    внутри одного чата: состояние ConversationHandler пользователя меняется
+    последовательно, а медленный обработчик одного пользователя не задерживает
+    остальных.
+
+    Одновременно выполняется не больше concurrency обработчиков. Апдейты,
+    ждущие своего чата, слот не занимают.
+    """
+
+    def __init__(self, concurrency):
+        super().__init__(max_concurrent_updates=MAX_PENDING_UPDATES)
+        self.concurrency = concurrency
+        self._limit = asyncio.Semaphore(concurrency)
+        self._chat_locks = {}  # ключ -> [asyncio.Lock, число апдейтов в очереди чата]
+        self.active = 0
+        self.waiting = 0  # ждут свободного слота
+        self.chat_waiting = 0  # ждут, пока обработается предыдущий апдейт своего чата
+        self.max_waiting = 0
+        self.max_chat_depth = 0
+        self.processed = 0
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'active': self.active,
+            'waiting': self.waiting,
+            'pending': self.waiting + self.chat_waiting,
+            'chats': len(self._chat_locks),
+            'max_waiting': self.max_waiting,
+            'max_chat_depth': self.max_chat_depth,
+            'processed': self.processed,
+        }
+
+    async def do_process_update(self, update, coroutine):
+        key = ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.max_chat_depth = max(self.max_chat_depth, entry[1])
+        try:
+            self.chat_waiting += 1
+            try:
+                await entry[0].acquire()
+            finally:
+                self.chat_waiting -= 1
+            try:
+                await self._run(coroutine)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def _run(self, coroutine):
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._limit.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+            self._limit.release()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logger.info(f"Обработка апдейтов завершена: {self.stats()}")
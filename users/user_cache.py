@@ -0,0 +1,67 @@
+# users/user_cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class UserCache:
+    """
+    Ограниченный LRU-кэш пользователей бота с временем жизни записей (TTL).
+    Ключ - telegram_id. Потокобезопасен: к кэшу обращаются из потоков ORM.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id):
+        with self._lock:
+            entry = self._data.get(telegram_id)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[telegram_id]
+                return None
+            self._data.move_to_end(telegram_id)
+            return user
+
+    def set(self, user):
+        if user is None or user.telegram_id is None:
+            return
+        with self._lock:
+            self._data[user.telegram_id] = (user, time.monotonic() + self.ttl)
+            self._data.move_to_end(user.telegram_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._data.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+user_cache = UserCache(
+    maxsize=getattr(settings, 'BOT_USER_CACHE_MAXSIZE', 2048),
+    ttl=getattr(settings, 'BOT_USER_CACHE_TTL', 60),
+)
+
+
+def invalidate_user(telegram_id):
+    """
+    Сбрасывает запись пользователя в кэше текущего процесса.
+    В других процессах (бот запущен отдельно от админки) запись устареет по TTL.
+    """
+    if telegram_id is not None:
+        user_cache.invalidate(telegram_id)
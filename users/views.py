@@ -1,3 +1,39 @@
-from django.shortcuts import render
+import hmac
+import json
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from telegram import Update
+
+from .webhook import get_application
+
+
+@csrf_exempt
+@require_POST
+async def telegram_webhook(request):
+    """
+    Принимает апдейт от Telegram, проверяет секретный токен
+    и передает его в очередь апдейтов бота.
+    """
+    application = get_application()
+    if application is None:
+        # Бот в этом процессе не запущен
+        return HttpResponse(status=503)
+
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not settings.BOT_WEBHOOK_SECRET or not hmac.compare_digest(secret, settings.BOT_WEBHOOK_SECRET):
+        return HttpResponseForbidden()
+
+    try:
+        data = json.loads(request.body)
+        # Апдейт - объект JSON: на список, число или объект без update_id отвечаем 400, а не 500
+        if not isinstance(data, dict):
+            raise ValueError("апдейт должен быть объектом JSON")
+        update = Update.de_json(data, application.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return HttpResponseBadRequest()
+
+    await application.update_queue.put(update)
+    return HttpResponse()
@@ -0,0 +1,14 @@
+# users/webhook.py
+
+# Application бота, запущенного в этом процессе (manage.py runbot --webhook).
+# В обычном процессе Daphne без бота остается None.
+_application = None
+
+
+def register_application(application):
+    global _application
+    _application = application
+
+
+def get_application():
+    return _application